@@ -0,0 +1,185 @@
+# ASGI entry point: uvicorn asgi:app
+#
+# Requests that mostly wait (the /live change feed and /sync long polls
+# with a wait parameter) are served by coroutines here, so one process can
+# hold thousands of them open without a thread each. Everything else is
+# passed to the Flask app through asgiref's WsgiToAsgi and runs on its
+# thread pool, so the route modules are the same in both modes.
+
+import asyncio
+import logging
+import time
+import urllib.parse
+
+import flask_jwt_extended
+from surrealdb import RecordID
+
+import changelog
+from extensions import adb, change_feed, revoked_tokens
+from live import format_event
+from main import create_app, start_services, stop_services
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+logger = logging.getLogger(__name__)
+
+
+def _query(scope):
+    return dict(urllib.parse.parse_qsl(scope.get("query_string", b"").decode()))
+
+
+def _header(scope, name):
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+class AsgiApp:
+    def __init__(self, flask_app):
+        if WsgiToAsgi is None:
+            raise RuntimeError("The ASGI entry point needs asgiref: pip install asgiref uvicorn")
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+
+        flask_app.config.setdefault("SYNC_MAX_WAIT", 60.0)
+        flask_app.config.setdefault("SYNC_POLL_INTERVAL", 5.0)
+        self.max_wait = flask_app.config["SYNC_MAX_WAIT"]
+        self.poll_interval = flask_app.config["SYNC_POLL_INTERVAL"]
+        adb.init_app(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+
+        if scope["type"] == "http" and scope["method"] == "GET":
+            path = scope["path"].rstrip("/")
+            if path == "/live":
+                return await self._live(scope, receive, send)
+            if path == "/sync" and "wait" in _query(scope):
+                return await self._long_poll(scope, receive, send)
+
+        await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await asyncio.to_thread(start_services, self.flask_app)
+                    await adb.start()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await adb.close()
+                await asyncio.to_thread(stop_services, self.flask_app)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _authenticate(self, scope):
+        # The checks jwt_required() makes: signature, expiry, token type and
+        # the blocklist. Returns the user id or None.
+        authorization = _header(scope, b"authorization") or ""
+        if not authorization.startswith("Bearer "):
+            return None
+        try:
+            with self.flask_app.app_context():
+                decoded = flask_jwt_extended.decode_token(authorization.removeprefix("Bearer "))
+        except Exception:
+            return None
+        if decoded.get("type") != "access":
+            return None
+        if await asyncio.to_thread(self._is_revoked, decoded["jti"]):
+            return None
+        return f"user:{decoded['sub']}"
+
+    def _is_revoked(self, jti):
+        # A cache miss reads through get_db(), which needs an app context
+        with self.flask_app.app_context():
+            return revoked_tokens.is_revoked(jti)
+
+    async def _live(self, scope, receive, send):
+        user_id = await self._authenticate(scope)
+        if user_id is None:
+            return await self._error(send, 401, "Missing or invalid access token")
+
+        subscription = change_feed.subscribe(user_id, loop=asyncio.get_running_loop())
+        disconnected = asyncio.create_task(self._disconnected(receive))
+        dumps = self.flask_app.json.dumps
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": b"retry: 5000\n\n", "more_body": True})
+            while not disconnected.done():
+                change = await subscription.wait(change_feed.heartbeat)
+                await send({"type": "http.response.body", "body": format_event(change, dumps).encode(), "more_body": True})
+        except OSError:
+            pass
+        finally:
+            change_feed.unsubscribe(subscription)
+            disconnected.cancel()
+
+    async def _long_poll(self, scope, receive, send):
+        # Holds GET /sync?since=...&wait=N until the user has a change after
+        # since or N seconds pass, then answers through the Flask handler.
+        # Waiting costs a coroutine; the change feed wakes it early and the
+        # change log is checked every SYNC_POLL_INTERVAL in case it can't.
+        user_id = await self._authenticate(scope)
+        query = _query(scope)
+        try:
+            wait = min(max(float(query["wait"]), 0.0), self.max_wait)
+            at, key = changelog.decode_token(query["since"])
+        except (KeyError, ValueError):
+            user_id = None
+        if user_id is None:
+            # The Flask handler produces the right 400 or 401
+            return await self.wsgi(scope, receive, send)
+
+        subscription = change_feed.subscribe(user_id, loop=asyncio.get_running_loop())
+        deadline = time.monotonic() + wait
+        try:
+            while not await self._has_changes(user_id, at, key):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await subscription.wait(min(remaining, self.poll_interval))
+        finally:
+            change_feed.unsubscribe(subscription)
+
+        await self.wsgi(scope, receive, send)
+
+    async def _has_changes(self, user_id, at, key):
+        async with adb.connection() as db:
+            rows = await db.query(
+                changelog.CHANGES_SINCE,
+                {"user_id": RecordID.parse(user_id), "at": at, "key": key, "limit": 1}
+            )
+        return bool(rows)
+
+    async def _disconnected(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    async def _error(self, send, status, message):
+        body = self.flask_app.json.dumps({"error": message}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+app = AsgiApp(create_app({"LAZY_START": True}))
@@ -0,0 +1,68 @@
+# Free/busy computation over many users' events
+
+import heapq
+from datetime import timedelta
+
+from recurrence import comparable, expand, parse_datetime
+
+
+def merge_intervals(intervals):
+    # Sweeps (start, end) pairs in start order, joining any that touch or
+    # overlap. Returns a new sorted list of disjoint intervals.
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def busy_intervals(events, window_start, window_end):
+    # Merged busy blocks for one user's events, clipped to the window.
+    # Recurring events are expanded inside the window only.
+    intervals = []
+    for event in events:
+        if event.get("busy") is False:
+            continue
+        for occurrence in expand(event, window_start, window_end):
+            start = max(comparable(parse_datetime(occurrence["start_time"])), window_start)
+            end = min(comparable(parse_datetime(occurrence["end_time"])), window_end)
+            if start < end:
+                intervals.append((start, end))
+    return merge_intervals(intervals)
+
+
+def free_slots(busy_by_user, window_start, window_end, duration):
+    # Common free time is the complement of the union of everyone's busy
+    # blocks. Each user's list is already sorted, so they are k-way merged
+    # and swept once.
+    slots = []
+    cursor = window_start
+    for start, end in heapq.merge(*busy_by_user):
+        if start - cursor >= duration:
+            slots.append((cursor, start))
+        cursor = max(cursor, end)
+    if window_end - cursor >= duration:
+        slots.append((cursor, window_end))
+    return slots
+
+
+def as_json(intervals):
+    return [{"start": start.isoformat(), "end": end.isoformat()} for start, end in intervals]
+
+
+def parse_window(range_from, range_to):
+    window_start = comparable(parse_datetime(range_from))
+    window_end = comparable(parse_datetime(range_to))
+    if window_start >= window_end:
+        raise ValueError("from must be before to")
+    return window_start, window_end
+
+
+def parse_duration(minutes):
+    duration = timedelta(minutes=int(minutes))
+    if duration <= timedelta(0):
+        raise ValueError("duration_minutes must be positive")
+    return duration
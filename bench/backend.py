@@ -0,0 +1,74 @@
+# Database the benchmark app talks to
+#
+# mem:// runs SurrealDB's embedded in-memory engine inside this process.
+# Each embedded Surreal() is its own database, so every pooled connection
+# wraps the same one, and calls are serialized because the engine is
+# shared. Any other URL (e.g. ws://localhost:8000 for
+# `surreal start memory`) goes through SurrealInstance.connect() as usual
+# with DB_USER and DB_PASS; point it at a throwaway server, seeding writes
+# to the app's namespace.
+
+import os
+import threading
+
+import surrealdb
+
+
+class MemoryDriver:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db = surrealdb.Surreal("mem://")
+        self._db.use("Test", "Test")
+
+    def connect(self):
+        return MemoryConnection(self)
+
+    async def connect_async(self):
+        return AsyncMemoryConnection(self)
+
+
+class MemoryConnection:
+    # The query surface SurrealInstance and query_all use
+    def __init__(self, driver):
+        self._driver = driver
+
+    def query(self, query, vars=None):
+        with self._driver._lock:
+            return self._driver._db.query(query, vars or {})
+
+    def query_raw(self, query, vars=None):
+        with self._driver._lock:
+            return self._driver._db.query_raw(query, vars or {})
+
+    def close(self):
+        pass
+
+
+class AsyncMemoryConnection(MemoryConnection):
+    # The same for AsyncSurrealInstance; the engine answers in process, so
+    # the calls don't wait on anything worth yielding for
+
+    async def query(self, query, vars=None):
+        return super().query(query, vars)
+
+    async def query_raw(self, query, vars=None):
+        return super().query_raw(query, vars)
+
+    async def subscribe_live(self, query_uuid):
+        # Like the SDK's embedded connections, which have no notifications
+        raise NotImplementedError("live not implemented for the embedded engine")
+
+    async def close(self):
+        pass
+
+
+def configure(sdb, url, adb=None):
+    # Points sdb, and adb for the ASGI app, at url before the app starts
+    # its pools
+    if url == "mem://":
+        driver = MemoryDriver()
+        sdb.connect = driver.connect
+        if adb is not None:
+            adb.connect = driver.connect_async
+    else:
+        os.environ["DB_URL"] = url
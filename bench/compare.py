@@ -0,0 +1,63 @@
+# Regression check between two runs: python -m bench.compare base.json new.json
+#
+# Prints each scenario's p50/p95/throughput side by side and exits with 1
+# when any scenario shared by both runs got slower at p95 or lost
+# throughput by more than --threshold, so CI can run it after bench.run.
+
+import argparse
+import json
+import sys
+
+METRICS = (("p50_ms", False), ("p95_ms", True), ("p99_ms", False), ("throughput", True))
+
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare(base, new, threshold):
+    # (rows, regressions); higher is worse for latencies, better for throughput
+    rows, regressions = [], []
+    for name in sorted(set(base["scenarios"]) & set(new["scenarios"])):
+        before, after = base["scenarios"][name], new["scenarios"][name]
+        for metric, gated in METRICS:
+            delta = change(before.get(metric), after.get(metric))
+            worse = delta is not None and (-delta if metric == "throughput" else delta) > threshold
+            rows.append((name, metric, before.get(metric), after.get(metric), delta, worse and gated))
+            if worse and gated:
+                regressions.append(f"{name} {metric}")
+        if after.get("errors") and not before.get("errors"):
+            regressions.append(f"{name} errors")
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.compare")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative change, default 0.10")
+    args = parser.parse_args(argv)
+
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    if base.get("config", {}).get("users") != new.get("config", {}).get("users"):
+        print("warning: the runs seeded different data sizes", file=sys.stderr)
+
+    rows, regressions = compare(base, new, args.threshold)
+    print(f"{'scenario':>14} {'metric':>10} {base.get('commit') or 'base':>12} {new.get('commit') or 'new':>12} {'change':>8}")
+    for name, metric, before, after, delta, flagged in rows:
+        shown = "" if delta is None else f"{delta:+.1%}"
+        print(f"{name:>14} {metric:>10} {before!s:>12} {after!s:>12} {shown:>8}{'  !' if flagged else ''}")
+
+    if regressions:
+        print("Regressed: " + ", ".join(regressions), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+# Benchmark runner: python -m bench.run [options]
+#
+# Boots the app against an in-memory SurrealDB (or --db URL), seeds it and
+# replays each scenario through Flask's test client from --concurrency
+# threads, so the numbers cover the routes, JWT checks, serialization and
+# the database but not a network or server. Results, including the commit
+# they were measured on, go to a JSON file for bench.compare.
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import flask_jwt_extended
+
+from bench import backend
+from bench.scenarios import SCENARIOS
+from bench.seed import seed
+from extensions import queries, sdb, tracer
+from main import create_app, start_services, stop_services
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(ordered, fraction):
+    # Nearest rank on an already sorted list
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def summarize(latencies, failures, seconds):
+    ordered = sorted(latencies)
+    milliseconds = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "requests": len(ordered),
+        "errors": failures,
+        "seconds": round(seconds, 3),
+        "throughput": round(len(ordered) / seconds, 2) if seconds else None,
+        "mean_ms": milliseconds(sum(ordered) / len(ordered)) if ordered else None,
+        "p50_ms": milliseconds(percentile(ordered, 0.50)),
+        "p95_ms": milliseconds(percentile(ordered, 0.95)),
+        "p99_ms": milliseconds(percentile(ordered, 0.99)),
+        "max_ms": milliseconds(ordered[-1]) if ordered else None,
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(app, tokens, requests, concurrency):
+    local = threading.local()
+    latencies, failures, errors = [], 0, {}
+    lock = threading.Lock()
+
+    def send(numbered):
+        nonlocal failures
+        number, (label, method, path, body, user_id, ok) = numbered
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        headers = {"Authorization": f"Bearer {tokens[user_id]}"} if user_id else {}
+
+        started = time.perf_counter()
+        # Spread requests over addresses as if they came from many clients,
+        # so per-address limits see realistic traffic
+        address = f"10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}"
+        response = client.open(path, method=method, json=body, headers=headers, environ_base={"REMOTE_ADDR": address})
+        response.get_data()
+        elapsed = time.perf_counter() - started
+
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code not in ok:
+                failures += 1
+                key = f"{label} {response.status_code}"
+                errors[key] = errors.get(key, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, enumerate(requests)))
+    result = summarize(latencies, failures, time.perf_counter() - started)
+    if errors:
+        result["error_statuses"] = errors
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.run", description=__doc__)
+    parser.add_argument("--db", default="mem://", help="mem:// for the embedded engine, or a SurrealDB URL")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--events-per-user", type=int, default=40)
+    parser.add_argument("--shares-per-event", type=int, default=3)
+    parser.add_argument("--follows-per-user", type=int, default=15)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracing", action="store_true", help="run with TRACING on and include phase latencies")
+    parser.add_argument("--output", help="defaults to bench/results/<commit>.json")
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenarios: " + ", ".join(unknown))
+
+    app = create_app({
+        "LAZY_START": True,
+        "JWT_SECRET_KEY": os.getenv("FLASK_SECRET_KEY") or secrets.token_hex(32),
+        "JWT_ACCESS_TOKEN_EXPIRES": timedelta(hours=12),
+        "WEBHOOK_DISPATCH": False,
+        "DB_POOL_MAX": max(args.concurrency, 2),
+        # Let every client thread queue a login; shedding is measured
+        # separately from hashing throughput
+        "PASSWORD_MAX_PENDING": args.concurrency,
+        "TRACING": args.tracing,
+    })
+    backend.configure(sdb, args.db)
+    start_services(app)
+
+    rng = random.Random(args.seed)
+    print(f"Seeding {args.users} users...", file=sys.stderr)
+    with sdb.connection() as db:
+        data = seed(db, args.users, args.events_per_user, args.shares_per_event, args.follows_per_user, rng)
+    print(f"Seeded {data.counts} in {data.seconds:.1f}s", file=sys.stderr)
+
+    with app.app_context():
+        tokens = {user_id: flask_jwt_extended.create_access_token(user_id[5:]) for user_id in data.users}
+
+    results = {}
+    for name in names:
+        requests = SCENARIOS[name](data, rng, args.warmup + args.requests)
+        run_scenario(app, tokens, requests[:args.warmup], args.concurrency)
+        queries.reset()
+        results[name] = run_scenario(app, tokens, requests[args.warmup:], args.concurrency)
+        results[name]["statements"] = {
+            statement: {"count": stats["count"], "mean_ms": round(stats["sum"] / stats["count"] * 1000, 3), "max_ms": round(stats["max"] * 1000, 3)}
+            for statement, stats in sorted(queries.stats().items()) if stats["count"]
+        }
+        summary = results[name]
+        print(
+            f"{name:>14}: {summary['throughput']} req/s, p50 {summary['p50_ms']} ms, "
+            f"p95 {summary['p95_ms']} ms, p99 {summary['p99_ms']} ms, {summary['errors']} errors",
+            file=sys.stderr
+        )
+
+    report = {
+        "commit": commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "backend": args.db,
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "seed": {"counts": data.counts, "seconds": round(data.seconds, 3)},
+        "scenarios": results,
+    }
+    if args.tracing:
+        report["phases"] = {labels["phase"]: snapshot for labels, snapshot in tracer.phase_histograms()}
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2, default=str)
+    print(f"Wrote {output}", file=sys.stderr)
+
+    stop_services(app)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Scripted request mixes
+#
+# Each scenario turns the seeded dataset into a list of requests, decided
+# up front from the run's random seed so two runs send the same traffic.
+# A request is (label, method, path, json body, user, ok statuses); user
+# picks the access token, None sends none.
+
+from datetime import timedelta
+
+from bench.seed import PASSWORD, START, WEEKS
+
+
+def login_storm(data, rng, count):
+    requests = []
+    for _ in range(count):
+        user_id = rng.choice(data.users)
+        body = {"email": data.emails[user_id], "password": PASSWORD}
+        requests.append(("login", "POST", "/auth/login", body, None, (200,)))
+    return requests
+
+
+def week_view(data, rng, count):
+    requests = []
+    for _ in range(count):
+        user_id = rng.choice(data.users)
+        week = START + timedelta(weeks=rng.randrange(WEEKS))
+        path = f"/events/?from={_iso(week)}&to={_iso(week + timedelta(weeks=1))}"
+        requests.append(("week", "GET", path, None, user_id, (200,)))
+    return requests
+
+
+def event_detail(data, rng, count):
+    requests = []
+    for _ in range(count):
+        user_id = rng.choice(data.users)
+        event_id = rng.choice(data.events[user_id]).split(":", 1)[1]
+        requests.append(("event", "GET", f"/events/{event_id}", None, user_id, (200,)))
+    return requests
+
+
+def mass_share(data, rng, count, audience=50):
+    requests = []
+    for _ in range(count):
+        user_id = rng.choice(data.users)
+        event_id = rng.choice(data.events[user_id]).split(":", 1)[1]
+        others = rng.sample([other for other in data.users if other != user_id], min(audience, len(data.users) - 1))
+        body = {
+            "shares": [{"user_id": other[5:], "share": "view"} for other in others],
+            "groups": [{"label_id": label_id.split(":", 1)[1], "share": "view"} for label_id in data.labels[user_id]],
+        }
+        requests.append(("share", "POST", f"/events/{event_id}/share", body, user_id, (200,)))
+    return requests
+
+
+def follow_graph(data, rng, count):
+    # Following someone new, then reading the lists it changed
+    requests = []
+    for _ in range(count):
+        user_id, other = rng.sample(data.users, 2)
+        match rng.randrange(3):
+            case 0:
+                requests.append(("follow", "POST", "/social/following", {"target_user_id": other[5:]}, user_id, (201,)))
+            case 1:
+                requests.append(("following", "GET", "/social/following", None, user_id, (200,)))
+            case 2:
+                requests.append(("friends", "GET", "/social/friends", None, user_id, (200,)))
+    return requests
+
+
+def suggestions(data, rng, count):
+    requests = []
+    for _ in range(count):
+        requests.append(("suggestions", "GET", "/social/suggestions", None, rng.choice(data.users), (200,)))
+    return requests
+
+
+def sync_snapshot(data, rng, count):
+    requests = []
+    for _ in range(count):
+        requests.append(("sync", "GET", "/sync/", None, rng.choice(data.users), (200,)))
+    return requests
+
+
+def _iso(moment):
+    return moment.isoformat().replace("+", "%2B")
+
+
+SCENARIOS = {
+    "login_storm": login_storm,
+    "week_view": week_view,
+    "event_detail": event_detail,
+    "mass_share": mass_share,
+    "follow_graph": follow_graph,
+    "suggestions": suggestions,
+    "sync_snapshot": sync_snapshot,
+}
@@ -0,0 +1,120 @@
+# Realistic data volumes for the benchmark
+#
+# Users follow a random set of others (mutual follows become friends) and
+# sort some of them into two relationship labels. Each user owns events
+# spread over WEEKS weeks from START, a few of them weekly series, and
+# shares some with people they follow. Everything is written in batched
+# INSERTs straight to the database rather than through the routes.
+
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from surrealdb import RecordID
+from werkzeug.security import generate_password_hash
+
+from routes.events import validate_event
+from sharing import DIRECT
+from surreal import query_all
+
+PASSWORD = "bench-password"
+START = datetime(2026, 1, 5, tzinfo=timezone.utc)
+WEEKS = 8
+BATCH = 1000
+
+
+class Dataset:
+    def __init__(self):
+        self.users = []
+        self.emails = {}
+        self.events = {}
+        self.following = {}
+        self.labels = {}
+        self.counts = {}
+        self.seconds = 0.0
+
+
+def _insert(db, table, rows, relation=False):
+    statement = f"INSERT RELATION INTO {table} $rows RETURN NONE;" if relation else f"INSERT INTO {table} $rows RETURN NONE;"
+    for offset in range(0, len(rows), BATCH):
+        query_all(db, statement, {"rows": rows[offset:offset + BATCH]})
+
+
+def _edge_id():
+    return RecordID("has_access_to", uuid.uuid4().hex)
+
+
+def seed(db, users=200, events_per_user=40, shares_per_event=3, follows_per_user=15, rng=None):
+    rng = rng or random.Random(0)
+    data = Dataset()
+    started = time.perf_counter()
+
+    # One hash for everyone; hashing is what the login scenario measures,
+    # not what seeding should spend its time on
+    password = generate_password_hash(PASSWORD)
+    user_rows = []
+    for number in range(users):
+        user_id = f"user:u{number}"
+        email = f"user{number}@bench.test"
+        data.users.append(user_id)
+        data.emails[user_id] = email
+        user_rows.append({"id": RecordID("user", f"u{number}"), "username": f"user{number}", "email": email, "password": password})
+    _insert(db, "user", user_rows)
+
+    label_rows = []
+    for user_id in data.users:
+        data.labels[user_id] = [f"relationship_label:{user_id[5:]}_{name}" for name in ("close", "work")]
+        for label_id in data.labels[user_id]:
+            label_rows.append({"id": RecordID.parse(label_id), "owner": RecordID.parse(user_id), "name": label_id.rsplit("_", 1)[1]})
+    _insert(db, "relationship_label", label_rows)
+
+    pairs = set()
+    for user_id in data.users:
+        others = [other for other in data.users if other != user_id]
+        for other in rng.sample(others, min(follows_per_user, len(others))):
+            pairs.add((user_id, other))
+    relationship_rows = []
+    for user_id, other in pairs:
+        data.following.setdefault(user_id, []).append(other)
+        relationship_rows.append({
+            "in": RecordID.parse(user_id),
+            "out": RecordID.parse(other),
+            "type": "friends" if (other, user_id) in pairs else "following",
+            "labels": [RecordID.parse(label) for label in data.labels[user_id] if rng.random() < 0.3],
+        })
+    _insert(db, "relationship_with", relationship_rows, relation=True)
+
+    event_rows, edge_rows = [], []
+    for user_id in data.users:
+        data.events[user_id] = []
+        for number in range(events_per_user):
+            start = START + timedelta(days=rng.randrange(WEEKS * 7), hours=rng.randrange(7, 20), minutes=rng.choice((0, 15, 30, 45)))
+            event = {
+                "id": RecordID("calendar_event", uuid.uuid4().hex),
+                "title": f"Event {number}",
+                "start_time": start.isoformat(),
+                "end_time": (start + timedelta(minutes=rng.choice((30, 60, 90, 120)))).isoformat(),
+            }
+            if rng.random() < 0.05:
+                event["recurrence"] = {"rrule": "FREQ=WEEKLY;COUNT=10"}
+            validate_event(event)
+            event_rows.append(event)
+            data.events[user_id].append(str(event["id"]))
+
+            edge_rows.append({"id": _edge_id(), "in": RecordID.parse(user_id), "out": event["id"], "permission": "owner", "because_of": ["owner"], "labels": []})
+            audience = data.following.get(user_id, [])
+            for other in rng.sample(audience, min(shares_per_event, len(audience))):
+                edge_rows.append({"id": _edge_id(), "in": RecordID.parse(other), "out": event["id"], "permission": "view", "because_of": [DIRECT], "reason_permissions": {DIRECT: "view"}, "labels": []})
+    _insert(db, "calendar_event", event_rows)
+    _insert(db, "has_access_to", edge_rows, relation=True)
+
+    data.counts = {
+        "users": len(user_rows),
+        "relationship_labels": len(label_rows),
+        "relationships": len(relationship_rows),
+        "events": len(event_rows),
+        "access_edges": len(edge_rows),
+    }
+    data.seconds = time.perf_counter() - started
+    return data
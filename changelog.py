@@ -0,0 +1,190 @@
+# Per-user change log behind GET /sync
+#
+# change_log holds one row per [user, record] saying whether the record was
+# last upserted or deleted for that user and when, so the log compacts
+# itself: however often a record changes, a user has one row for it. Rows
+# only carry ids; a sync reads the current contents of the upserted
+# records and turns the ones that no longer exist into tombstones.
+#
+# Rows older than SYNC_RETENTION_DAYS are purged by compact(). A client
+# holding a token from before the last compaction has to resync from
+# scratch. Tokens trail the newest change by SYNC_SETTLE_SECONDS so a write
+# that commits with a slightly older timestamp is not skipped; changes in
+# that window can be sent twice, which is harmless for upserts and deletes.
+
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+from surrealdb import RecordID
+
+from pagination import decode_cursor, encode_cursor
+
+# Replaced from the app config by init_app
+RETENTION_DAYS = 30
+SETTLE_SECONDS = 2.0
+
+
+# The log rows after a token in (at, key) order. The planner won't use an
+# index for an OR, so the rows tied with the token and the ones after it
+# are read separately, each through change_log_user_at.
+CHANGES_SINCE = """
+    RETURN array::slice(array::concat(
+        (SELECT record, key, action, at FROM change_log WHERE user = $user_id AND at = $at AND key > $key ORDER BY key LIMIT $limit),
+        (SELECT record, key, action, at FROM change_log WHERE user = $user_id AND at > $at ORDER BY at, key LIMIT $limit)
+    ), 0, $limit);
+"""
+
+
+class TokenExpired(Exception):
+    pass
+
+
+def init_app(app):
+    global RETENTION_DAYS, SETTLE_SECONDS
+    app.config.setdefault("SYNC_RETENTION_DAYS", int(os.getenv("SYNC_RETENTION_DAYS", 30)))
+    app.config.setdefault("SYNC_SETTLE_SECONDS", float(os.getenv("SYNC_SETTLE_SECONDS", 2)))
+    RETENTION_DAYS = app.config["SYNC_RETENTION_DAYS"]
+    SETTLE_SECONDS = app.config["SYNC_SETTLE_SECONDS"]
+
+
+def _record(value):
+    return RecordID.parse(value) if isinstance(value, str) else value
+
+
+def record(db, user_ids, upserts=(), deletes=()):
+    # Notes that each of user_ids saw the records in upserts change and the
+    # records in deletes go away
+    changes = [(record_id, "upsert") for record_id in upserts] + [(record_id, "delete") for record_id in deletes]
+    record_many(db, [
+        (user, record_id, action)
+        for user in {str(user_id) for user_id in user_ids}
+        for record_id, action in changes
+    ])
+
+
+def record_many(db, entries):
+    # One write for a list of (user id, record id, "upsert" or "delete")
+    if not entries:
+        return
+    now = datetime.now(timezone.utc)
+    db.query(
+        """
+        INSERT INTO change_log $rows
+        ON DUPLICATE KEY UPDATE action = $input.action, at = $input.at
+        RETURN NONE;
+        """,
+        {"rows": [
+            {
+                "id": [str(user_id), str(record_id)],
+                "user": _record(str(user_id)),
+                "record": _record(record_id),
+                "key": str(record_id),
+                "action": action,
+                "at": now,
+            }
+            for user_id, record_id, action in entries
+        ]}
+    )
+
+
+def encode_token(at, key=""):
+    return encode_cursor(at.isoformat(), key)
+
+
+def decode_token(token):
+    # Raises ValueError for a token we didn't hand out
+    at, key = decode_cursor(token, 2)
+    try:
+        return datetime.fromisoformat(at), key
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid sync token") from e
+
+
+def snapshot(db, user_id):
+    # Every record user_id can currently see, for a first or full sync
+    settled = datetime.now(timezone.utc) - timedelta(seconds=SETTLE_SECONDS)
+    edges = db.query("SELECT * FROM has_access_to WHERE in = $user_id", {"user_id": _record(user_id)})
+    events = db.query("SELECT * FROM $ids", {"ids": [edge["out"] for edge in edges]}) if edges else []
+    # Event labels made before owners were stored as records hold a string
+    event_labels = db.query(
+        "SELECT * FROM event_label WHERE owner = $user_record OR owner = $user_id",
+        {"user_id": user_id, "user_record": _record(user_id)}
+    )
+    relationship_labels = db.query(
+        "SELECT * FROM relationship_label WHERE owner = $user_id",
+        {"user_id": _record(user_id)}
+    )
+
+    changes = [
+        {"table": table, "id": item["id"], "action": "upsert", "record": item}
+        for table, items in (
+            ("calendar_event", events),
+            ("has_access_to", edges),
+            ("event_label", event_labels),
+            ("relationship_label", relationship_labels),
+        )
+        for item in items
+    ]
+    return changes, encode_token(settled)
+
+
+def changes_since(db, user_id, token, limit):
+    # (changes, next token, has_more) for the log rows after token
+    at, key = decode_token(token)
+    horizon = db.query("SELECT VALUE horizon FROM ONLY sync_meta:compaction")
+    if horizon and at < horizon:
+        raise TokenExpired()
+
+    rows = db.query(CHANGES_SINCE, {"user_id": _record(user_id), "at": at, "key": key, "limit": limit + 1})
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # Upserts carry the record as it is now, or become tombstones if it's gone
+    upserted = [row["record"] for row in rows if row["action"] == "upsert"]
+    current = {}
+    if upserted:
+        current = {str(item["id"]): item for item in db.query("SELECT * FROM $ids", {"ids": upserted})}
+
+    changes = []
+    for row in rows:
+        item = current.get(row["key"]) if row["action"] == "upsert" else None
+        change = {"table": row["record"].table_name, "id": row["record"], "action": "upsert" if item else "delete"}
+        if item:
+            change["record"] = item
+        changes.append(change)
+
+    if not rows:
+        return changes, token, False
+    settled = datetime.now(timezone.utc) - timedelta(seconds=SETTLE_SECONDS)
+    if rows[-1]["at"] > settled:
+        # Send the unsettled tail again next time rather than risk a gap
+        return changes, encode_token(max(settled, at)), has_more
+    return changes, encode_token(rows[-1]["at"], rows[-1]["key"]), has_more
+
+
+def compact(db, retention_days=None, delete_batches=None):
+    # Moves the horizon tokens must be newer than and purges rows older than
+    # the retention, in one statement or through the job scheduler's
+    # delete_batches. The horizon moves first so a sync that races the
+    # purge is told to resync rather than miss a row. Returns the number of
+    # rows removed.
+    horizon = datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS if retention_days is None else retention_days)
+    db.query("UPSERT sync_meta:compaction SET horizon = $horizon", {"horizon": horizon})
+    if delete_batches is not None:
+        return delete_batches(db, "SELECT VALUE id FROM change_log WHERE at < $horizon LIMIT $limit", {"horizon": horizon})
+    removed = db.query("DELETE change_log WHERE at < $horizon RETURN BEFORE", {"horizon": horizon})
+    return len(removed or [])
+
+
+if __name__ == "__main__":
+    # python changelog.py compact [retention_days]
+    from extensions import sdb
+
+    if len(sys.argv) < 2 or sys.argv[1] != "compact":
+        sys.exit("usage: python changelog.py compact [retention_days]")
+
+    sdb.start()
+    with sdb.connection() as db:
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else int(os.getenv("SYNC_RETENTION_DAYS", RETENTION_DAYS))
+        print(f"Removed {compact(db, days)} change log rows")
@@ -0,0 +1,311 @@
+# Double-booking checks against a per-user interval index, cached in process
+#
+# For each user the cache holds the busy events they own: single events in
+# an interval tree and recurring series as stored, since a user has few
+# series and their occurrences are expanded only inside the window asked
+# about. The tree is the start-sorted intervals with each implicit subtree's
+# largest end, so "which events overlap [start, end)" walks O(log n + k)
+# nodes instead of every event. The DB is the source of truth: entries load
+# with one indexed query, are kept in an LRU with a TTL like the social
+# graph cache, and are updated by apply() after every event write. Writes
+# land in a small side list and tombstone set that queries also consult;
+# the tree is rebuilt once CONFLICTS_REBUILD_AFTER of them have piled up,
+# so a run of creates doesn't rebuild it every time.
+#
+# Each entry remembers the user's events revision (see revisions.py) it
+# was loaded at, and is only trusted while that is still the revision in
+# the DB, so a write made through another worker process is seen on the
+# next check rather than when the TTL runs out. apply() moves an entry on
+# to the revision of the write it applies when it was current just before.
+#
+# A check and the write after it aren't atomic, so two concurrent creates
+# can still double-book; reject is a guard for interactive use, not a
+# constraint.
+
+import collections
+import os
+import threading
+import time
+from datetime import timedelta
+
+from recurrence import comparable, expand, parse_datetime
+
+POLICIES = ("ignore", "warn", "reject")
+# The fields of each events.owned_intervals row
+FIELDS = ("id", "title", "start_time", "end_time", "recurrence", "recurrence_end")
+
+
+class IntervalTree:
+    # Static tree over (start, end, item) with start < end
+
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals, key=lambda interval: (interval[0], interval[1]))
+        self.max_end = [None] * len(self.intervals)
+        self._build(0, len(self.intervals))
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def _build(self, lo, hi):
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        end = self.intervals[mid][1]
+        for child in (self._build(lo, mid), self._build(mid + 1, hi)):
+            if child is not None and child > end:
+                end = child
+        self.max_end[mid] = end
+        return end
+
+    def overlapping(self, start, end):
+        # (start, end, item) for every interval overlapping [start, end), in
+        # start order. A subtree is skipped when nothing in it ends after
+        # start; the right one also when its root starts at or after end.
+        found = []
+        stack = [(0, len(self.intervals))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if self.max_end[mid] <= start:
+                continue
+            interval = self.intervals[mid]
+            stack.append((lo, mid))
+            if interval[0] < end:
+                if interval[1] > start:
+                    found.append(interval)
+                stack.append((mid + 1, hi))
+        found.sort(key=lambda interval: (interval[0], interval[1]))
+        return found
+
+
+def _interval(event):
+    item = {field: event.get(field) for field in ("id", "title", "start_time", "end_time")}
+    item["id"] = str(item["id"])
+    return comparable(parse_datetime(event["start_time"])), comparable(parse_datetime(event["end_time"])), item
+
+
+def _occurrence_interval(occurrence):
+    start, end, item = _interval({**occurrence, "id": occurrence.get("occurrence_of")})
+    item["recurrence_id"] = occurrence["recurrence_id"]
+    return start, end, item
+
+
+class Calendar:
+    __slots__ = ("events", "series", "tree", "added", "removed", "expires", "rev")
+
+    def __init__(self, rows, expires, rev):
+        # event id -> interval for single events
+        self.events = {}
+        # event id -> stored event for recurring series
+        self.series = {}
+        for row in rows:
+            # An edge whose event is gone has no id
+            if row[0] is not None:
+                self.set(str(row[0]), dict(zip(FIELDS, row)))
+        self.tree = IntervalTree(self.events.values())
+        # Changes since the tree was built: intervals to add, ids to drop
+        self.added = {}
+        self.removed = set()
+        self.expires = expires
+        self.rev = rev
+
+    def set(self, event_id, event):
+        # event is None or not busy when it is gone from the calendar
+        self.events.pop(event_id, None)
+        self.series.pop(event_id, None)
+        if event is None or event.get("busy") is False:
+            return None
+        if event.get("recurrence"):
+            self.series[event_id] = event
+            return None
+        interval = self.events[event_id] = _interval(event)
+        return interval
+
+    def change(self, event_id, event):
+        interval = self.set(event_id, event)
+        self.removed.add(event_id)
+        self.added.pop(event_id, None)
+        if interval is not None:
+            self.added[event_id] = interval
+
+    def rebuild(self):
+        self.tree = IntervalTree(self.events.values())
+        self.added.clear()
+        self.removed.clear()
+
+    def overlapping(self, start, end):
+        # Single events first, from the tree and the side list
+        found = [interval for interval in self.tree.overlapping(start, end) if interval[2]["id"] not in self.removed]
+        found.extend(interval for interval in self.added.values() if interval[0] < end and interval[1] > start)
+        return found
+
+
+class ConflictIndex:
+    def __init__(self, queries):
+        self.queries = queries
+        self.max_size = 10000
+        self.ttl = 60.0
+        self.rebuild_after = 64
+        self.horizon = timedelta(days=366)
+        self.max_occurrences = 1000
+
+        self._lock = threading.Lock()
+        # user id -> Calendar
+        self._entries = collections.OrderedDict()
+        # Bumped by every write, so a load that raced one isn't cached
+        self._version = 0
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "checks": 0,
+            "conflicts": 0,
+            "rebuilds": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("CONFLICT_POLICY", os.getenv("CONFLICT_POLICY", "ignore"))
+        app.config.setdefault("CONFLICTS_CACHE_SIZE", 10000)
+        app.config.setdefault("CONFLICTS_TTL", 60.0)
+        app.config.setdefault("CONFLICTS_REBUILD_AFTER", 64)
+        app.config.setdefault("CONFLICTS_HORIZON_DAYS", 366)
+        app.config.setdefault("CONFLICTS_MAX_OCCURRENCES", 1000)
+        if app.config["CONFLICT_POLICY"] not in POLICIES:
+            raise ValueError(f"CONFLICT_POLICY must be one of {', '.join(POLICIES)}")
+        self.max_size = app.config["CONFLICTS_CACHE_SIZE"]
+        self.ttl = app.config["CONFLICTS_TTL"]
+        self.rebuild_after = app.config["CONFLICTS_REBUILD_AFTER"]
+        self.horizon = timedelta(days=app.config["CONFLICTS_HORIZON_DAYS"])
+        self.max_occurrences = app.config["CONFLICTS_MAX_OCCURRENCES"]
+        app.extensions["conflicts"] = self
+
+    def overlapping(self, db, user_id, start, end, exclude=None):
+        # user_id's busy events and occurrences overlapping [start, end) as
+        # {id, title, start_time, end_time[, recurrence_id]} in start order,
+        # leaving out the event exclude
+        start, end = comparable(parse_datetime(start)), comparable(parse_datetime(end))
+        entry = self._entry(db, user_id)
+        with self._lock:
+            found = entry.overlapping(start, end)
+            series = list(entry.series.values())
+        found.extend(self._series_within(series, start, end))
+        exclude = str(exclude) if exclude is not None else None
+        found.sort(key=lambda interval: (interval[0], interval[1], interval[2]["id"]))
+        return [item for _, _, item in found if item["id"] != exclude]
+
+    def check(self, db, user_id, event, exclude=None):
+        # The events event would overlap on user_id's calendar. A recurring
+        # event is checked occurrence by occurrence up to the end of the
+        # series or CONFLICTS_HORIZON_DAYS, at most
+        # CONFLICTS_MAX_OCCURRENCES of them.
+        if event.get("busy") is False:
+            return []
+        start = comparable(parse_datetime(event["start_time"]))
+        if event.get("recurrence"):
+            until = start + self.horizon
+            if event.get("recurrence_end"):
+                until = min(until, comparable(parse_datetime(event["recurrence_end"])))
+            wanted = []
+            for occurrence in expand(event, start, until):
+                wanted.append(_occurrence_interval(occurrence)[:2])
+                if len(wanted) >= self.max_occurrences:
+                    break
+        else:
+            wanted = [_interval(event)[:2]]
+        if not wanted:
+            return []
+
+        entry = self._entry(db, user_id)
+        exclude = str(exclude) if exclude is not None else None
+        window_start = min(start for start, _ in wanted)
+        window_end = max(end for _, end in wanted)
+        with self._lock:
+            series = [event for event_id, event in entry.series.items() if event_id != exclude]
+            singles = [entry.overlapping(start, end) for start, end in wanted]
+        # Series occurrences inside the whole window get a tree of their own,
+        # so each of the event's occurrences is one lookup
+        occurrences = IntervalTree(self._series_within(series, window_start, window_end))
+
+        seen, conflicts = set(), []
+        for (start, end), found in zip(wanted, singles):
+            for _, _, item in found + occurrences.overlapping(start, end):
+                key = (item["id"], item.get("recurrence_id"))
+                if item["id"] != exclude and key not in seen:
+                    seen.add(key)
+                    conflicts.append(item)
+        conflicts.sort(key=lambda item: (comparable(parse_datetime(item["start_time"])), item["id"]))
+
+        with self._lock:
+            self._counters["checks"] += 1
+            self._counters["conflicts"] += bool(conflicts)
+        return conflicts
+
+    def apply(self, user_id, event_id, event, rev):
+        # Records event_id as event (None once it is deleted) on user_id's
+        # calendar if it is cached. rev is the events revision the write
+        # bumped user_id to; an entry that missed a revision before it is
+        # dropped instead.
+        user_id, event_id = str(user_id), str(event_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and (rev is None or entry.rev != rev - 1):
+                self._entries.pop(user_id)
+            elif entry is not None:
+                entry.change(event_id, event)
+                entry.rev = rev
+                if len(entry.added) + len(entry.removed) > self.rebuild_after:
+                    entry.rebuild()
+                    self._counters["rebuilds"] += 1
+            self._version += 1
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(str(user_id), None)
+            self._version += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._entries)
+        return stats
+
+    def _series_within(self, series, start, end):
+        # Occurrences of the series overlapping [start, end)
+        occurrences = []
+        for event in series:
+            if comparable(parse_datetime(event["start_time"])) >= end:
+                continue
+            if event.get("recurrence_end") and comparable(parse_datetime(event["recurrence_end"])) <= start:
+                continue
+            occurrences.extend(_occurrence_interval(occurrence) for occurrence in expand(event, start, end))
+        return occurrences
+
+    def _entry(self, db, user_id):
+        # revisions reads extensions, which builds this module's singleton
+        import revisions
+
+        user_id = str(user_id)
+        now = time.monotonic()
+        # Read before the events, so a write between the two makes the
+        # entry look older than it is rather than newer
+        rev = revisions.current(db, user_id, "events")[0]
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.expires > now and entry.rev == rev:
+                self._entries.move_to_end(user_id)
+                self._counters["hits"] += 1
+                return entry
+            self._counters["misses"] += 1
+            version = self._version
+
+        entry = Calendar(self.queries.run(db, "events.owned_intervals", {"user_id": user_id}), now + self.ttl, rev)
+        with self._lock:
+            if version != self._version:
+                return entry
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
@@ -1,3 +1,32 @@
-from surreal import SurrealInstance
+from conflicts import ConflictIndex
+from fanout import Fanout
+from jobs import JobScheduler
+from live import ChangeFeed
+from passwords import PasswordHasher
+from permissions import PermissionResolver
+from profiling import Profiler
+from queries import QueryRepository
+from ratelimit import RateLimiter
+from surreal import AsyncSurrealInstance, SurrealInstance
+from revocation import RevocationCache
+from social_graph import SocialGraph
+from suggestions import SuggestionEngine
+from tracing import Tracer
+from webhooks import WebhookDispatcher
 
-sdb = SurrealInstance()
\ No newline at end of file
+sdb = SurrealInstance()
+adb = AsyncSurrealInstance()
+revoked_tokens = RevocationCache(sdb)
+permissions = PermissionResolver(sdb)
+passwords = PasswordHasher()
+queries = QueryRepository(sdb)
+rate_limiter = RateLimiter(sdb)
+social_graph = SocialGraph(queries)
+suggestions = SuggestionEngine(social_graph)
+conflicts = ConflictIndex(queries)
+webhooks = WebhookDispatcher(sdb)
+fanout = Fanout(sdb, permissions, webhooks)
+jobs = JobScheduler(sdb)
+change_feed = ChangeFeed(sdb, adb)
+tracer = Tracer()
+profiler = Profiler()
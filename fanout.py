@@ -0,0 +1,386 @@
+# Label-group sharing, materialized into has_access_to edges
+#
+# An owner grants one of their relationship_labels access to one of their
+# event_labels with a label_grant. Every event the owner has applied the
+# event label to is then shared with everyone the owner has tagged with the
+# relationship label, at the grant's permission. The access is written into
+# the has_access_to edges themselves, so checking it stays a single edge
+# lookup however large the group is.
+#
+# On an edge the event label's id sits in because_of once, and label_refs
+# holds it once per grant that leads there, so the reasons are reference
+# counted: losing one of two groups only drops a reference, the reason goes
+# with the last one and the edge with its last reason. Direct and group
+# shares on the same edge are never touched. Each event label reason's
+# permission, the highest of the grants behind it, is kept in
+# reason_permissions like the other reasons' (see sharing.py), and the
+# edge's permission is recomputed from them on every change.
+#
+# Writes that change who should see what only queue a row in fanout_job,
+# keyed by what it reconciles: an event, an owner's tags on one member, or
+# every event under a label. Repeated writes collapse into the one pending
+# job. A worker thread claims jobs with a lease, recomputes the references
+# from the current labels, grants and tags and applies the difference in one
+# transaction per job, so a job is safe to run twice or out of order.
+
+import logging
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from surrealdb import RecordID
+
+import changelog
+from permissions import PERMISSION_RANK, strongest
+from sharing import reason_permissions
+
+logger = logging.getLogger(__name__)
+
+LABEL_TABLE = "event_label"
+
+
+def _record(value):
+    return RecordID.parse(value) if isinstance(value, str) else value
+
+
+def _is_label(reason):
+    return reason.startswith(LABEL_TABLE + ":")
+
+
+def _because_of(edge):
+    because_of = edge.get("because_of") or []
+    return [because_of] if isinstance(because_of, str) else [str(reason) for reason in because_of]
+
+
+class Fanout:
+    def __init__(self, sdb, permissions, webhooks):
+        self.sdb = sdb
+        self.permissions = permissions
+        self.webhooks = webhooks
+        self.batch_size = 20
+        self.poll_interval = 5.0
+
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = {
+            "enqueued": 0,
+            "processed": 0,
+            "failed": 0,
+            "edges_created": 0,
+            "edges_updated": 0,
+            "edges_deleted": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("FANOUT_WORKER", True)
+        app.config.setdefault("FANOUT_BATCH", 20)
+        app.config.setdefault("FANOUT_POLL_INTERVAL", 5.0)
+        self.batch_size = app.config["FANOUT_BATCH"]
+        self.poll_interval = app.config["FANOUT_POLL_INTERVAL"]
+        app.extensions["fanout"] = self
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="fanout", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def enqueue_events(self, db, event_ids):
+        # The events' audiences are recomputed from their labels
+        self._enqueue(db, [("event", str(event_id)) for event_id in event_ids])
+
+    def enqueue_label(self, db, owner_id, label_id):
+        # Every event owner_id has labelled with label_id is recomputed
+        self._enqueue(db, [("label", str(owner_id), str(label_id))])
+
+    def enqueue_members(self, db, owner_id, member_ids):
+        # What owner_id's tags on each member give them is recomputed
+        self._enqueue(db, [("member", str(owner_id), str(member_id)) for member_id in member_ids])
+
+    def run_pending(self, limit=None):
+        # Claims and runs up to limit due jobs in this thread, returning how
+        # many ran
+        with self.sdb.connection() as db:
+            jobs = db.query(
+                """
+                SELECT id, queued_at FROM fanout_job
+                WHERE status = 'pending' OR (status = 'running' AND lease_until < time::now())
+                ORDER BY queued_at
+                LIMIT $limit;
+                """,
+                {"limit": limit or self.batch_size}
+            )
+            if not jobs:
+                return 0
+            jobs = db.query(
+                """
+                UPDATE $ids SET status = 'running', lease_until = time::now() + 1m
+                WHERE status = 'pending' OR (status = 'running' AND lease_until < time::now())
+                RETURN AFTER;
+                """,
+                {"ids": [job["id"] for job in jobs]}
+            )
+
+            for job in jobs:
+                try:
+                    self.reconcile(db, *job["id"].id)
+                except Exception:
+                    # Left running, so it's picked up again once the lease runs out
+                    logger.exception("Fan-out job %s failed", job["id"].id)
+                    self._count("failed")
+                    continue
+                # A job queued again while this one ran stays pending
+                db.query("DELETE $id WHERE queued_at = $queued_at", {"id": job["id"], "queued_at": job["queued_at"]})
+                self._count("processed")
+        return len(jobs)
+
+    def sweep(self, db):
+        # Queues every granted label again, which repairs any drift between
+        # the grants and the edges; run by the fanout_sweep job
+        grants = db.query("SELECT owner, event_label FROM label_grant")
+        labels = {(str(grant["owner"]), str(grant["event_label"])) for grant in grants}
+        self._enqueue(db, [("label", owner_id, label_id) for owner_id, label_id in labels])
+        return {"queued": len(labels)}
+
+    def reconcile(self, db, kind, *args):
+        if kind == "event":
+            self._reconcile_event(db, *args)
+        elif kind == "member":
+            self._reconcile_member(db, *args)
+        elif kind == "label":
+            events = db.query(
+                "SELECT VALUE out FROM has_access_to WHERE labels CONTAINS $label AND in = $owner AND permission = 'owner'",
+                {"label": _record(args[1]), "owner": _record(args[0])}
+            )
+            self.enqueue_events(db, events)
+        else:
+            raise ValueError(f"Unknown fan-out job: {kind}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _enqueue(self, db, keys):
+        if not keys:
+            return
+        now = datetime.now(timezone.utc)
+        db.query(
+            """
+            INSERT INTO fanout_job $jobs
+            ON DUPLICATE KEY UPDATE status = 'pending', queued_at = $input.queued_at
+            RETURN NONE;
+            """,
+            {"jobs": [{"id": list(key), "status": "pending", "queued_at": now} for key in keys]}
+        )
+        self._count("enqueued", len(keys))
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                ran = self.run_pending()
+            except Exception:
+                logger.exception("Failed to claim fan-out jobs")
+                ran = 0
+            if not ran:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def _grants(self, db, owner_id):
+        # [(event label, relationship label, permission)] for owner_id
+        grants = db.query(
+            "SELECT event_label, relationship_label, permission FROM label_grant WHERE owner = $owner",
+            {"owner": _record(owner_id)}
+        )
+        return [(str(grant["event_label"]), str(grant["relationship_label"]), grant["permission"]) for grant in grants]
+
+    def _wanted(self, grants, event_labels, member_labels):
+        # (label_refs, {event label: permission}) that grants give someone
+        # tagged with member_labels on an event labelled with event_labels
+        refs, permissions = [], {}
+        for event_label, relationship_label, grant_permission in grants:
+            if event_label in event_labels and relationship_label in member_labels:
+                refs.append(event_label)
+                if PERMISSION_RANK[grant_permission] > PERMISSION_RANK.get(permissions.get(event_label), 0):
+                    permissions[event_label] = grant_permission
+        return sorted(refs), permissions
+
+    def _reconcile_event(self, db, event_id):
+        owners = db.query(
+            "SELECT in, labels FROM has_access_to WHERE out = $event_id AND permission = 'owner' LIMIT 1",
+            {"event_id": _record(event_id)}
+        )
+        edges = db.query("SELECT * FROM has_access_to WHERE out = $event_id", {"event_id": _record(event_id)})
+        wanted = {}
+        if owners:
+            owner_id = str(owners[0]["in"])
+            event_labels = {str(label) for label in owners[0].get("labels") or []}
+            grants = [grant for grant in self._grants(db, owner_id) if grant[0] in event_labels]
+            groups = {grant[1] for grant in grants}
+            tags = {}
+            if groups:
+                relationships = db.query(
+                    """
+                    SELECT out, labels FROM relationship_with
+                    WHERE in = $owner AND labels CONTAINSANY $labels AND type != 'blocked';
+                    """,
+                    {"owner": _record(owner_id), "labels": [_record(label) for label in groups]}
+                )
+                tags = {str(relationship["out"]): {str(label) for label in relationship["labels"]} for relationship in relationships}
+            for member_id, member_labels in tags.items():
+                if member_id != owner_id:
+                    wanted[member_id] = self._wanted(grants, event_labels, member_labels)
+
+        current = {str(edge["in"]): edge for edge in edges}
+        # Users who hold label references but aren't wanted any more lose them
+        for user_id, edge in current.items():
+            if user_id not in wanted and any(_is_label(reason) for reason in _because_of(edge)):
+                wanted[user_id] = ([], {})
+        self._apply(db, [(user_id, event_id, current.get(user_id), refs, permissions) for user_id, (refs, permissions) in wanted.items()])
+
+    def _reconcile_member(self, db, owner_id, member_id):
+        relationships = db.query(
+            "SELECT labels, type FROM relationship_with WHERE in = $owner AND out = $member",
+            {"owner": _record(owner_id), "member": _record(member_id)}
+        )
+        member_labels = set()
+        if relationships and relationships[0]["type"] != "blocked":
+            member_labels = {str(label) for label in relationships[0].get("labels") or []}
+        grants = [grant for grant in self._grants(db, owner_id) if grant[1] in member_labels]
+
+        # The owner's events the member should reach, and the ones they
+        # hold references to any of the owner's event labels on now
+        events = {}
+        granted = sorted({grant[0] for grant in grants})
+        if granted:
+            for edge in db.query(
+                "SELECT out, labels FROM has_access_to WHERE labels CONTAINSANY $labels AND in = $owner AND permission = 'owner'",
+                {"labels": [_record(label) for label in granted], "owner": _record(owner_id)}
+            ):
+                events[str(edge["out"])] = {str(label) for label in edge["labels"]}
+        owned = db.query(
+            "SELECT VALUE <string> id FROM event_label WHERE owner = $owner OR owner = <string> $owner",
+            {"owner": _record(owner_id)}
+        )
+        held = {}
+        if owned:
+            edges = db.query(
+                "SELECT * FROM (SELECT * FROM has_access_to WHERE in = $member) WHERE because_of CONTAINSANY $labels",
+                {"member": _record(member_id), "labels": owned}
+            )
+            held = {str(edge["out"]): edge for edge in edges}
+        if events:
+            edges = db.query(
+                "SELECT * FROM (SELECT * FROM has_access_to WHERE out IN $events) WHERE in = $member",
+                {"events": [_record(event_id) for event_id in events if event_id not in held], "member": _record(member_id)}
+            )
+            held.update({str(edge["out"]): edge for edge in edges})
+
+        changes = []
+        for event_id in set(events) | set(held):
+            refs, permissions = self._wanted(grants, events.get(event_id, ()), member_labels)
+            changes.append((member_id, event_id, held.get(event_id), refs, permissions))
+        self._apply(db, changes)
+
+    def _apply(self, db, changes):
+        # changes is [(user id, event id, current edge or None, label_refs,
+        # {event label: permission})]; writes every difference in one
+        # transaction
+        inserts, updates, deletes = [], [], []
+        results = {}
+        for user_id, event_id, edge, refs, label_permissions in changes:
+            if edge is None:
+                if refs:
+                    link = RecordID("has_access_to", uuid.uuid4().hex)
+                    inserts.append({
+                        "id": link,
+                        "in": _record(user_id),
+                        "out": _record(event_id),
+                        "permission": strongest(label_permissions.values()),
+                        "because_of": sorted(label_permissions),
+                        "reason_permissions": label_permissions,
+                        "label_refs": refs,
+                        "labels": [],
+                    })
+                    results.setdefault(event_id, []).append((user_id, link, "created"))
+                continue
+            if edge["permission"] == "owner":
+                continue
+
+            granted = {reason: permission for reason, permission in reason_permissions(edge).items() if not _is_label(reason)}
+            granted.update(label_permissions)
+            because_of = sorted(granted)
+            if not because_of:
+                deletes.append(edge["id"])
+                results.setdefault(event_id, []).append((user_id, edge["id"], "deleted"))
+                continue
+            permission = strongest(granted.values())
+            if (because_of == edge.get("because_of") and refs == sorted(edge.get("label_refs") or [])
+                    and permission == edge["permission"] and granted == edge.get("reason_permissions")):
+                continue
+            updates.append({"id": edge["id"], "permission": permission, "because_of": because_of, "reason_permissions": granted, "label_refs": refs})
+            results.setdefault(event_id, []).append((user_id, edge["id"], "updated"))
+
+        if not results:
+            return
+        db.query(
+            """
+            BEGIN TRANSACTION;
+            INSERT RELATION INTO has_access_to $inserts RETURN NONE;
+            FOR $update IN $updates {
+                UPDATE $update.id SET
+                    permission = $update.permission, because_of = $update.because_of,
+                    reason_permissions = $update.reason_permissions, label_refs = $update.label_refs
+                RETURN NONE;
+            };
+            DELETE $deletes;
+            COMMIT TRANSACTION;
+            """,
+            {"inserts": inserts, "updates": updates, "deletes": deletes}
+        )
+        self._count("edges_created", len(inserts))
+        self._count("edges_updated", len(updates))
+        self._count("edges_deleted", len(deletes))
+
+        for event_id, changed in results.items():
+            self.notify(db, event_id, changed)
+
+    def notify(self, db, event_id, changed):
+        # What share_event and unshare_event do after their writes, for
+        # changed as [(user id, edge id, "created", "updated" or "deleted")]
+        # revisions reads extensions, which builds this module's singleton
+        import revisions
+
+        user_ids = [user_id for user_id, _, _ in changed]
+        self.permissions.invalidate(user_ids, event_id)
+        revisions.bump(db, user_ids, "events")
+        entries = []
+        for user_id, link, action in changed:
+            if action == "deleted":
+                entries += [(user_id, event_id, "delete"), (user_id, link, "delete")]
+            elif action == "created":
+                entries += [(user_id, event_id, "upsert"), (user_id, link, "upsert")]
+            else:
+                entries.append((user_id, link, "upsert"))
+        changelog.record_many(db, entries)
+
+        shared = [user_id for user_id, _, action in changed if action != "deleted"]
+        unshared = [user_id for user_id, _, action in changed if action == "deleted"]
+        if shared:
+            self.webhooks.emit(db, "event.shared", shared, {"event": event_id, "users": shared})
+        if unshared:
+            self.webhooks.emit(db, "event.unshared", unshared, {"event": event_id, "users": unshared})
@@ -0,0 +1,76 @@
+# Gunicorn settings and worker hooks for serve:app
+#
+# The master imports the app once (preload_app) and forks workers, so the
+# imports and route table are shared copy-on-write. Nothing touches the
+# network until a worker has forked: each worker opens its own connection
+# pool, loads the revocation filter and starts its background threads in
+# post_fork, and only then reports ready on /health/ready.
+#
+# kill -HUP <master> reloads gracefully: new workers start and the old ones
+# finish their in-flight requests (up to GRACEFUL_TIMEOUT) before exiting.
+# A worker that is told to stop starts failing readiness first so a load
+# balancer stops routing to it while it drains.
+#
+# Gunicorn runs this file as a module of its own, apart from the serve
+# module it imports the app from, so the hooks import serve.app rather
+# than building an app here.
+
+import logging
+import multiprocessing
+import os
+import signal
+
+logger = logging.getLogger(__name__)
+
+SERVER_MODE = os.getenv("SERVER_MODE", "wsgi")
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# Each worker caches revoked tokens on its own: a logout handled by one
+# worker reaches the others within REVOCATION_SYNC_INTERVAL seconds (see
+# revocation.py)
+workers = int(os.getenv("WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("THREADS", 8))
+worker_class = "uvicorn.workers.UvicornWorker" if SERVER_MODE == "asgi" else "gthread"
+preload_app = True
+timeout = int(os.getenv("WORKER_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("KEEPALIVE", 5))
+# Recycle workers now and then so slow leaks can't build up; the jitter
+# keeps them from all restarting at once
+max_requests = int(os.getenv("MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", 1000))
+
+
+def post_fork(server, worker):
+    if SERVER_MODE == "asgi":
+        return
+    from main import start_services
+    from serve import app
+    start_services(app)
+    logger.info("Worker %s started services", worker.pid)
+
+
+def post_worker_init(worker):
+    # Fail readiness as soon as a shutdown signal arrives, then hand over to
+    # gunicorn's own handler. Uvicorn workers install their own handlers
+    # later and drain in the lifespan shutdown instead.
+    if SERVER_MODE == "asgi":
+        return
+    from serve import app
+    for signum in (signal.SIGTERM, signal.SIGQUIT, signal.SIGINT):
+        handler = signal.getsignal(signum)
+
+        def drain(signum, frame, handler=handler):
+            app.extensions["health"]["draining"] = True
+            if callable(handler):
+                handler(signum, frame)
+
+        signal.signal(signum, drain)
+
+
+def worker_exit(server, worker):
+    if SERVER_MODE == "asgi":
+        return
+    from main import stop_services
+    from serve import app
+    stop_services(app)
@@ -0,0 +1,131 @@
+# Streaming iCalendar (RFC 5545) reading and writing for event import/export
+#
+# Only VEVENT components are read. Properties map onto calendar_event fields:
+# SUMMARY -> title, DTSTART -> start_time, DTEND -> end_time, DESCRIPTION,
+# LOCATION, UID -> uid, RRULE and EXDATE -> recurrence.
+
+from datetime import datetime, timezone
+
+from recurrence import parse_datetime
+
+FIELDS = {
+    "SUMMARY": "title",
+    "DESCRIPTION": "description",
+    "LOCATION": "location",
+    "UID": "uid",
+}
+
+
+def _unfold(lines):
+    # Joins folded continuation lines, yielding (line_number, line)
+    current, current_number = None, 0
+    for number, line in enumerate(lines, start=1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current_number, current
+        current, current_number = line, number
+    if current:
+        yield current_number, current
+
+
+def _unescape(value):
+    return (value.replace("\\n", "\n").replace("\\N", "\n")
+            .replace("\\,", ",").replace("\\;", ";").replace("\\\\", "\\"))
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\n", "\\n"))
+
+
+def _parse_value_datetime(value, params):
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        return datetime.strptime(value, "%Y%m%d").isoformat()
+    if value.endswith("Z"):
+        return datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc).isoformat()
+    return datetime.strptime(value, "%Y%m%dT%H%M%S").isoformat()
+
+
+def _format_value_datetime(value):
+    dt = parse_datetime(value)
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    return dt.strftime("%Y%m%dT%H%M%S")
+
+
+def _split(line):
+    name_and_params, _, value = line.partition(":")
+    name, *raw_params = name_and_params.split(";")
+    params = {}
+    for param in raw_params:
+        key, _, param_value = param.partition("=")
+        params[key.upper()] = param_value
+    return name.upper(), params, value
+
+
+def parse_events(lines):
+    # Yields (line_number, event_data, error) for each VEVENT in a stream of
+    # text lines without reading the whole calendar into memory
+    event, error, start_line = None, None, 0
+    for number, line in _unfold(lines):
+        if not line:
+            continue
+        name, params, value = _split(line)
+
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            event, error, start_line = {}, None, number
+            continue
+        if event is None:
+            continue
+        if name == "END" and value.upper() == "VEVENT":
+            yield start_line, (None if error else event), error
+            event = None
+            continue
+
+        try:
+            if name in FIELDS:
+                event[FIELDS[name]] = _unescape(value)
+            elif name == "DTSTART":
+                event["start_time"] = _parse_value_datetime(value, params)
+            elif name == "DTEND":
+                event["end_time"] = _parse_value_datetime(value, params)
+            elif name == "RRULE":
+                event.setdefault("recurrence", {})["rrule"] = value
+            elif name == "EXDATE":
+                exdates = event.setdefault("recurrence", {}).setdefault("exdates", [])
+                exdates.extend(_parse_value_datetime(part, params) for part in value.split(","))
+        except ValueError:
+            error = f"Invalid {name} value on line {number}"
+
+    if event is not None:
+        yield start_line, None, "Unterminated VEVENT"
+
+
+def format_calendar(events):
+    # Yields the lines of a VCALENDAR for an iterable of calendar_event records
+    yield "BEGIN:VCALENDAR\r\n"
+    yield "VERSION:2.0\r\n"
+    yield "PRODID:-//CalendarApp-API//EN\r\n"
+    for event in events:
+        yield from format_event(event)
+    yield "END:VCALENDAR\r\n"
+
+
+def format_event(event):
+    yield "BEGIN:VEVENT\r\n"
+    yield f"UID:{_escape(event.get('uid') or event['id'])}\r\n"
+    yield f"DTSTART:{_format_value_datetime(event['start_time'])}\r\n"
+    yield f"DTEND:{_format_value_datetime(event['end_time'])}\r\n"
+    for prop, field in FIELDS.items():
+        if field != "uid" and event.get(field):
+            yield f"{prop}:{_escape(event[field])}\r\n"
+
+    recurrence = event.get("recurrence")
+    if recurrence:
+        yield f"RRULE:{recurrence['rrule']}\r\n"
+        if recurrence.get("exdates"):
+            yield "EXDATE:" + ",".join(_format_value_datetime(exdate) for exdate in recurrence["exdates"]) + "\r\n"
+    yield "END:VEVENT\r\n"
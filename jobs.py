@@ -0,0 +1,334 @@
+# Background maintenance jobs
+#
+# A scheduler thread runs registered jobs on a small thread pool, either
+# every JOB_INTERVALS seconds or straight away when trigger() asks. Jobs
+# that should run once per deployment rather than once per worker are
+# leader_only: a process runs them only while it holds the
+# job_lease:scheduler row, which it renews every tick and another process
+# takes over once it has gone JOBS_LEASE_SECONDS without renewal. When each
+# job last finished is kept in job_state, so a new leader or a restart
+# doesn't reset the schedule.
+#
+# Jobs that remove many rows go through delete_batches(), which deletes
+# JOBS_BATCH_SIZE rows per statement and sleeps JOBS_THROTTLE_MS between
+# statements, so a purge never holds the database for long and stops early
+# when the process shuts down.
+#
+# Each job's runs, failures, last duration and last result are kept for
+# stats() and GET /debug/jobs.
+
+import concurrent.futures
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import changelog
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVALS = "token_purge=3600, orphaned_edges=21600, changelog_compact=86400, fanout_sweep=86400"
+
+
+def parse_intervals(text):
+    # "name=seconds, name=seconds" from the environment; 0 runs on demand only
+    intervals = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name, _, seconds = item.partition("=")
+        intervals[name.strip()] = float(seconds)
+    return intervals
+
+
+class Job:
+    def __init__(self, name, func, interval, leader_only):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.leader_only = leader_only
+
+        self.running = False
+        self.triggered = False
+        # Wall clock time the job last finished anywhere, from job_state
+        self.last_finished = None
+        self.last_duration = None
+        self.last_result = None
+        self.last_error = None
+        self.runs = 0
+        self.failures = 0
+
+    def due(self, now):
+        if self.triggered:
+            return True
+        if not self.interval:
+            return False
+        return self.last_finished is None or now >= self.last_finished + self.interval
+
+    def status(self):
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "leader_only": self.leader_only,
+            "running": self.running,
+            "last_finished": datetime.fromtimestamp(self.last_finished, timezone.utc).isoformat() if self.last_finished else None,
+            "last_duration": self.last_duration,
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+            "runs": self.runs,
+            "failures": self.failures,
+        }
+
+
+class JobScheduler:
+    def __init__(self, sdb):
+        self.sdb = sdb
+        self.workers = 2
+        self.tick = 1.0
+        self.lease_seconds = 30.0
+        self.batch_size = 500
+        self.throttle = 0.05
+        self.intervals = {}
+        # Identifies this process in the lease row; set by start(), which
+        # a prefork server calls after fork
+        self.holder = None
+
+        self._jobs = {}
+        self._leader = False
+        self._state_loaded = False
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault("JOBS_ENABLED", os.getenv("JOBS_ENABLED", "true").lower() == "true")
+        app.config.setdefault("JOBS_WORKERS", int(os.getenv("JOBS_WORKERS", 2)))
+        app.config.setdefault("JOBS_TICK_SECONDS", float(os.getenv("JOBS_TICK_SECONDS", 1)))
+        app.config.setdefault("JOBS_LEASE_SECONDS", float(os.getenv("JOBS_LEASE_SECONDS", 30)))
+        app.config.setdefault("JOBS_BATCH_SIZE", int(os.getenv("JOBS_BATCH_SIZE", 500)))
+        app.config.setdefault("JOBS_THROTTLE_MS", float(os.getenv("JOBS_THROTTLE_MS", 50)))
+        app.config.setdefault("JOB_INTERVALS", parse_intervals(os.getenv("JOB_INTERVALS", DEFAULT_INTERVALS)))
+
+        self.workers = app.config["JOBS_WORKERS"]
+        self.tick = app.config["JOBS_TICK_SECONDS"]
+        self.lease_seconds = app.config["JOBS_LEASE_SECONDS"]
+        self.batch_size = app.config["JOBS_BATCH_SIZE"]
+        self.throttle = app.config["JOBS_THROTTLE_MS"] / 1000
+        self.intervals = {**parse_intervals(DEFAULT_INTERVALS), **app.config["JOB_INTERVALS"]}
+        app.extensions["jobs"] = self
+
+    def register(self, name, func, leader_only=True):
+        # func(scheduler, db) does one run and returns a JSON-able summary.
+        # Its interval comes from JOB_INTERVALS.
+        with self._lock:
+            self._jobs[name] = Job(name, func, self.intervals.get(name, 0), leader_only)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="job")
+        self._thread = threading.Thread(target=self._run, name="job-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._leader:
+            self._release()
+
+    def stopping(self):
+        return self._stop.is_set()
+
+    def pause(self):
+        # Sleeps between batches; True once the process is stopping
+        return self._stop.wait(self.throttle)
+
+    def trigger(self, name):
+        # Runs name on the next tick, in this process whether or not it
+        # holds the lease. Returns False for an unknown job.
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None:
+                return False
+            job.triggered = True
+        self._wake.set()
+        return True
+
+    def run(self, name):
+        # Runs name in the calling thread and returns its status
+        with self._lock:
+            job = self._jobs[name]
+            job.running = True
+        self._execute(job)
+        return job.status()
+
+    def delete_batches(self, db, select, vars=None):
+        # Deletes the ids select returns, JOBS_BATCH_SIZE ($limit) at a time,
+        # until it returns fewer or the process is stopping. Returns how
+        # many were deleted.
+        removed = 0
+        while True:
+            ids = db.query(select, {**(vars or {}), "limit": self.batch_size})
+            if ids:
+                db.query("DELETE $ids", {"ids": ids})
+                removed += len(ids)
+            if len(ids) < self.batch_size or self.pause():
+                return removed
+
+    def status(self):
+        with self._lock:
+            return {
+                "holder": self.holder,
+                "leader": self._leader,
+                "jobs": [job.status() for job in self._jobs.values()],
+            }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "leader": self._leader,
+                "running": sum(job.running for job in self._jobs.values()),
+                "runs": sum(job.runs for job in self._jobs.values()),
+                "failures": sum(job.failures for job in self._jobs.values()),
+            }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._schedule()
+            except Exception:
+                logger.exception("Job scheduler tick failed")
+            self._wake.wait(self.tick)
+            self._wake.clear()
+
+    def _schedule(self):
+        with self._lock:
+            needs_lease = any(job.leader_only for job in self._jobs.values())
+        if needs_lease:
+            self._renew()
+
+        now = time.time()
+        with self._lock:
+            due = []
+            for job in self._jobs.values():
+                if job.running or not job.due(now):
+                    continue
+                if job.leader_only and not self._leader and not job.triggered:
+                    continue
+                job.running = True
+                job.triggered = False
+                due.append(job)
+        for job in due:
+            self._executor.submit(self._execute, job)
+
+    def _renew(self):
+        # Takes or keeps the lease; the WHERE only lets the holder renew it
+        # or anyone take it once it has run out
+        with self.sdb.connection() as db:
+            held = db.query(
+                """
+                UPSERT job_lease:scheduler
+                SET holder = $holder, expires = time::now() + type::duration($lease)
+                WHERE holder = NONE OR holder = $holder OR expires < time::now();
+                """,
+                {"holder": self.holder, "lease": f"{int(self.lease_seconds * 1000)}ms"}
+            )
+            leader = bool(held)
+            # Picks up where the previous leader left off
+            states = db.query("SELECT * FROM job_state") if leader and not self._state_loaded else []
+        with self._lock:
+            for state in states:
+                job = self._jobs.get(state["id"].id)
+                if job is not None and state.get("finished_at"):
+                    job.last_finished = state["finished_at"].timestamp()
+            if leader != self._leader:
+                logger.info("%s job scheduler lease as %s", "Took" if leader else "Lost", self.holder)
+            self._leader = leader
+            self._state_loaded = leader
+
+    def _release(self):
+        try:
+            with self.sdb.connection() as db:
+                db.query("UPDATE job_lease:scheduler SET expires = time::now() WHERE holder = $holder", {"holder": self.holder})
+        except Exception:
+            logger.exception("Failed to release the job scheduler lease")
+        self._leader = False
+
+    def _execute(self, job):
+        started = time.perf_counter()
+        result, error = None, None
+        try:
+            with self.sdb.connection() as db:
+                result = job.func(self, db)
+                finished = datetime.now(timezone.utc)
+                db.query(
+                    "UPSERT type::thing('job_state', $name) SET finished_at = $finished, result = $result",
+                    {"name": job.name, "finished": finished, "result": result}
+                )
+        except Exception as e:
+            logger.exception("Job %s failed", job.name)
+            error = str(e)
+            finished = datetime.now(timezone.utc)
+
+        with self._lock:
+            job.running = False
+            job.runs += 1
+            job.last_finished = finished.timestamp()
+            job.last_duration = time.perf_counter() - started
+            job.last_result = result
+            job.last_error = error
+            job.failures += error is not None
+        logger.info("Job %s finished in %.2fs: %s", job.name, job.last_duration, error or result)
+
+
+def purge_expired_tokens(scheduler, db):
+    # blocked_token rows only matter until the token would have expired
+    removed = scheduler.delete_batches(
+        db,
+        "SELECT VALUE id FROM blocked_token WHERE expiry < $now LIMIT $limit",
+        {"now": int(time.time())}
+    )
+    return {"removed": removed}
+
+
+def purge_orphaned_edges(scheduler, db, table="has_access_to"):
+    # Walks the table in id order a batch at a time and deletes edges whose
+    # user or event is gone. Each batch starts after the last id seen, a
+    # range read, rather than rescanning the table from the start.
+    removed, scanned, after = 0, 0, None
+    while not scheduler.stopping():
+        source = table if after is None else f"{table}:⟨{after}⟩>.."
+        edges = db.query(
+            f"SELECT id, record::exists(in) AND record::exists(out) AS linked FROM {source} LIMIT $limit",
+            {"limit": scheduler.batch_size}
+        )
+        orphans = [edge["id"] for edge in edges if not edge["linked"]]
+        if orphans:
+            db.query("DELETE $ids", {"ids": orphans})
+            removed += len(orphans)
+        scanned += len(edges)
+        if len(edges) < scheduler.batch_size:
+            break
+        after = edges[-1]["id"].id
+        # Ids are generated, so this only guards the range literal
+        if not isinstance(after, str) or not re.fullmatch(r"\w+", after):
+            raise ValueError(f"Cannot page {table} past id {after!r}")
+        if scheduler.pause():
+            break
+    return {"scanned": scanned, "removed": removed}
+
+
+def compact_changelog(scheduler, db):
+    return {"removed": changelog.compact(db, delete_batches=scheduler.delete_batches)}
@@ -0,0 +1,292 @@
+# Change feed shared by every connected live client
+#
+# One dedicated async SurrealDB connection runs a LIVE SELECT per table in
+# LIVE_TABLES. Notifications are read on a single thread, matched to the
+# users they concern and pushed onto each subscriber's bounded queue, so the
+# number of upstream live queries doesn't grow with the number of clients.
+# A subscriber that falls behind has its backlog dropped and is told to
+# resync instead of slowing everyone else down.
+
+import asyncio
+import collections
+import logging
+import queue
+import threading
+import time
+
+from surrealdb import RecordID
+
+logger = logging.getLogger(__name__)
+
+LIVE_TABLES = ("calendar_event", "has_access_to", "relationship_with")
+
+# Field the live queries project $event into; subscribe_live() only yields
+# the record, not the notification's action
+ACTION_FIELD = "live_action"
+
+
+def format_event(change, dumps):
+    # One server-sent event for a change, or a heartbeat comment for None
+    if change is None:
+        return ": heartbeat\n\n"
+    if change["type"] == "resync":
+        return "event: resync\ndata: {}\n\n"
+    return f"event: change\ndata: {dumps(change)}\n\n"
+
+
+class Subscription:
+    def __init__(self, user_id, maxsize, loop=None):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        # Set for asyncio consumers, which are woken through their loop
+        self._loop = loop
+        self._ready = asyncio.Event() if loop is not None else None
+
+    def push(self, change):
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            # Slow consumer: replace the backlog with a single resync marker
+            with self.queue.mutex:
+                self.dropped += len(self.queue.queue)
+                self.queue.queue.clear()
+            self.queue.put_nowait({"type": "resync"})
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._ready.set)
+            except RuntimeError:
+                # The consumer's loop has closed
+                pass
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def wait(self, timeout):
+        # get() for asyncio consumers, waiting without holding a thread
+        while True:
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._ready.clear()
+            # Checked again after clearing so a push in between isn't lost
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+
+class ChangeFeed:
+    def __init__(self, sdb, adb):
+        self.sdb = sdb
+        # Opens the upstream connection; lookups go through sdb's pool
+        self.adb = adb
+        self.queue_size = 256
+        self.heartbeat = 15.0
+        self.audience_cache_size = 10000
+
+        self._lock = threading.Lock()
+        self._subscribers = collections.defaultdict(set)
+        # event id -> set of user ids with access, kept current from
+        # has_access_to notifications once looked up
+        self._audience = collections.OrderedDict()
+        self._thread = None
+        self._loop = None
+        self._task = None
+        self._stop = threading.Event()
+        self._counters = {
+            "notifications": 0,
+            "delivered": 0,
+            "reconnects": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("LIVE_QUEUE_SIZE", 256)
+        app.config.setdefault("LIVE_HEARTBEAT", 15.0)
+        self.queue_size = app.config["LIVE_QUEUE_SIZE"]
+        self.heartbeat = app.config["LIVE_HEARTBEAT"]
+        app.extensions["change_feed"] = self
+
+    def subscribe(self, user_id, loop=None):
+        # Pass the running event loop to wait on the subscription from asyncio
+        subscription = Subscription(str(user_id), self.queue_size, loop)
+        with self._lock:
+            self._subscribers[subscription.user_id].add(subscription)
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def stop(self):
+        self._stop.set()
+        loop, task = self._loop, self._task
+        if task is not None:
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                # The feed's loop has already finished
+                pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["subscribers"] = sum(len(subscribers) for subscribers in self._subscribers.values())
+            stats["users"] = len(self._subscribers)
+        return stats
+
+    def _run(self):
+        asyncio.run(self._follow())
+
+    async def _follow(self):
+        self._loop, self._task = asyncio.get_running_loop(), asyncio.current_task()
+        backoff = 1.0
+        first = True
+        while not self._stop.is_set():
+            driver = None
+            try:
+                driver = await self.adb.connect()
+                feeds = []
+                for table in LIVE_TABLES:
+                    # DELETE notifications carry the record as it was,
+                    # without the projection
+                    query_uuid = await driver.query(f"LIVE SELECT *, $event AS {ACTION_FIELD} FROM {table}")
+                    feeds.append(self._relay(table, await driver.subscribe_live(query_uuid)))
+                if not first:
+                    # Anything could have changed while we were disconnected
+                    self._counters["reconnects"] += 1
+                    self._broadcast({"type": "resync"})
+                first = False
+                backoff = 1.0
+
+                # Runs until a feed or the ping fails, or stop() cancels it
+                tasks = [asyncio.ensure_future(feed) for feed in feeds] + [asyncio.ensure_future(self._ping(driver))]
+                try:
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                    done.pop().result()
+                    raise ConnectionError("A live query stream ended")
+                finally:
+                    for task in tasks:
+                        task.cancel()
+            except NotImplementedError:
+                logger.error("The live change feed needs a ws:// or wss:// DB_URL")
+                break
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                if self._stop.is_set():
+                    break
+                logger.exception("Live change feed disconnected, reconnecting in %ss", backoff)
+                try:
+                    await asyncio.sleep(backoff)
+                except asyncio.CancelledError:
+                    break
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if driver is not None:
+                    try:
+                        await driver.close()
+                    except Exception:
+                        pass
+
+    async def _relay(self, table, notifications):
+        async for record in notifications:
+            if isinstance(record, dict):
+                record = dict(record)
+                self._dispatch(table, record.pop(ACTION_FIELD, "DELETE"), record)
+
+    async def _ping(self, driver):
+        # The SDK's live iterators just stop yielding when the socket drops,
+        # so a failed query is what tells us to reconnect
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            await driver.query("RETURN true")
+
+    def _dispatch(self, table, action, record):
+        if not isinstance(record, dict) or "id" not in record:
+            return
+        with self._lock:
+            self._counters["notifications"] += 1
+            if not self._subscribers:
+                return
+
+        # [(users, record they are sent)]
+        match table:
+            case "calendar_event":
+                deliveries = [(self._event_audience(str(record["id"]), forget=action == "DELETE"), record)]
+            case "has_access_to":
+                deliveries = [({str(record["in"])}, record)]
+                self._update_audience(str(record["out"]), str(record["in"]), removed=action == "DELETE")
+            case "relationship_with":
+                # Labels are the follower's own, and the other side isn't
+                # told it was blocked or unblocked
+                deliveries = [({str(record["in"])}, record)]
+                if record.get("type") != "blocked":
+                    deliveries.append(({str(record["out"])}, {key: value for key, value in record.items() if key != "labels"}))
+            case _:
+                return
+
+        pushes = []
+        with self._lock:
+            for users, sent in deliveries:
+                change = {"type": "change", "table": table, "action": action, "record": sent}
+                pushes.extend((subscription, change) for user in users for subscription in self._subscribers.get(user, ()))
+            self._counters["delivered"] += len(pushes)
+        for subscription, change in pushes:
+            subscription.push(change)
+
+    def _event_audience(self, event_id, forget=False):
+        with self._lock:
+            if forget:
+                # The edges are gone by now; clients also get their
+                # has_access_to DELETE notifications
+                return self._audience.pop(event_id, set())
+            if event_id in self._audience:
+                self._audience.move_to_end(event_id)
+                return set(self._audience[event_id])
+
+        # One lookup per change, shared by every subscriber
+        with self.sdb.connection() as db:
+            users = db.query("SELECT VALUE in FROM has_access_to WHERE out = $event_id", {"event_id": RecordID.parse(event_id)})
+        users = {str(user) for user in users}
+
+        with self._lock:
+            self._audience[event_id] = users
+            while len(self._audience) > self.audience_cache_size:
+                self._audience.popitem(last=False)
+        return set(users)
+
+    def _update_audience(self, event_id, user_id, removed):
+        with self._lock:
+            users = self._audience.get(event_id)
+            if users is None:
+                return
+            if removed:
+                users.discard(user_id)
+            else:
+                users.add(user_id)
+
+    def _broadcast(self, change):
+        with self._lock:
+            subscriptions = [subscription for subscribers in self._subscribers.values() for subscription in subscribers]
+        for subscription in subscriptions:
+            subscription.push(change)
@@ -6,42 +6,137 @@ from dotenv import load_dotenv
 import flask_jwt_extended
 from surrealdb import Surreal
 
-from extensions import sdb
+import changelog
+import ratelimit
+import tracing
+from extensions import change_feed, conflicts, fanout, jobs, passwords, permissions, profiler, queries, rate_limiter, revoked_tokens, sdb, social_graph, suggestions, tracer, webhooks
+from jobs import compact_changelog, purge_expired_tokens, purge_orphaned_edges
+from schema import define_schema
+from surreal import SurrealJSONProvider
 
+from routes.analytics import analytics_bp
 from routes.auth import auth_bp
+from routes.availability import availability_bp
+from routes.debug import debug_bp
+from routes.event_labels import event_labels_bp
 from routes.events import events_bp
+from routes.friends import social_bp
+from routes.health import health_bp
+from routes.live import live_bp
+from routes.metrics import metrics_bp
+from routes.relationship_labels import relationship_labels_bp
+from routes.sync import sync_bp
+from routes.webhooks import webhooks_bp
 
 load_dotenv()
 
-if __name__ == "__main__":
+def create_app(config=None):
+    # Wires the app without touching the network. With LAZY_START set the
+    # caller runs start_services() later, e.g. in each worker after fork.
     app = flask.Flask(__name__)
     app.config["JWT_SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY")
-    
-    # Initialize the database connection
+    app.config["LAZY_START"] = os.getenv("LAZY_START", "false").lower() == "true"
+    app.config["READINESS_DB_TIMEOUT"] = float(os.getenv("READINESS_DB_TIMEOUT", 1))
+    app.config["DEBUG_TOKEN"] = os.getenv("DEBUG_TOKEN")
+    app.config.update(config or {})
+    app.json = SurrealJSONProvider(app)
+    app.extensions["health"] = {"ready": False, "draining": False}
+
+    tracer.init_app(app)
+    profiler.init_app(app)
     sdb.init_app(app)
-    db = sdb.get_db()
+    rate_limiter.init_app(app)
+    revoked_tokens.init_app(app)
+    permissions.init_app(app)
+    passwords.init_app(app)
+    queries.init_app(app)
+    social_graph.init_app(app)
+    suggestions.init_app(app)
+    conflicts.init_app(app)
+    webhooks.init_app(app)
+    fanout.init_app(app)
+    jobs.init_app(app)
+    jobs.register("token_purge", purge_expired_tokens)
+    jobs.register("orphaned_edges", purge_orphaned_edges)
+    jobs.register("changelog_compact", compact_changelog)
+    jobs.register("fanout_sweep", lambda scheduler, db: fanout.sweep(db))
+    change_feed.init_app(app)
+    changelog.init_app(app)
 
-    jwt = flask_jwt_extended.JWTManager()
+    jwt = ratelimit.JWTManager()
     jwt.init_app(app)
 
     # Register blueprints
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(events_bp, url_prefix='/events')
+    app.register_blueprint(event_labels_bp, url_prefix='/event-labels')
+    app.register_blueprint(relationship_labels_bp, url_prefix='/relationship-labels')
+    app.register_blueprint(social_bp, url_prefix='/social')
+    app.register_blueprint(availability_bp, url_prefix='/availability')
+    app.register_blueprint(analytics_bp, url_prefix='/analytics')
+    app.register_blueprint(webhooks_bp, url_prefix='/webhooks')
+    app.register_blueprint(live_bp, url_prefix='/live')
+    app.register_blueprint(sync_bp, url_prefix='/sync')
+    app.register_blueprint(health_bp, url_prefix='/health')
+    app.register_blueprint(metrics_bp, url_prefix='/metrics')
+    app.register_blueprint(debug_bp, url_prefix='/debug')
 
     # Flask callbacks
     @jwt.additional_claims_loader
     def add_claims_to_access_token(identity):
         pass
 
+    @jwt.decode_key_loader
+    def decode_key(jwt_header, jwt_payload):
+        # Called just before the signature check; the span ends when the
+        # blocklist check starts
+        flask.g.jwt_span = tracing.begin("jwt.verify")
+        return flask_jwt_extended.config.config.decode_key
+
     @jwt.token_in_blocklist_loader
     def token_in_blocklist(jwt_header, jwt_payload):
-        jti = jwt_payload["jti"]
-        token = db.query("SELECT * FROM blocked_token WHERE jti = $jti", {"jti": jti})
-        if token != []:
-            return True
-        return False
-
-    
-    # Run the Flask app
+        tracing.end(flask.g.pop("jwt_span", None))
+        with tracing.span("jwt.blocklist"):
+            return revoked_tokens.is_revoked(jwt_payload["jti"])
+
+    if not app.config["LAZY_START"]:
+        start_services(app)
+    return app
+
+def start_services(app):
+    # Opens the connection pool, makes sure the schema exists, warms the
+    # caches and starts background threads. Runs once per process, so a
+    # prefork server calls it after fork.
+    sdb.start()
+    with sdb.connection() as db:
+        define_schema(db)
+        queries.install(db)
+        # A round trip on a pooled connection so the first request doesn't
+        # pay for anything the handshake left undone
+        db.query("RETURN true")
+    revoked_tokens.start()
+    passwords.start()
+    if app.config["WEBHOOK_DISPATCH"]:
+        webhooks.start()
+    if app.config["FANOUT_WORKER"]:
+        fanout.start()
+    if app.config["JOBS_ENABLED"]:
+        jobs.start()
+    app.extensions["health"]["ready"] = True
+
+def stop_services(app):
+    # Stops taking traffic and winds the background threads down
+    app.extensions["health"]["draining"] = True
+    change_feed.stop()
+    webhooks.stop()
+    fanout.stop()
+    jobs.stop()
+    tracer.stop()
+    profiler.stop()
+    passwords.stop()
+    sdb.close()
+
+if __name__ == "__main__":
+    # Development server; see serve.py, gunicorn.conf.py and asgi.py for production
+    app = create_app()
     app.run()
-    
\ No newline at end of file
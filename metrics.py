@@ -0,0 +1,74 @@
+# Latency histograms and the Prometheus text format behind GET /metrics
+
+import bisect
+import math
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    # Not locked; the owner observes and snapshots under its own lock
+
+    def __init__(self, buckets=BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        cumulative, total = {}, 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            total += count
+            cumulative[bound] = total
+        return {"count": self.count, "sum": self.sum, "max": self.max, "buckets": cumulative}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def histogram(name, help_text, series):
+    # series: [(labels, Histogram.snapshot())]
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, snapshot in series:
+        for bound, count in snapshot["buckets"].items():
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': _number(bound)})} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {_number(snapshot['sum'])}")
+        lines.append(f"{name}_count{_labels(labels)} {snapshot['count']}")
+    return lines
+
+
+def gauge(name, help_text, series):
+    # series: [(labels, value)]
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines.extend(f"{name}{_labels(labels)} {_number(value)}" for labels, value in series)
+    return lines
+
+
+def flatten(stats):
+    # The numeric top level values of an extension's stats()
+    for key, value in stats.items():
+        if isinstance(value, bool):
+            yield key, int(value)
+        elif isinstance(value, (int, float)):
+            yield key, value
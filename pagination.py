@@ -0,0 +1,30 @@
+# Opaque cursors for keyset pagination
+
+import base64
+import json
+
+
+def encode_cursor(*values):
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, length):
+    # Raises ValueError for anything that isn't a cursor we handed out
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def parse_limit(value, default=100, maximum=500):
+    if value is None:
+        return default
+    limit = int(value)
+    if limit < 1:
+        raise ValueError("Limit must be positive")
+    return min(limit, maximum)
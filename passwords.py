@@ -0,0 +1,247 @@
+# Password hashing off the request thread
+#
+# Hashes and checks run in a small process pool, so a burst of logins
+# uses PASSWORD_HASH_WORKERS cores instead of every request thread's share
+# of the GIL. PASSWORD_HASH_WORKERS=0 hashes inline, e.g. for a dev server.
+#
+# PASSWORD_HASH_METHOD picks the algorithm and cost for new hashes:
+# werkzeug's "scrypt:N:r:p" or "pbkdf2:sha256:iterations", or
+# "argon2:time_cost:memory_kib:parallelism" with argon2-cffi installed.
+# A successful check against a hash made with anything else also returns
+# a fresh hash so the caller can store it.
+#
+# Each job holds a slot for the account and the client address until it
+# finishes, and there are only so many slots per account, per address and
+# in total; past that callers get HashingBusy rather than a queue.
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METHOD = "scrypt:32768:8:1"
+
+
+class HashingBusy(Exception):
+    # scope is "account", "ip" or "server"; callers answer the first two
+    # with 429 and a full pool with 503
+    def __init__(self, scope, retry_after):
+        super().__init__(f"Too many password checks in progress ({scope})")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+def normalize_method(method):
+    # The method string werkzeug writes in front of its hashes
+    name, _, params = method.partition(":")
+    match name:
+        case "scrypt":
+            return "scrypt:" + (params or "32768:8:1")
+        case "pbkdf2":
+            digest, _, iterations = params.partition(":")
+            return f"pbkdf2:{digest or 'sha256'}:{iterations or DEFAULT_PBKDF2_ITERATIONS}"
+        case "argon2":
+            time_cost, memory_cost, parallelism = (params.split(":") + ["", "", ""])[:3]
+            return f"argon2:{time_cost or 3}:{memory_cost or 65536}:{parallelism or 4}"
+    raise ValueError(f"Unsupported password hash method: {method}")
+
+
+def _argon2(method):
+    _, time_cost, memory_cost, parallelism = method.split(":")
+    return argon2.PasswordHasher(time_cost=int(time_cost), memory_cost=int(memory_cost), parallelism=int(parallelism))
+
+
+def needs_rehash(stored, method):
+    if method.startswith("argon2:"):
+        return not stored.startswith("$argon2") or argon2 is None or _argon2(method).check_needs_rehash(stored)
+    return stored.split("$", 1)[0] != method
+
+
+def hash_password(password, method):
+    if method.startswith("argon2:"):
+        return _argon2(method).hash(password)
+    return generate_password_hash(password, method)
+
+
+def check_password(stored, password, method):
+    # (matches, replacement hash or None); runs in the pool
+    if stored.startswith("$argon2"):
+        if argon2 is None:
+            return False, None
+        try:
+            argon2.PasswordHasher().verify(stored, password)
+        except argon2.exceptions.VerificationError:
+            return False, None
+    elif not check_password_hash(stored, password):
+        return False, None
+    return True, hash_password(password, method) if needs_rehash(stored, method) else None
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.method = DEFAULT_METHOD
+        self.workers = 2
+        self.timeout = 10.0
+        self.max_pending = 16
+        self.max_per_account = 2
+        self.max_per_ip = 4
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._accounts = {}
+        self._ips = {}
+        self._counters = {
+            "hashed": 0,
+            "checked": 0,
+            "rehashed": 0,
+            "rejected_account": 0,
+            "rejected_ip": 0,
+            "rejected_server": 0,
+            "timeouts": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("PASSWORD_HASH_METHOD", os.getenv("PASSWORD_HASH_METHOD", DEFAULT_METHOD))
+        app.config.setdefault("PASSWORD_HASH_WORKERS", int(os.getenv("PASSWORD_HASH_WORKERS", min(os.cpu_count() or 1, 4))))
+        app.config.setdefault("PASSWORD_HASH_TIMEOUT", float(os.getenv("PASSWORD_HASH_TIMEOUT", 10)))
+        app.config.setdefault("PASSWORD_MAX_PENDING", int(os.getenv("PASSWORD_MAX_PENDING", 0)))
+        app.config.setdefault("PASSWORD_MAX_PER_ACCOUNT", int(os.getenv("PASSWORD_MAX_PER_ACCOUNT", 2)))
+        app.config.setdefault("PASSWORD_MAX_PER_IP", int(os.getenv("PASSWORD_MAX_PER_IP", 4)))
+
+        self.method = normalize_method(app.config["PASSWORD_HASH_METHOD"])
+        if self.method.startswith("argon2:") and argon2 is None:
+            raise RuntimeError("PASSWORD_HASH_METHOD argon2 needs the argon2-cffi package")
+        self.workers = app.config["PASSWORD_HASH_WORKERS"]
+        self.timeout = app.config["PASSWORD_HASH_TIMEOUT"]
+        # By default a few jobs queue behind each worker
+        self.max_pending = app.config["PASSWORD_MAX_PENDING"] or max(self.workers, 1) * 4
+        self.max_per_account = app.config["PASSWORD_MAX_PER_ACCOUNT"]
+        self.max_per_ip = app.config["PASSWORD_MAX_PER_IP"]
+
+        app.extensions["passwords"] = self
+
+    def start(self):
+        # The pool has to be made after a prefork server forks, so this
+        # runs from start_services; the first job starts it otherwise
+        with self._lock:
+            executor = self._start()
+        # Workers boot on first use; have them up before traffic arrives
+        if executor is not None:
+            concurrent.futures.wait([executor.submit(os.getpid) for _ in range(self.workers)], self.timeout)
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password, account=None, ip=None):
+        self._count("hashed")
+        return self._run(hash_password, (password, self.method), account, ip)
+
+    def check(self, stored, password, account=None, ip=None):
+        # (matches, replacement hash or None) as in check_password
+        self._count("checked")
+        matches, replacement = self._run(check_password, (stored, password, self.method), account, ip)
+        if replacement:
+            self._count("rehashed")
+        return matches, replacement
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["pending"] = self._pending
+            stats["workers"] = self.workers
+            stats["max_pending"] = self.max_pending
+        return stats
+
+    def _start(self):
+        if self._executor is None and self.workers > 0:
+            # forkserver keeps the workers from inheriting locks held by
+            # request threads at fork time. Like spawn it re-imports the
+            # main module, so scripts need the __main__ guard.
+            context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+            if context.get_start_method() == "forkserver":
+                context.set_forkserver_preload([__name__])
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context)
+        return self._executor
+
+    def _run(self, function, args, account, ip):
+        self._acquire(account, ip)
+        release = lambda *_: self._release(account, ip)
+        if self.workers <= 0:
+            try:
+                return function(*args)
+            finally:
+                release()
+
+        try:
+            with self._lock:
+                future = self._start().submit(function, *args)
+        except concurrent.futures.BrokenExecutor:
+            release()
+            self._reset()
+            raise HashingBusy("server", 1)
+        except BaseException:
+            release()
+            raise
+        # The slot stays taken until the worker is done, even if this
+        # request has given up waiting on it
+        future.add_done_callback(release)
+
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            self._count("timeouts")
+            raise HashingBusy("server", max(int(self.timeout), 1))
+        except concurrent.futures.BrokenExecutor:
+            self._reset()
+            raise HashingBusy("server", 1)
+
+    def _acquire(self, account, ip):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                scope = "server"
+            elif account is not None and self._accounts.get(account, 0) >= self.max_per_account:
+                scope = "account"
+            elif ip is not None and self._ips.get(ip, 0) >= self.max_per_ip:
+                scope = "ip"
+            else:
+                self._pending += 1
+                if account is not None:
+                    self._accounts[account] = self._accounts.get(account, 0) + 1
+                if ip is not None:
+                    self._ips[ip] = self._ips.get(ip, 0) + 1
+                return
+            self._counters["rejected_" + scope] += 1
+        raise HashingBusy(scope, 1)
+
+    def _release(self, account, ip):
+        with self._lock:
+            self._pending -= 1
+            for counts, key in ((self._accounts, account), (self._ips, ip)):
+                if key is None:
+                    continue
+                counts[key] -= 1
+                if not counts[key]:
+                    del counts[key]
+
+    def _reset(self):
+        # A worker died (OOM, killed); the next job starts a new pool
+        logger.error("Password hashing pool broke, restarting it")
+        self.stop()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
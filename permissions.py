@@ -0,0 +1,186 @@
+# Effective permission of a user on an event, cached in process
+#
+# Answers come from the has_access_to edge between the two. An edge only
+# grants access while something in its because_of still holds: "owner",
+# a direct share, a relationship_label that still exists, or an event_label
+# shared with a group the user is in (see fanout.py). Answers are
+# kept in an LRU with a TTL (misses are cached too) and dropped as soon as
+# a share, unshare, label deletion or event deletion changes them; the TTL
+# bounds how stale another worker process can be.
+
+import collections
+import logging
+import threading
+import time
+
+from surrealdb import RecordID
+
+logger = logging.getLogger(__name__)
+
+PERMISSION_RANK = {"view": 1, "edit": 2, "admin": 3, "owner": 4}
+# What a share can grant; owner only comes from creating the event
+SHARE_PERMISSIONS = ("admin", "edit", "view")
+LABEL_TABLE = "relationship_label"
+
+
+def strongest(permissions):
+    # The highest of permissions, or None when there are none
+    return max(permissions, key=lambda permission: PERMISSION_RANK.get(permission, 0), default=None)
+
+
+def _record(value):
+    return RecordID.parse(value) if isinstance(value, str) else value
+
+
+def _reasons(edge):
+    because_of = edge.get("because_of")
+    if not because_of:
+        return []
+    return [because_of] if isinstance(because_of, str) else [str(reason) for reason in because_of]
+
+
+class PermissionResolver:
+    def __init__(self, sdb):
+        self.sdb = sdb
+        self.max_size = 10000
+        self.ttl = 60.0
+
+        self._lock = threading.Lock()
+        # (user id, event id) -> (permission or None, labels it depends on, expiry)
+        self._entries = collections.OrderedDict()
+        # Reverse indexes so invalidation doesn't scan the whole cache
+        self._by_event = collections.defaultdict(set)
+        self._by_label = collections.defaultdict(set)
+        # Bumped by every invalidation, so a resolve that raced one isn't cached
+        self._version = 0
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "invalidations": 0,
+            "evictions": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("PERMISSION_CACHE_SIZE", 10000)
+        app.config.setdefault("PERMISSION_CACHE_TTL", 60.0)
+        self.max_size = app.config["PERMISSION_CACHE_SIZE"]
+        self.ttl = app.config["PERMISSION_CACHE_TTL"]
+        app.extensions["permissions"] = self
+
+    def get(self, db, user_id, event_id):
+        # Highest permission user_id holds on event_id, or None
+        return self.get_many(db, user_id, [event_id])[str(event_id)]
+
+    def get_many(self, db, user_id, event_ids):
+        # {event id: permission or None} for many events with one query for
+        # the ones that aren't cached
+        user_id = str(user_id)
+        event_ids = [str(event_id) for event_id in event_ids]
+        result, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for event_id in event_ids:
+                entry = self._entries.get((user_id, event_id))
+                if entry is not None and entry[2] > now:
+                    self._entries.move_to_end((user_id, event_id))
+                    result[event_id] = entry[0]
+                    self._counters["hits"] += 1
+                else:
+                    missing.append(event_id)
+                    self._counters["misses"] += 1
+            version = self._version
+
+        if missing:
+            resolved = self._resolve(db, user_id, list(dict.fromkeys(missing)))
+            with self._lock:
+                if version == self._version:
+                    for event_id, (permission, labels) in resolved.items():
+                        self._store((user_id, event_id), permission, labels)
+            result.update({event_id: permission for event_id, (permission, labels) in resolved.items()})
+        return result
+
+    def invalidate(self, user_ids=None, event_id=None):
+        # Drops the answers for user_ids on event_id, or for everyone on
+        # event_id when user_ids is None
+        with self._lock:
+            if user_ids is None:
+                keys = list(self._by_event.get(str(event_id), ()))
+            else:
+                keys = [(str(user_id), str(event_id)) for user_id in user_ids]
+            for key in keys:
+                self._drop(key)
+            self._version += 1
+            self._counters["invalidations"] += len(keys)
+
+    def invalidate_label(self, label_id):
+        # Drops every answer that relied on label_id
+        with self._lock:
+            keys = list(self._by_label.get(str(label_id), ()))
+            for key in keys:
+                self._drop(key)
+            self._version += 1
+            self._counters["invalidations"] += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_event.clear()
+            self._by_label.clear()
+            self._version += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _resolve(self, db, user_id, event_ids):
+        edges = db.query(
+            "SELECT out, permission, because_of FROM has_access_to WHERE in = $user_id AND out IN $events",
+            {"user_id": _record(user_id), "events": [_record(event_id) for event_id in event_ids]}
+        )
+
+        # Label grants only count while the label is still there
+        labels = {reason for edge in edges for reason in _reasons(edge) if reason.startswith(LABEL_TABLE + ":")}
+        existing = set()
+        if labels:
+            existing = {str(label) for label in db.query("SELECT VALUE id FROM $labels", {"labels": [_record(label) for label in labels]})}
+
+        resolved = {event_id: (None, ()) for event_id in event_ids}
+        for edge in edges:
+            reasons = _reasons(edge)
+            edge_labels = [reason for reason in reasons if reason.startswith(LABEL_TABLE + ":")]
+            # Edges shared before because_of was kept still grant access
+            granted = not reasons or any(reason not in edge_labels or reason in existing for reason in reasons)
+            if not granted:
+                continue
+
+            event_id = str(edge["out"])
+            permission, depends_on = resolved[event_id]
+            if PERMISSION_RANK.get(edge["permission"], 0) > PERMISSION_RANK.get(permission, 0):
+                permission = edge["permission"]
+            resolved[event_id] = (permission, tuple(depends_on) + tuple(edge_labels))
+        return resolved
+
+    def _store(self, key, permission, labels):
+        self._drop(key)
+        self._entries[key] = (permission, labels, time.monotonic() + self.ttl)
+        self._by_event[key[1]].add(key)
+        for label in labels:
+            self._by_label[label].add(key)
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+            self._counters["evictions"] += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for index, name in [(self._by_event, key[1])] + [(self._by_label, label) for label in entry[1]]:
+            keys = index.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[name]
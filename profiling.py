@@ -0,0 +1,113 @@
+# On-demand sampling profiler for one endpoint
+#
+# start() picks an endpoint (e.g. "events.get_events_in_range") and a
+# duration. While it runs, a background thread samples the stack of every
+# thread that is serving that endpoint every PROFILE_INTERVAL_MS and counts
+# the folded stacks, which folded() returns in the format flamegraph.pl
+# and speedscope read. Samples are per process, so under a prefork server
+# profile with one worker or repeat the request until it lands on each.
+#
+# When no profile is running the request hooks return after one attribute
+# check.
+
+import collections
+import os
+import sys
+import threading
+import time
+
+import flask
+
+
+def fold(frame):
+    # root;...;leaf for one stack
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    def __init__(self):
+        self.endpoint = None
+        self.interval = 0.005
+        self.max_seconds = 300.0
+
+        self._lock = threading.Lock()
+        self._threads = set()
+        self._stacks = collections.Counter()
+        self._samples = 0
+        self._deadline = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        app.config.setdefault("PROFILE_INTERVAL_MS", float(os.getenv("PROFILE_INTERVAL_MS", 5)))
+        app.config.setdefault("PROFILE_MAX_SECONDS", float(os.getenv("PROFILE_MAX_SECONDS", 300)))
+        self.interval = app.config["PROFILE_INTERVAL_MS"] / 1000
+        self.max_seconds = app.config["PROFILE_MAX_SECONDS"]
+
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.extensions["profiler"] = self
+
+    def start(self, endpoint, seconds):
+        # Starts a fresh profile, replacing any that is running
+        self.stop()
+        with self._lock:
+            self._stacks.clear()
+            self._samples = 0
+            self._deadline = time.monotonic() + min(seconds, self.max_seconds)
+            self._stop.clear()
+            self.endpoint = endpoint
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        self.endpoint = None
+
+    def folded(self):
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self.endpoint is not None,
+                "samples": self._samples,
+                "stacks": len(self._stacks),
+                "seconds_left": max(self._deadline - time.monotonic(), 0.0) if self.endpoint else 0.0,
+            }
+
+    def _before_request(self):
+        if self.endpoint is not None and flask.request.endpoint == self.endpoint:
+            with self._lock:
+                self._threads.add(threading.get_ident())
+            flask.g.profiled = True
+
+    def _teardown_request(self, exception):
+        if flask.g.pop("profiled", False):
+            with self._lock:
+                self._threads.discard(threading.get_ident())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if time.monotonic() >= self._deadline:
+                # Keep the samples for folded() but stop taking new ones
+                self.endpoint = None
+                return
+            with self._lock:
+                threads = list(self._threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            stacks = [fold(frames[ident]) for ident in threads if ident in frames]
+            with self._lock:
+                self._samples += len(stacks)
+                self._stacks.update(stacks)
@@ -0,0 +1,499 @@
+# Named SurrealQL statements and the wrapper that runs them
+#
+# Every statement the route modules send is defined once here under a
+# dotted name and run with queries.run(db, name, vars), which times it and
+# keeps per-name latency histograms, row counts and error counts. Anything
+# slower than SLOW_QUERY_MS is logged.
+#
+# Scripts (statements with params) are written as the body of a block and
+# RETURN their result, so they give back one value however many
+# statements they hold. They're sent inline as RETURN { ... } by default.
+# With QUERY_FUNCTIONS set, install() defines each one on the server as
+# DEFINE FUNCTION fn::<name>_<hash> and run() only sends the call. The hash
+# of the body is part of the name, so workers on different versions of a
+# script never call each other's definition during a rolling reload.
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import tracing
+from metrics import Histogram
+from surreal import query_all
+from surrealdb import RecordID
+
+logger = logging.getLogger(__name__)
+
+class Statement:
+    def __init__(self, name, text, params=(), records=(), many=False):
+        self.name = name
+        self.text = text.strip()
+        self.params = tuple(params)
+        self.records = tuple(records)
+        self.many = many
+
+        digest = hashlib.sha1(self.text.encode()).hexdigest()[:8]
+        self.function = f"fn::{name.replace('.', '_')}_{digest}"
+
+    @property
+    def script(self):
+        return bool(self.params)
+
+    def inline(self):
+        if self.script:
+            return f"RETURN {{\n{self.text}\n}};"
+        return self.text
+
+    def definition(self):
+        params = ", ".join(f"${param}: any" for param in self.params)
+        return f"DEFINE FUNCTION OVERWRITE {self.function}({params}) {{\n{self.text}\n}};"
+
+    def call(self):
+        return f"RETURN {self.function}({', '.join('$' + param for param in self.params)});"
+
+
+STATEMENTS = {}
+
+
+def statement(name, text, params=(), records=(), many=False):
+    # params makes text a script. records names the vars that hold record
+    # ids; they're sent as RecordIDs, because SurrealDB won't use an index
+    # for a comparison with <record> $var. many sends text through
+    # query_all so every statement in a transaction is checked.
+    if name in STATEMENTS:
+        raise ValueError(f"Statement {name} is already defined")
+    STATEMENTS[name] = Statement(name, text, params, records, many)
+
+
+class QueryRepository:
+    def __init__(self, sdb):
+        self.sdb = sdb
+        self.slow_seconds = 0.25
+        self.use_functions = False
+
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._installed = False
+
+    def init_app(self, app):
+        app.config.setdefault("SLOW_QUERY_MS", float(os.getenv("SLOW_QUERY_MS", 250)))
+        app.config.setdefault("QUERY_FUNCTIONS", os.getenv("QUERY_FUNCTIONS", "false").lower() == "true")
+        self.slow_seconds = app.config["SLOW_QUERY_MS"] / 1000
+        self.use_functions = app.config["QUERY_FUNCTIONS"]
+
+        app.extensions["queries"] = self
+
+    def install(self, db):
+        # Defines every script as a stored function; a no-op unless
+        # QUERY_FUNCTIONS is set
+        if not self.use_functions:
+            return
+        scripts = [stmt for stmt in STATEMENTS.values() if stmt.script]
+        query_all(db, "\n".join(stmt.definition() for stmt in scripts))
+        self._installed = True
+        logger.info("Defined %d stored functions", len(scripts))
+
+    def run(self, db, name, vars=None):
+        stmt = STATEMENTS[name]
+        vars = dict(vars or {})
+        for key in stmt.records:
+            if isinstance(vars.get(key), str):
+                vars[key] = RecordID.parse(vars[key])
+            elif isinstance(vars.get(key), list):
+                vars[key] = [RecordID.parse(value) if isinstance(value, str) else value for value in vars[key]]
+        if stmt.script:
+            vars = {param: vars.get(param) for param in stmt.params}
+            text = stmt.call() if self._installed else stmt.inline()
+        else:
+            text = stmt.text
+
+        started = time.perf_counter()
+        try:
+            with tracing.span("query " + name, statement=name):
+                result = query_all(db, text, vars) if stmt.many else db.query(text, vars)
+        except Exception:
+            self._observe(name, time.perf_counter() - started, 0, failed=True)
+            raise
+        elapsed = time.perf_counter() - started
+
+        if isinstance(result, list):
+            rows = len(result)
+        else:
+            rows = 0 if result is None else 1
+        self._observe(name, elapsed, rows)
+        if elapsed >= self.slow_seconds:
+            logger.warning("Slow query %s took %.1f ms, %d rows, vars %s", name, elapsed * 1000, rows, sorted(vars))
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {"errors": metric["errors"], "rows": metric["rows"], **metric["seconds"].snapshot()}
+                for name, metric in self._metrics.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def _observe(self, name, elapsed, rows, failed=False):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = {"errors": 0, "rows": 0, "seconds": Histogram()}
+            metric["errors"] += failed
+            metric["rows"] += rows
+            metric["seconds"].observe(elapsed)
+
+
+# Events
+
+statement("events.owner", """
+    SELECT in, labels FROM has_access_to
+    WHERE out = $event_id AND permission = 'owner'
+    LIMIT 1;
+""", records=("event_id",))
+
+statement("events.audience", """
+    SELECT VALUE in FROM has_access_to WHERE out = $event_id;
+""", records=("event_id",))
+
+statement("events.get", """
+    SELECT * FROM ONLY $event_id;
+""", records=("event_id",))
+
+statement("events.create", """
+    CREATE calendar_event CONTENT $event_data;
+""")
+
+statement("events.link_owner", """
+    RELATE $user->has_access_to->$calendar_event
+    SET permission = 'owner', because_of = ['owner'], labels = [];
+""", records=("user",))
+
+# The owner's time budget changes with the event. $budget was worked out
+# from the event's timing as the route read it, so nothing is written if
+# that has changed since.
+statement("events.update", """
+    BEGIN TRANSACTION;
+    LET $before = (SELECT start_time, end_time, recurrence, recurrence_end FROM ONLY $event_id);
+    IF $before = NONE OR $before.start_time != $timing.start_time OR $before.end_time != $timing.end_time
+        OR $before.recurrence != $timing.recurrence OR $before.recurrence_end != $timing.recurrence_end {
+        RETURN { error: "Event changed" };
+    };
+    LET $after = (UPDATE ONLY $event_id MERGE $event_data RETURN AFTER);
+    INSERT INTO time_budget $budget ON DUPLICATE KEY UPDATE seconds += $input.seconds RETURN NONE;
+    RETURN { event: $after };
+    COMMIT TRANSACTION;
+""", records=("event_id",), many=True)
+
+statement("events.set_recurrence", """
+    UPDATE ONLY $event_id
+    SET recurrence = $recurrence, recurrence_end = $recurrence_end
+    RETURN AFTER;
+""", records=("event_id",))
+
+statement("events.links", """
+    SELECT id, in FROM has_access_to WHERE out = $event_id;
+""", records=("event_id",))
+
+statement("events.delete", """
+    DELETE $event_id RETURN BEFORE;
+""", records=("event_id",))
+
+statement("events.user_exists", """
+    SELECT VALUE id FROM ONLY $user_id;
+""", records=("user_id",))
+
+# Both users' edges are read with has_access_to_in and intersected. With
+# out IN $visible in the WHERE the planner unions has_access_to_out over
+# every event the requester can see instead.
+statement("events.owned_by", """
+    LET $visible = (SELECT VALUE out FROM has_access_to WHERE in = $requester_id);
+    LET $owned = (SELECT VALUE out FROM has_access_to WHERE in = $user_id AND permission = 'owner');
+    RETURN (SELECT * FROM array::intersect($owned, $visible));
+""", params=("user_id", "requester_id"), records=("user_id", "requester_id"))
+
+# Visible events are read from the user's access edges with the
+# has_access_to_in index and filtered from there. Testing every event
+# against WHERE id IN (SELECT ...) runs the subquery once per event.
+# Single events are paged in the DB in (start_time, id) order to match the
+# cursor.
+statement("events.range_single", """
+    SELECT * FROM (SELECT VALUE out FROM has_access_to WHERE in = $user_id)
+    WHERE recurrence = NONE
+        AND start_time < $to AND end_time > $from
+        AND ($after_start = NONE OR start_time > $after_start OR (start_time = $after_start AND id > <record> $after_id))
+    ORDER BY start_time, id
+    LIMIT $limit;
+""", records=("user_id",))
+
+statement("events.range_series", """
+    SELECT * FROM (SELECT VALUE out FROM has_access_to WHERE in = $user_id)
+    WHERE recurrence != NONE
+        AND start_time < $to AND (recurrence_end = NONE OR recurrence_end > $from);
+""", records=("user_id",))
+
+statement("events.export_page", """
+    SELECT * FROM (SELECT VALUE out FROM has_access_to WHERE in = $user_id)
+    WHERE ($after_start = NONE OR start_time > $after_start OR (start_time = $after_start AND id > <record> $after_id))
+    ORDER BY start_time, id
+    LIMIT $limit;
+""", records=("user_id",))
+
+# Only the fields the conflict index keeps, for every busy event the user
+# owns, as arrays; objects take about twice as long to send
+statement("events.owned_intervals", """
+    SELECT VALUE [id, title, start_time, end_time, recurrence, recurrence_end]
+    FROM (SELECT VALUE out FROM has_access_to WHERE in = $user_id AND permission = 'owner')
+    WHERE busy != false;
+""", records=("user_id",))
+
+statement("events.import_batch", """
+    BEGIN TRANSACTION;
+    INSERT INTO calendar_event $events RETURN NONE;
+    INSERT RELATION INTO has_access_to $links RETURN NONE;
+    COMMIT TRANSACTION;
+""", many=True)
+
+# The labels on the requester's own edge; only their own event labels
+statement("events.set_labels", """
+    LET $edge = (SELECT id, permission, labels FROM has_access_to WHERE in = $user_id AND out = $event_id)[0];
+    IF $edge = NONE { RETURN { error: "Event not found" }; };
+    IF array::len((SELECT VALUE id FROM $label_ids WHERE owner IN [$user_id, <string> $user_id])) != array::len($label_ids) {
+        RETURN { error: "Event label not found" };
+    };
+    UPDATE $edge.id SET labels = $label_ids RETURN NONE;
+    RETURN { link: $edge.id, permission: $edge.permission, before: $edge.labels };
+""", params=("user_id", "event_id", "label_ids"), records=("user_id", "event_id", "label_ids"))
+
+statement("events.shares", """
+    SELECT * FROM has_access_to WHERE out = $event_id;
+""", records=("event_id",))
+
+statement("events.share_for_user", """
+    SELECT * FROM has_access_to WHERE in = $user_id AND out = $event_id;
+""", records=("user_id", "event_id"))
+
+# Event labels. Labels made before owners were stored as records hold a
+# string, so ownership matches either.
+
+statement("event_labels.list", """
+    SELECT * FROM event_label WHERE owner = $user_id OR owner = <string> $user_id;
+""", records=("user_id",))
+
+statement("event_labels.create", """
+    CREATE event_label SET name = $name, owner = $user_id;
+""")
+
+statement("event_labels.rename", """
+    LET $label = <record> $label_id;
+    IF !record::exists($label) { RETURN { error: "Event label not found" }; };
+    IF $label.owner NOT IN [$user_id, <record> $user_id] { RETURN { error: "Requester is not owner" }; };
+    RETURN (UPDATE ONLY $label SET name = $name);
+""", params=("label_id", "user_id", "name"))
+
+# Takes the reason $reason off every edge that has it and sets the edge's
+# permission to the highest its remaining reasons grant (see sharing.py);
+# edges from before reason_permissions was kept keep their permission.
+# Evaluates to the updated edges' id, in, out and because_of.
+STRIP_REASON = """(
+        UPDATE has_access_to SET
+            because_of -= $reason,
+            label_refs = array::complement(label_refs ?? [], [$reason]),
+            reason_permissions = IF reason_permissions = NONE { NONE }
+                ELSE { object::from_entries(object::entries(reason_permissions)[WHERE $this[0] != $reason]) },
+            permission = IF reason_permissions = NONE { permission }
+                ELSE IF object::values(reason_permissions) CONTAINS 'admin' { 'admin' }
+                ELSE IF object::values(reason_permissions) CONTAINS 'edit' { 'edit' }
+                ELSE { 'view' }
+        WHERE because_of CONTAINS $reason
+        RETURN id, in, out, because_of
+    )"""
+
+# Deleting a label also takes away the access it granted relationship
+# label groups, and the edges it was the last reason for
+statement("event_labels.delete", """
+    LET $label = <record> $label_id;
+    IF !record::exists($label) { RETURN { error: "Event label not found" }; };
+    IF $label.owner NOT IN [$user_id, <record> $user_id] { RETURN { error: "Requester is not owner" }; };
+    LET $links = (UPDATE has_access_to SET labels -= $label WHERE labels CONTAINS $label RETURN VALUE id);
+    DELETE label_grant WHERE event_label = $label;
+    LET $reason = <string> $label;
+    LET $granted = """ + STRIP_REASON + """;
+    LET $revoked = $granted[WHERE because_of = []];
+    DELETE $revoked.id;
+    RETURN {
+        label: (DELETE ONLY $label RETURN BEFORE),
+        links: $links,
+        updated: $granted[WHERE because_of != []],
+        revoked: $revoked
+    };
+""", params=("label_id", "user_id"))
+
+# Relationship label groups an event label is shared with, keyed by the pair
+
+statement("event_labels.groups", """
+    LET $label = <record> $label_id;
+    IF $label.owner NOT IN [$user_id, <record> $user_id] { RETURN { error: "Event label not found" }; };
+    RETURN (SELECT relationship_label, permission FROM label_grant WHERE event_label = $label);
+""", params=("label_id", "user_id"))
+
+statement("event_labels.grant", """
+    LET $label = <record> $label_id;
+    LET $group = <record> $group_id;
+    IF $label.owner NOT IN [$user_id, <record> $user_id] { RETURN { error: "Event label not found" }; };
+    IF $group.owner != <record> $user_id { RETURN { error: "Relationship label not found" }; };
+    RETURN (
+        UPSERT ONLY type::thing('label_grant', [<string> $label, <string> $group])
+        SET owner = <record> $user_id, event_label = $label, relationship_label = $group, permission = $permission
+    );
+""", params=("label_id", "group_id", "user_id", "permission"))
+
+statement("event_labels.revoke", """
+    LET $label = <record> $label_id;
+    IF $label.owner NOT IN [$user_id, <record> $user_id] { RETURN { error: "Event label not found" }; };
+    LET $grant = type::thing('label_grant', [<string> $label, $group_id]);
+    IF !record::exists($grant) { RETURN { error: "Group not found" }; };
+    RETURN (DELETE ONLY $grant RETURN BEFORE);
+""", params=("label_id", "group_id", "user_id"))
+
+# Relationship labels
+
+statement("relationship_labels.list", """
+    SELECT * FROM relationship_label WHERE owner = $user_id;
+""", records=("user_id",))
+
+statement("relationship_labels.create", """
+    CREATE relationship_label SET owner = $user_id, name = $name RETURN AFTER;
+""", records=("user_id",))
+
+statement("relationship_labels.update", """
+    LET $label = <record> $label_id;
+    IF !record::exists($label) { RETURN { error: "Label not found" }; };
+    IF $label.owner != <record> $user_id { RETURN { error: "Requester is not the owner" }; };
+    RETURN (UPDATE ONLY $label MERGE $merge_data);
+""", params=("label_id", "user_id", "merge_data"))
+
+statement("relationship_labels.owner", """
+    SELECT owner FROM ONLY $label_id;
+""", records=("label_id",))
+
+# Returns the event labels whose groups lost the label
+# Members of the label's group lose what sharing with it granted, and
+# the edges it was the last reason for
+statement("relationship_labels.delete", """
+    DELETE $label_id;
+    LET $event_labels = (DELETE label_grant WHERE relationship_label = $label_id RETURN BEFORE).event_label;
+    LET $reason = <string> $label_id;
+    LET $granted = """ + STRIP_REASON + """;
+    LET $revoked = $granted[WHERE because_of = []];
+    DELETE $revoked.id;
+    RETURN {
+        event_labels: $event_labels,
+        updated: $granted[WHERE because_of != []],
+        revoked: $revoked
+    };
+""", params=("label_id",), records=("label_id",))
+
+# Tagging the user the requester follows with one of their labels
+statement("relationship_labels.tag", """
+    IF $label_id.owner != $user_id { RETURN { error: "Label not found" }; };
+    LET $relationship = (SELECT id, type FROM relationship_with WHERE in = $user_id AND out = $target_id);
+    IF $relationship = [] OR $relationship[0].type = 'blocked' { RETURN { error: "Requester not following target" }; };
+    RETURN (UPDATE ONLY $relationship[0].id SET labels = array::union(labels, [$label_id]) RETURN AFTER);
+""", params=("label_id", "user_id", "target_id"), records=("label_id", "user_id", "target_id"))
+
+statement("relationship_labels.untag", """
+    IF $label_id.owner != $user_id { RETURN { error: "Label not found" }; };
+    LET $relationship = (SELECT id, labels FROM relationship_with WHERE in = $user_id AND out = $target_id);
+    IF $relationship = [] OR $relationship[0].labels CONTAINSNOT $label_id { RETURN { error: "Target is not tagged with label" }; };
+    RETURN (UPDATE ONLY $relationship[0].id SET labels -= $label_id RETURN AFTER);
+""", params=("label_id", "user_id", "target_id"), records=("label_id", "user_id", "target_id"))
+
+# Social graph
+
+# Scripts keep to one edge per (in, out) pair, which social_graph relies on
+
+statement("social.adjacency", """
+    RETURN {
+        out: (SELECT VALUE [out, type, id] FROM relationship_with WHERE in = $user_id),
+        in: (SELECT VALUE [in, type, id] FROM relationship_with WHERE out = $user_id)
+    };
+""", records=("user_id",))
+
+statement("social.edges", """
+    SELECT * FROM $ids;
+""", records=("ids",))
+
+statement("social.following_many", """
+    SELECT VALUE [in, out] FROM relationship_with WHERE in IN $users AND type IN ['following', 'friends'];
+""", records=("users",))
+
+# Following back someone who follows you makes both edges friends, and
+# unfollowing a friend leaves their edge as a follow
+
+statement("social.follow", """
+    LET $requester = <record> $requester_id;
+    LET $target = <record> $target_user_id;
+    IF !record::exists($target) { RETURN { error: "Target user does not exist" }; };
+    IF (SELECT VALUE type FROM relationship_with WHERE in = $target AND out = $requester) CONTAINS 'blocked' {
+        RETURN { error: "Requester blocked by target" };
+    };
+    LET $existing = (SELECT * FROM relationship_with WHERE in = $requester AND out = $target);
+    IF $existing[0].type = 'blocked' { RETURN { error: "Requester blocked target" }; };
+    IF $existing != [] { RETURN $existing[0]; };
+    LET $reverse = (SELECT VALUE id FROM relationship_with WHERE in = $target AND out = $requester AND type IN ['following', 'friends']);
+    LET $type = IF $reverse = [] { 'following' } ELSE { 'friends' };
+    UPDATE $reverse SET type = 'friends';
+    RETURN (RELATE ONLY $requester->relationship_with->$target SET type = $type, labels = []);
+""", params=("requester_id", "target_user_id"))
+
+statement("social.unfollow", """
+    LET $requester = <record> $requester_id;
+    LET $target = <record> $target_user_id;
+    LET $relationship = (SELECT VALUE id FROM relationship_with WHERE in = $requester AND out = $target AND type != 'blocked');
+    IF $relationship = [] { RETURN { error: "Requester not following target" }; };
+    UPDATE relationship_with SET type = 'following' WHERE in = $target AND out = $requester AND type = 'friends';
+    RETURN (DELETE ONLY $relationship[0] RETURN BEFORE);
+""", params=("requester_id", "target_user_id"))
+
+statement("social.remove_follower", """
+    LET $requester = <record> $requester_id;
+    LET $target = <record> $target_user_id;
+    IF !record::exists($target) { RETURN { error: "Target user does not exist" }; };
+    LET $relationship = (SELECT id, type FROM relationship_with WHERE in = $target AND out = $requester);
+    IF $relationship = [] OR $relationship[0].type = 'blocked' { RETURN { error: "Target is not following user" }; };
+    UPDATE relationship_with SET type = 'following' WHERE in = $requester AND out = $target AND type = 'friends';
+    RETURN (DELETE ONLY $relationship[0].id RETURN BEFORE);
+""", params=("requester_id", "target_user_id"))
+
+statement("social.remove_friend", """
+    LET $requester = <record> $requester_id;
+    LET $target = <record> $target_user_id;
+    IF !record::exists($target) { RETURN { error: "Target user does not exist" }; };
+    LET $relationship = (SELECT id, type FROM relationship_with WHERE in = $requester AND out = $target);
+    IF $relationship = [] OR $relationship[0].type != 'friends' { RETURN { error: "Target is not friends with user" }; };
+    UPDATE relationship_with SET type = 'following' WHERE in = $target AND out = $requester;
+    RETURN (UPDATE ONLY $relationship[0].id SET type = 'following');
+""", params=("requester_id", "target_user_id"))
+
+statement("social.block", """
+    LET $requester = <record> $requester_id;
+    LET $target = <record> $target_user_id;
+    IF !record::exists($target) { RETURN { error: "Target user does not exist" }; };
+    DELETE relationship_with WHERE in = $target AND out = $requester AND type != 'blocked';
+    DELETE relationship_with WHERE in = $requester AND out = $target;
+    RETURN (RELATE ONLY $requester->relationship_with->$target SET type = 'blocked', labels = []);
+""", params=("requester_id", "target_user_id"))
+
+statement("social.unblock", """
+    LET $requester = <record> $requester_id;
+    LET $target = <record> $target_user_id;
+    IF !record::exists($target) { RETURN { error: "Target user does not exist" }; };
+    LET $relationship = (SELECT id, type FROM relationship_with WHERE in = $requester AND out = $target);
+    IF $relationship = [] OR $relationship[0].type != 'blocked' { RETURN { error: "Target is not blocked by user" }; };
+    RETURN (DELETE ONLY $relationship[0].id RETURN BEFORE);
+""", params=("requester_id", "target_user_id"))
@@ -0,0 +1,255 @@
+# Per-client rate limits and load shedding
+#
+# Every request takes a token from a bucket keyed by the JWT identity when
+# it carries a valid access token and by the client address otherwise.
+# RATE_LIMITS sets the refill rate and burst per endpoint or blueprint,
+# e.g. "auth.login=10/minute, events=50/second:100"; the most specific
+# match wins and RATE_LIMIT_DEFAULT covers the rest. An empty bucket
+# answers 429 with Retry-After.
+#
+# Buckets live in this process unless RATE_LIMIT_STORAGE is a redis://
+# URL, which shares them between workers and hosts. Without the redis
+# package, or while Redis is unreachable, the in-process buckets stand in
+# so a Redis outage loosens the limits instead of failing requests.
+#
+# Independently of any one client, once RATE_LIMIT_SHED_QUEUE requests are
+# already waiting for a SurrealDB connection new ones get 503 with
+# Retry-After straight away rather than joining the queue and timing out.
+#
+# Keying on the identity means decoding the token before the route does.
+# The app's JWTManager keeps the decoded claims on flask.g for the rest of
+# the request, so jwt_required reuses them instead of checking the
+# signature a second time; its type and revocation checks still run.
+
+import collections
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+import flask
+import flask_jwt_extended
+
+import tracing
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"second": 1, "s": 1, "minute": 60, "m": 60, "hour": 3600, "h": 3600, "day": 86400, "d": 86400}
+
+# Blueprints that keep answering under load and aren't limited
+EXEMPT = ("health", "metrics", "debug")
+
+
+def parse_limit(spec):
+    # "count/period[:burst]" -> (tokens per second, burst)
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\w+)\s*(?::\s*(\d+))?\s*", spec)
+    if not match or match.group(2) not in PERIODS:
+        raise ValueError(f"Invalid rate limit: {spec!r}, expected e.g. 10/minute or 50/second:100")
+    count, period, burst = int(match.group(1)), PERIODS[match.group(2)], match.group(3)
+    return count / period, int(burst) if burst else count
+
+
+def parse_limits(text):
+    # "endpoint=spec, blueprint=spec" from the environment
+    limits = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name, _, spec = item.partition("=")
+        limits[name.strip()] = spec.strip()
+    return limits
+
+
+class MemoryBuckets:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # key -> [tokens, monotonic time of the last refill]
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        # (allowed, seconds until a token is available)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [burst, now]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True, 0.0
+            return False, (1 - bucket[0]) / rate
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisBuckets:
+    # One round trip per request; the script refills and takes atomically
+    # against Redis' clock so workers on different hosts agree
+    SCRIPT = """
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+    local tokens = tonumber(state[1]) or burst
+    local at = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+    local allowed, wait = 0, 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+    return {allowed, tostring(wait)}
+    """
+
+    def __init__(self, url, prefix="ratelimit:"):
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        allowed, wait = self._script(keys=[self.prefix + key], args=[rate, burst])
+        return bool(allowed), float(wait)
+
+
+class JWTManager(flask_jwt_extended.JWTManager):
+    # Decodes each request's token once however many times it is asked for
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        cached = flask.g.get("jwt_decoded")
+        if cached is not None and cached[0] == encoded_token and csrf_value is None and not allow_expired:
+            return cached[1]
+        claims = super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+        if csrf_value is None and not allow_expired:
+            flask.g.jwt_decoded = (encoded_token, claims)
+        return claims
+
+
+class RateLimiter:
+    def __init__(self, sdb):
+        self.sdb = sdb
+        self.enabled = True
+        self.default = None
+        self.limits = {}
+        self.shed_queue = 0
+        self.retry_redis = 30.0
+
+        self._local = MemoryBuckets()
+        self._shared = None
+        self._shared_down_until = 0.0
+        self._lock = threading.Lock()
+        self._counters = {
+            "allowed": 0,
+            "limited": 0,
+            "shed": 0,
+            "shared_failures": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("RATE_LIMIT_ENABLED", os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true")
+        app.config.setdefault("RATE_LIMIT_DEFAULT", os.getenv("RATE_LIMIT_DEFAULT", "20/second:40"))
+        app.config.setdefault("RATE_LIMITS", parse_limits(os.getenv("RATE_LIMITS", "auth.login=10/minute:5, auth.register=5/minute")))
+        app.config.setdefault("RATE_LIMIT_STORAGE", os.getenv("RATE_LIMIT_STORAGE", "memory://"))
+        app.config.setdefault("RATE_LIMIT_MAX_KEYS", int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000)))
+        app.config.setdefault("RATE_LIMIT_REDIS_RETRY", float(os.getenv("RATE_LIMIT_REDIS_RETRY", 30)))
+        # 0 sheds once as many requests wait for a connection as the pool holds
+        app.config.setdefault("RATE_LIMIT_SHED_QUEUE", int(os.getenv("RATE_LIMIT_SHED_QUEUE", 0)))
+
+        self.enabled = app.config["RATE_LIMIT_ENABLED"]
+        self.default = parse_limit(app.config["RATE_LIMIT_DEFAULT"]) if app.config["RATE_LIMIT_DEFAULT"] else None
+        self.limits = {name: parse_limit(spec) if spec else None for name, spec in app.config["RATE_LIMITS"].items()}
+        self.shed_queue = app.config["RATE_LIMIT_SHED_QUEUE"] or app.config["DB_POOL_MAX"]
+        self.retry_redis = app.config["RATE_LIMIT_REDIS_RETRY"]
+        self._local = MemoryBuckets(app.config["RATE_LIMIT_MAX_KEYS"])
+
+        storage = app.config["RATE_LIMIT_STORAGE"]
+        if storage.startswith(("redis://", "rediss://", "unix://")):
+            if redis is None:
+                logger.warning("RATE_LIMIT_STORAGE is %s but the redis package is missing, limiting per process", storage)
+            else:
+                self._shared = RedisBuckets(storage)
+
+        if self.enabled:
+            app.before_request(self._before_request)
+        app.extensions["rate_limiter"] = self
+
+    def limit_for(self, endpoint, blueprint):
+        # (bucket scope, (rate, burst) or None for unlimited); an endpoint
+        # entry beats its blueprint's, which beats the default
+        for name in (endpoint, blueprint):
+            if name in self.limits:
+                return name, self.limits[name]
+        return "default", self.default
+
+    def take(self, key, rate, burst):
+        shared = self._shared
+        if shared is not None and time.monotonic() >= self._shared_down_until:
+            try:
+                return shared.take(key, rate, burst)
+            except redis.RedisError:
+                logger.warning("Rate limit storage unreachable, limiting per process for %ss", self.retry_redis, exc_info=True)
+                with self._lock:
+                    self._counters["shared_failures"] += 1
+                self._shared_down_until = time.monotonic() + self.retry_redis
+        return self._local.take(key, rate, burst)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["local_buckets"] = len(self._local)
+        stats["shared"] = self._shared is not None and time.monotonic() >= self._shared_down_until
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _client_key(self):
+        # The verified identity when there is one; an expired, revoked or
+        # forged token falls back to the address, and the route rejects it.
+        # jwt_required reuses the claims decoded here (see JWTManager).
+        header = flask.request.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            try:
+                return "user:" + str(flask_jwt_extended.decode_token(header[7:])["sub"])
+            except Exception:
+                pass
+        return "ip:" + (flask.request.remote_addr or "unknown")
+
+    def _before_request(self):
+        blueprint = flask.request.blueprint
+        if blueprint in EXEMPT or flask.request.endpoint is None:
+            return None
+
+        if self.sdb.waiting() >= self.shed_queue:
+            self._count("shed")
+            return {"error": "Server is busy, try again shortly"}, 503, {"Retry-After": "1"}
+
+        scope, limit = self.limit_for(flask.request.endpoint, blueprint)
+        if limit is None:
+            return None
+        rate, burst = limit
+        # The span also closes the jwt.verify span decode_token opens
+        with tracing.span("ratelimit"):
+            allowed, wait = self.take(f"{scope}:{self._client_key()}", rate, burst)
+        if allowed:
+            self._count("allowed")
+            return None
+
+        self._count("limited")
+        return {"error": "Rate limit exceeded"}, 429, {"Retry-After": str(max(math.ceil(wait), 1))}
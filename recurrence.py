@@ -0,0 +1,262 @@
+# RRULE-style recurring events, expanded lazily inside a window
+#
+# A recurring calendar_event is stored once with
+#     recurrence: { rrule: "FREQ=WEEKLY;BYDAY=MO,WE", exdates: [...], overrides: {...} }
+# exdates lists occurrence keys that were cancelled and overrides maps an
+# occurrence key to the fields that differ for that one occurrence. The
+# occurrence key is the original start of the occurrence in ISO format,
+# in the offset of the series start.
+
+import calendar
+import collections
+import heapq
+from datetime import datetime, timedelta, timezone
+
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+
+Rule = collections.namedtuple("Rule", ["freq", "interval", "count", "until", "byday"])
+
+
+def parse_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    value = str(value)
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
+
+
+def comparable(dt):
+    # Aware datetimes are compared in UTC so they can be mixed with naive ones
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _parse_until(value):
+    for fmt in ("%Y%m%dT%H%M%SZ", "%Y%m%dT%H%M%S", "%Y%m%d"):
+        try:
+            until = datetime.strptime(value, fmt)
+            return until.replace(tzinfo=timezone.utc) if value.endswith("Z") else until
+        except ValueError:
+            continue
+    return parse_datetime(value)
+
+
+def parse_rrule(rrule):
+    # Supports FREQ, INTERVAL, COUNT, UNTIL and BYDAY (weekly only)
+    if not rrule or not isinstance(rrule, str):
+        raise ValueError("rrule is required")
+
+    parts = {}
+    for part in rrule.removeprefix("RRULE:").split(";"):
+        if not part:
+            continue
+        key, sep, value = part.partition("=")
+        if not sep or not value:
+            raise ValueError(f"Invalid rrule part '{part}'")
+        parts[key.upper()] = value
+
+    freq = parts.pop("FREQ", "").upper()
+    if freq not in FREQUENCIES:
+        raise ValueError("FREQ must be one of " + ", ".join(FREQUENCIES))
+
+    try:
+        interval = int(parts.pop("INTERVAL", 1))
+        count = int(parts["COUNT"]) if "COUNT" in parts else None
+    except ValueError:
+        raise ValueError("INTERVAL and COUNT must be integers")
+    parts.pop("COUNT", None)
+    if interval < 1 or (count is not None and count < 1):
+        raise ValueError("INTERVAL and COUNT must be positive")
+
+    until = None
+    if "UNTIL" in parts:
+        if count is not None:
+            raise ValueError("COUNT and UNTIL cannot both be set")
+        until = _parse_until(parts.pop("UNTIL"))
+
+    byday = ()
+    if "BYDAY" in parts:
+        if freq != "WEEKLY":
+            raise ValueError("BYDAY is only supported with FREQ=WEEKLY")
+        days = parts.pop("BYDAY").upper().split(",")
+        if any(day not in WEEKDAYS for day in days):
+            raise ValueError("BYDAY must be a list of MO, TU, WE, TH, FR, SA, SU")
+        byday = tuple(sorted({WEEKDAYS.index(day) for day in days}))
+
+    if parts:
+        raise ValueError("Unsupported rrule parts: " + ", ".join(sorted(parts)))
+
+    return Rule(freq, interval, count, until, byday)
+
+
+def _add_months(dt, months):
+    month_index = dt.month - 1 + months
+    year, month = dt.year + month_index // 12, month_index % 12 + 1
+    if dt.day > calendar.monthrange(year, month)[1]:
+        return None
+    return dt.replace(year=year, month=month)
+
+
+def _periods(rule, dtstart, skip_to):
+    # Yields (occurrences_before, [starts]) per period starting at the first
+    # period that can contain skip_to. occurrences_before is None when the
+    # number of earlier occurrences can't be worked out without iterating.
+    if rule.freq in ("DAILY", "WEEKLY") and not rule.byday:
+        step = timedelta(days=rule.interval * (7 if rule.freq == "WEEKLY" else 1))
+        k = 0
+        if skip_to is not None and skip_to > comparable(dtstart):
+            k = int((skip_to - comparable(dtstart)) / step)
+        while True:
+            yield k, [dtstart + k * step]
+            k += 1
+
+    elif rule.freq == "WEEKLY":
+        step = timedelta(weeks=rule.interval)
+        week0 = dtstart - timedelta(days=dtstart.weekday())
+        first = [week0 + timedelta(days=day) for day in rule.byday if week0 + timedelta(days=day) >= dtstart]
+        w = 0
+        if skip_to is not None and skip_to > comparable(week0):
+            w = int((skip_to - comparable(week0)) / step)
+        while True:
+            if w == 0:
+                yield 0, first
+            else:
+                starts = [week0 + w * step + timedelta(days=day) for day in rule.byday]
+                yield len(first) + (w - 1) * len(rule.byday), starts
+            w += 1
+
+    else:
+        months = rule.interval * (12 if rule.freq == "YEARLY" else 1)
+        m = 0
+        if skip_to is not None and rule.count is None and skip_to > comparable(dtstart):
+            elapsed = (skip_to.year - dtstart.year) * 12 + skip_to.month - dtstart.month
+            m = max(0, elapsed // months - 1)
+        while True:
+            start = _add_months(dtstart, m * months)
+            yield (m if m == 0 else None), [start] if start is not None else []
+            m += 1
+
+
+def occurrence_starts(rule, dtstart, not_before=None):
+    # Lazily yields every occurrence start of the series in order, starting
+    # near not_before when the rule allows jumping there directly
+    dtstart = parse_datetime(dtstart)
+    skip_to = comparable(parse_datetime(not_before)) if not_before is not None else None
+    until = comparable(rule.until) if rule.until is not None else None
+
+    seen = 0
+    for before, starts in _periods(rule, dtstart, skip_to):
+        if before is not None:
+            seen = before
+        for start in starts:
+            if rule.count is not None and seen >= rule.count:
+                return
+            if until is not None and comparable(start) > until:
+                return
+            seen += 1
+            if skip_to is None or comparable(start) >= skip_to:
+                yield start
+
+
+def occurrence_key(start):
+    return start.isoformat()
+
+
+def match_occurrence(rule, dtstart, key):
+    # The key of the occurrence starting at the same instant as key, which
+    # may be written with another offset, or None when there is none
+    key = parse_datetime(key)
+    first = next(occurrence_starts(rule, dtstart, key), None)
+    if first is None or comparable(first) != comparable(key):
+        return None
+    return occurrence_key(first)
+
+
+def series_end(rule, start_time, end_time, overrides=None):
+    # Latest end of any occurrence, or None for a series that never ends.
+    # Stored as recurrence_end so range queries can rule series out in the DB.
+    start, end = parse_datetime(start_time), parse_datetime(end_time)
+    duration = end - start
+
+    if rule.until is not None:
+        last = rule.until + duration
+    elif rule.count is not None:
+        last = None
+        for last in occurrence_starts(rule, start):
+            pass
+        last = (last or start) + duration
+    else:
+        return None
+
+    for delta in (overrides or {}).values():
+        if delta.get("end_time"):
+            last = max(last, parse_datetime(delta["end_time"]), key=comparable)
+    return last.isoformat()
+
+
+def _occurrence(event, key, start, end, delta=None):
+    occurrence = {k: v for k, v in event.items() if k not in ("recurrence", "recurrence_end")}
+    occurrence["start_time"] = start.isoformat()
+    occurrence["end_time"] = end.isoformat()
+    occurrence["occurrence_of"] = event.get("id")
+    occurrence["recurrence_id"] = key
+    if delta:
+        occurrence.update(delta)
+    return occurrence
+
+
+def sort_key(event):
+    return (event["start_time"], str(event.get("occurrence_of") or event.get("id")))
+
+
+def expand(event, window_start, window_end):
+    # Yields the occurrences of event overlapping [window_start, window_end)
+    # in start order. Non-recurring events yield themselves if they overlap.
+    window_start = comparable(parse_datetime(window_start))
+    window_end = comparable(parse_datetime(window_end))
+
+    start = parse_datetime(event["start_time"])
+    end = parse_datetime(event["end_time"])
+    recurrence = event.get("recurrence")
+    if not recurrence:
+        if comparable(start) < window_end and comparable(end) > window_start:
+            yield event
+        return
+
+    rule = parse_rrule(recurrence["rrule"])
+    duration = end - start
+    overrides = recurrence.get("overrides") or {}
+    # Keys are matched as instants, so one stored with another offset still
+    # lines up with its occurrence
+    exdates = {comparable(parse_datetime(key)) for key in recurrence.get("exdates") or []}
+    overridden = {comparable(parse_datetime(key)) for key in overrides}
+
+    def regular():
+        for occurrence_start in occurrence_starts(rule, start, window_start - duration):
+            at = comparable(occurrence_start)
+            if at >= window_end:
+                return
+            if at in exdates or at in overridden:
+                continue
+            yield _occurrence(event, occurrence_key(occurrence_start), occurrence_start, occurrence_start + duration)
+
+    # Overrides are sparse, so the moved occurrences are cheap to sort
+    moved = []
+    for key, delta in overrides.items():
+        if comparable(parse_datetime(key)) in exdates:
+            continue
+        occurrence_start = parse_datetime(delta.get("start_time", key))
+        occurrence_end = parse_datetime(delta.get("end_time") or (parse_datetime(key) + duration).isoformat())
+        if comparable(occurrence_start) < window_end and comparable(occurrence_end) > window_start:
+            moved.append(_occurrence(event, key, occurrence_start, occurrence_end, delta))
+    moved.sort(key=sort_key)
+
+    yield from heapq.merge(regular(), moved, key=sort_key)
+
+
+def expand_all(events, window_start, window_end):
+    # Streams the occurrences of many events merged into a single start order
+    return heapq.merge(*(expand(event, window_start, window_end) for event in events), key=sort_key)
@@ -0,0 +1,209 @@
+# In-process cache in front of the blocked_token table
+#
+# Each worker process keeps its own cache, and revoke() only reaches the
+# process that handled the logout. The others catch up by reading the
+# blocked_token rows written since their last sync, at most every
+# REVOCATION_SYNC_INTERVAL seconds, so that is how long a token revoked in
+# one worker can still be accepted by another.
+
+import collections
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds each sync reaches back before the previous one
+SYNC_OVERLAP = 5.0
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "little")
+        b = int.from_bytes(digest[8:], "little") | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationCache:
+    def __init__(self, sdb):
+        self.sdb = sdb
+        self.max_size = 10000
+        self.ttl = 30.0
+        self.use_bloom = False
+        self.bloom_refresh = 60.0
+        self.sync_interval = 1.0
+
+        # jti -> expiry for tokens we know are revoked
+        self._revoked = {}
+        # jti -> time we last confirmed it is not revoked
+        self._known_good = collections.OrderedDict()
+        self._bloom = None
+        self._bloom_loaded_at = 0.0
+        self._bloom_refreshing = False
+        self._synced_at = 0.0
+        self._syncing = False
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "bloom_negatives": 0,
+            "synced": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("REVOCATION_CACHE_SIZE", int(os.getenv("REVOCATION_CACHE_SIZE", 10000)))
+        app.config.setdefault("REVOCATION_CACHE_TTL", float(os.getenv("REVOCATION_CACHE_TTL", 30)))
+        app.config.setdefault("REVOCATION_BLOOM", os.getenv("REVOCATION_BLOOM", "false").lower() == "true")
+        app.config.setdefault("REVOCATION_BLOOM_REFRESH", float(os.getenv("REVOCATION_BLOOM_REFRESH", 60)))
+        app.config.setdefault("REVOCATION_SYNC_INTERVAL", float(os.getenv("REVOCATION_SYNC_INTERVAL", 1)))
+
+        self.max_size = app.config["REVOCATION_CACHE_SIZE"]
+        self.ttl = app.config["REVOCATION_CACHE_TTL"]
+        self.use_bloom = app.config["REVOCATION_BLOOM"]
+        self.bloom_refresh = app.config["REVOCATION_BLOOM_REFRESH"]
+        self.sync_interval = app.config["REVOCATION_SYNC_INTERVAL"]
+
+        app.extensions["revocation_cache"] = self
+
+    def start(self):
+        # Load the filter before the first request instead of on a miss
+        self._synced_at = time.time()
+        if self.use_bloom:
+            self.refresh_bloom()
+
+    def is_revoked(self, jti):
+        now = time.time()
+        with self._lock:
+            sync = now - self._synced_at >= self.sync_interval and not self._syncing
+            if sync:
+                self._syncing = True
+        if sync:
+            self.sync()
+
+        with self._lock:
+            if jti in self._revoked:
+                self._counters["hits"] += 1
+                return True
+
+            checked_at = self._known_good.get(jti)
+            if checked_at is not None and now - checked_at < self.ttl:
+                self._known_good.move_to_end(jti)
+                self._counters["hits"] += 1
+                return False
+
+            bloom_fresh = self._bloom is not None and now - self._bloom_loaded_at < self.bloom_refresh
+            if bloom_fresh and jti not in self._bloom:
+                self._counters["bloom_negatives"] += 1
+                return False
+
+            self._counters["misses"] += 1
+            refresh = self.use_bloom and not bloom_fresh and not self._bloom_refreshing
+            if refresh:
+                self._bloom_refreshing = True
+
+        if refresh:
+            threading.Thread(target=self.refresh_bloom, daemon=True).start()
+
+        db = self.sdb.get_db()
+        token = db.query("SELECT expiry FROM blocked_token WHERE jti = $jti LIMIT 1", {"jti": jti})
+
+        with self._lock:
+            if token:
+                self._revoked[jti] = token[0].get("expiry")
+                self._known_good.pop(jti, None)
+                return True
+            self._known_good[jti] = now
+            self._known_good.move_to_end(jti)
+            while len(self._known_good) > self.max_size:
+                self._known_good.popitem(last=False)
+        return False
+
+    def sync(self):
+        # Picks up tokens other processes revoked since the last sync. The
+        # overlap covers clocks that disagree a little between hosts.
+        started = time.time()
+        try:
+            db = self.sdb.get_db()
+            rows = db.query(
+                "SELECT jti, expiry FROM blocked_token WHERE revoked_at >= $since AND expiry > $now",
+                {"since": self._synced_at - SYNC_OVERLAP, "now": int(started)}
+            )
+            with self._lock:
+                for row in rows:
+                    self._revoked[row["jti"]] = row["expiry"]
+                    self._known_good.pop(row["jti"], None)
+                    if self._bloom is not None:
+                        self._bloom.add(row["jti"])
+                self._synced_at = started
+                self._counters["synced"] += len(rows)
+                # revoke() is only called for this worker's logouts, so
+                # expired tokens are dropped here as well
+                self._prune(started)
+        except Exception:
+            logger.exception("Failed to sync revoked tokens")
+        finally:
+            with self._lock:
+                self._syncing = False
+
+    def revoke(self, jti, expiry):
+        # Called after a blocked_token has been written so this process
+        # stops accepting the token straight away
+        with self._lock:
+            self._revoked[jti] = expiry
+            self._known_good.pop(jti, None)
+            if self._bloom is not None:
+                self._bloom.add(jti)
+            self._prune(time.time())
+
+    def refresh_bloom(self):
+        # Rebuild the filter from every unexpired blocked_token. A jti that
+        # is not in the filter is treated as valid until the next refresh.
+        try:
+            with self.sdb.connection() as db:
+                rows = db.query("SELECT jti, expiry FROM blocked_token WHERE expiry > $now", {"now": int(time.time())})
+            bloom = BloomFilter(max(len(rows) * 2, self.max_size))
+            for row in rows:
+                bloom.add(row["jti"])
+            with self._lock:
+                self._bloom = bloom
+                self._bloom_loaded_at = time.time()
+                for row in rows:
+                    self._revoked[row["jti"]] = row["expiry"]
+                self._prune(time.time())
+        except Exception:
+            logger.exception("Failed to refresh the revoked token bloom filter")
+        finally:
+            with self._lock:
+                self._bloom_refreshing = False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["revoked"] = len(self._revoked)
+            stats["known_good"] = len(self._known_good)
+            stats["bloom_enabled"] = self._bloom is not None
+            stats["bloom_age_seconds"] = time.time() - self._bloom_loaded_at if self._bloom is not None else None
+            stats["sync_age_seconds"] = time.time() - self._synced_at
+        return stats
+
+    def _prune(self, now):
+        expired = [jti for jti, expiry in self._revoked.items() if expiry is not None and expiry < now]
+        for jti in expired:
+            del self._revoked[jti]
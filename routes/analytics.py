@@ -0,0 +1,54 @@
+# Routes relating to statistics and analytics
+
+from datetime import date, timedelta
+
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+
+import time_budget
+from extensions import sdb
+
+analytics_bp = Blueprint('analytics', __name__)
+
+@analytics_bp.route('/time-budget', methods=['GET'])
+@jwt_required()
+def get_time_budget():
+    db = sdb.get_db()
+
+    user = get_jwt_identity()
+    user_id = f"user:{user}"
+
+    period = request.args.get("period", "week")
+    try:
+        anchor = date.fromisoformat(request.args["date"]) if request.args.get("date") else date.today()
+        match period:
+            case "week":
+                start = anchor - timedelta(days=anchor.weekday())
+                end = start + timedelta(days=7)
+                bucket = "day"
+            case "month":
+                start = anchor.replace(day=1)
+                end = (start + timedelta(days=32)).replace(day=1)
+                bucket = "day"
+            case "custom":
+                start = date.fromisoformat(request.args["from"])
+                end = date.fromisoformat(request.args["to"])
+                bucket = request.args.get("bucket", "day")
+            case _:
+                return {"error": "period must be week, month or custom"}, 400
+    except (KeyError, ValueError):
+        return {"error": "date, from and to must be ISO 8601 dates"}, 400
+
+    if start >= end:
+        return {"error": "from must be before to"}, 400
+    if bucket not in ("day", "week", "month"):
+        return {"error": "bucket must be day, week or month"}, 400
+
+    rows = time_budget.read(db, user_id, start, end)
+
+    return jsonify({
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "bucket": bucket,
+        **time_budget.rollup(rows, bucket)
+    }), 200
@@ -1,13 +1,22 @@
 # User authentication and authorization logic
 
+import time
+
 from flask import Flask, Blueprint, jsonify, request
 from flask_jwt_extended import create_access_token, create_refresh_token, get_jwt, get_jwt_identity, jwt_required
-from werkzeug.security import generate_password_hash, check_password_hash
 
-from extensions import sdb
+from extensions import passwords, revoked_tokens, sdb
+from passwords import HashingBusy
 
 auth_bp = Blueprint('auth', __name__)
 
+@auth_bp.errorhandler(HashingBusy)
+def hashing_busy(e):
+    # 429 when this account or address already has checks running, 503
+    # when the hashing pool itself is full
+    status = 503 if e.scope == "server" else 429
+    return { "error": "Too many login attempts, try again shortly" }, status, { "Retry-After": str(e.retry_after) }
+
 @auth_bp.post('/register')
 def register():
     db = sdb.get_db()
@@ -26,13 +35,10 @@ def register():
         return { "error": "Invalid email address" }, 400
 
     users = db.query("SELECT * FROM user WHERE username = $username OR email = $email", { "username": username, "email": email })
-    print(users)
     if users != []:
         return { "error": "username or email taken" }, 409
 
-    password = data.get("password")
-    hash = generate_password_hash(password)
-    print(hash)
+    hash = passwords.hash(password, email.lower(), request.remote_addr)
 
     db.query("CREATE user SET username = $username, email = $email, password = $password" , { "username": username, "email": email, "password": hash })
     return { "message": "User registered successfully" }
@@ -45,19 +51,22 @@ def login():
     password = data.get("password")
     email = data.get("email")
 
-    print(password)
-
     if (not email) or not password:
         return { "error": "Email and password are required" }, 400
 
     user = db.query("SELECT * FROM user WHERE email = $email", { "email": email })
-    print(user)
     if user == []:
         return { "error": "Invalid email or password" }, 401
 
-    if not check_password_hash(user[0]['password'], password):
+    matches, rehashed = passwords.check(user[0]['password'], password, email.lower(), request.remote_addr)
+    if not matches:
         return { "error": "Invalid email or password" }, 401
 
+    # Hashes made with an older method or cost are upgraded while we have
+    # the plaintext
+    if rehashed:
+        db.query("UPDATE $user SET password = $password RETURN NONE", { "user": user[0]['id'], "password": rehashed })
+
     # Generate JWT tokens
     access_token = create_access_token(user[0]['id'].id)
     refresh_token = create_refresh_token(user[0]['id'].id)
@@ -95,7 +104,8 @@ def logout():
     exp = jwt["exp"]
     token_type = jwt["type"]
 
-    db.query("CREATE blocked_token SET jti = $jti, reason='logout', expiry=$expiry", { "jti": jti, "expiry": exp })
+    db.query("CREATE blocked_token SET jti = $jti, reason='logout', expiry=$expiry, revoked_at=$revoked_at", { "jti": jti, "expiry": exp, "revoked_at": time.time() })
+    revoked_tokens.revoke(jti, exp)
 
     return jsonify(
         {
@@ -0,0 +1,73 @@
+# Routes relating to free/busy and finding meeting times
+
+from flask import Blueprint, current_app, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from surrealdb import RecordID
+
+from availability import as_json, busy_intervals, free_slots, parse_duration, parse_window
+from extensions import sdb, social_graph
+
+availability_bp = Blueprint('availability', __name__)
+
+@availability_bp.route('/', methods=['POST'])
+@jwt_required()
+def find_availability():
+    db = sdb.get_db()
+
+    requester = get_jwt_identity()
+    requester_id = RecordID("user", requester)
+
+    data = request.get_json() or {}
+    users = data.get("users", [])
+    if not isinstance(users, list) or not data.get("from") or not data.get("to"):
+        return {"error": "users, from and to are required"}, 400
+
+    try:
+        window_start, window_end = parse_window(data["from"], data["to"])
+        duration = parse_duration(data.get("duration_minutes", 30))
+    except (TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+
+    user_ids = list(dict.fromkeys([requester] + [str(user) for user in users]))
+    if len(user_ids) > current_app.config.get("AVAILABILITY_MAX_USERS", 100):
+        return {"error": "Too many users"}, 400
+    participants = [RecordID("user", user) for user in user_ids]
+
+    # Only friends share their free/busy time with the requester
+    visible = {
+        str(user) for user in participants
+        if social_graph.relation(db, requester_id, user)[1] == "friends"
+    } | {str(requester_id)}
+    hidden = [str(user) for user in participants if str(user) not in visible]
+    if hidden:
+        return {"error": "Cannot view availability of these users", "users": hidden}, 403
+
+    # Every participant's own busy events overlapping the window in a single
+    # round trip through the has_access_to_in index; events only shared with
+    # them don't take up their time, as for conflicts
+    rows = db.query(
+        """
+        SELECT in AS user, out.start_time AS start_time, out.end_time AS end_time,
+            out.recurrence AS recurrence, out.busy AS busy
+        FROM has_access_to
+        WHERE in IN $participants
+            AND permission = 'owner'
+            AND out.busy != false
+            AND out.start_time < $to
+            AND ((out.recurrence = NONE AND out.end_time > $from)
+                OR (out.recurrence != NONE AND (out.recurrence_end = NONE OR out.recurrence_end > $from)));
+        """,
+        {"participants": participants, "from": data["from"], "to": data["to"]}
+    )
+
+    events_by_user = {str(user): [] for user in participants}
+    for row in rows:
+        events_by_user[str(row["user"])].append(row)
+
+    busy = {user: busy_intervals(events, window_start, window_end) for user, events in events_by_user.items()}
+    free = free_slots(busy.values(), window_start, window_end, duration)
+
+    return jsonify({
+        "busy": {user: as_json(intervals) for user, intervals in busy.items()},
+        "free": as_json(free)
+    }), 200
@@ -0,0 +1,63 @@
+# Operator endpoints for traces, the sampling profiler and maintenance jobs
+#
+# Only answered when DEBUG_TOKEN is set, and only to requests that send it
+# in X-Debug-Token; otherwise they 404 like any unknown route.
+
+import hmac
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request
+
+from extensions import jobs, profiler, tracer
+
+debug_bp = Blueprint('debug', __name__)
+
+@debug_bp.before_request
+def require_debug_token():
+    expected = current_app.config.get("DEBUG_TOKEN")
+    given = request.headers.get("X-Debug-Token", "")
+    if not expected or not hmac.compare_digest(given, expected):
+        abort(404)
+
+@debug_bp.route('/traces', methods=['GET'])
+def get_traces():
+    # The most recent sampled traces as an OTLP/HTTP JSON export request
+    return jsonify(tracer.recent()), 200
+
+@debug_bp.route('/profile', methods=['POST'])
+def start_profile():
+    data = request.get_json() or {}
+    endpoint = data.get("endpoint")
+    if endpoint not in current_app.view_functions:
+        return jsonify({"error": "endpoint must be a Flask endpoint name, e.g. events.get_events_in_range"}), 400
+    try:
+        seconds = float(data.get("seconds", 30))
+    except (TypeError, ValueError):
+        return jsonify({"error": "seconds must be a number"}), 400
+    if seconds <= 0:
+        return jsonify({"error": "seconds must be positive"}), 400
+
+    profiler.start(endpoint, seconds)
+    return jsonify({"message": "Profiling started", "endpoint": endpoint, **profiler.stats()}), 202
+
+@debug_bp.route('/profile', methods=['GET'])
+def get_profile():
+    # Folded stacks, one "frame;frame;frame count" line each, for
+    # flamegraph.pl or speedscope
+    return Response(profiler.folded(), mimetype="text/plain")
+
+@debug_bp.route('/profile', methods=['DELETE'])
+def stop_profile():
+    profiler.stop()
+    return jsonify({"message": "Profiling stopped", **profiler.stats()}), 200
+
+@debug_bp.route('/jobs', methods=['GET'])
+def get_jobs():
+    # The scheduler's lease and every job's last run
+    return jsonify(jobs.status()), 200
+
+@debug_bp.route('/jobs/<name>', methods=['POST'])
+def run_job(name):
+    # Queues name to run now on this process
+    if not jobs.trigger(name):
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"message": "Job triggered", "job": name}), 202
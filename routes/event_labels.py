@@ -3,19 +3,23 @@
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import get_jwt_identity, jwt_required
 
-from extensions import sdb
+import changelog
+import revisions
+from extensions import fanout, queries, sdb
+from permissions import SHARE_PERMISSIONS
 
 event_labels_bp = Blueprint('event-labels', __name__)
 
 @event_labels_bp.route('/', methods=['GET'])
 @jwt_required()
+@revisions.conditional("event_labels")
 def get_event_labels():
     db = sdb.get_db()
     # Logic to retrieve event labels
     current_user = get_jwt_identity()
     user_id = f"user:{current_user}"
 
-    event_labels = db.query("SELECT * FROM event_label WHERE owner = $user_id;", {"user_id": user_id})
+    event_labels = queries.run(db, "event_labels.list", {"user_id": user_id})
     return jsonify(event_labels)
 
 @event_labels_bp.route('/', methods=['POST'])
@@ -31,7 +35,9 @@ def create_event_label():
     if not label_name:
         return jsonify({"error": "Label name is required"}), 400
 
-    db.query("CREATE event_label SET name = $name, owner = $user_id;", {"name": label_name, "user_id": user_id})
+    created = queries.run(db, "event_labels.create", {"name": label_name, "user_id": user_id})
+    revisions.bump(db, [user_id], "event_labels")
+    changelog.record(db, [user_id], upserts=[label["id"] for label in created])
     return jsonify({"message": "Event label created successfully"}), 201
 
 @event_labels_bp.route('/<label_id>', methods=['PUT'])
@@ -47,16 +53,9 @@ def edit_event_label(label_id):
     if not label_name:
         return jsonify({"error": "Label name is required"}), 400
 
-    result = db.query("""
-            IF NOT (record::exists($label_id)) THEN {
-                RETURN { "error": "Event label not found" };
-            };
-            IF (SELECT owner FROM $label_id) != $user_id THEN {
-                RETURN { "error": "Requester is not owner" };
-            }
-            UPDATE event_label SET name = $name WHERE id = $label_id AND owner = $user_id;
-            RETURN { "message": "Event label updated successfully" };
-            """, {"name": label_name, "label_id": label_id, "user_id": user_id})
+    label_id = f"event_label:{label_id}"
+
+    result = queries.run(db, "event_labels.rename", {"name": label_name, "label_id": label_id, "user_id": user_id})
 
     if result.get("error"):
         match result["error"]:
@@ -65,6 +64,8 @@ def edit_event_label(label_id):
             case "Requester is not owner":
                 return jsonify({"error": "You do not have permission to edit this label"}), 403
 
+    revisions.bump(db, [user_id], "event_labels")
+    changelog.record(db, [user_id], upserts=[label_id])
     return jsonify({"message": "Event label updated successfully", "label": result}), 200
 
 @event_labels_bp.route('/<label_id>', methods=['DELETE'])
@@ -74,17 +75,10 @@ def delete_event_label(label_id):
     current_user = get_jwt_identity()
     user_id = f"user:{current_user}"
 
-    result = db.query("""
-            IF NOT (record::exists($label_id)) THEN {
-                RETURN { "error": "Event label not found" };
-            };
-            IF (SELECT owner FROM $label_id) != $user_id THEN {
-                RETURN { "error": "Requester is not owner" };
-            }
-            UPDATE has_access_to WHERE because_of CONTAINS $label_id SET because_of -= $label_id;
-            DELETE has_access_to WHERE because_of = [];
-            RETURN DELETE FROM event_label WHERE id = $label_id AND owner = $user_id RETURN BEFORE;
-            """)
+    label_id = f"event_label:{label_id}"
+
+    # Also takes the label off any events it was applied to
+    result = queries.run(db, "event_labels.delete", {"label_id": label_id, "user_id": user_id})
 
     if result.get("error"):
         match result["error"]:
@@ -93,4 +87,86 @@ def delete_event_label(label_id):
             case "Requester is not owner":
                 return jsonify({"error": "You do not have permission to delete this label"}), 403
 
-    return jsonify({"message": "Event label deleted successfully", "label": result}), 204
\ No newline at end of file
+    revisions.bump(db, [user_id], "event_labels")
+    if result["links"]:
+        revisions.bump(db, [user_id], "events")
+    changelog.record(db, [user_id], upserts=result["links"], deletes=[label_id])
+
+    # Whoever the label's groups reached loses that access now rather than
+    # when the fan-out worker gets to it
+    changed = {}
+    for edge in result["updated"]:
+        changed.setdefault(str(edge["out"]), []).append((str(edge["in"]), edge["id"], "updated"))
+    for edge in result["revoked"]:
+        changed.setdefault(str(edge["out"]), []).append((str(edge["in"]), edge["id"], "deleted"))
+    for event_id, edges in changed.items():
+        fanout.notify(db, event_id, edges)
+
+    return jsonify({"message": "Event label deleted successfully", "label": result["label"]}), 204
+
+@event_labels_bp.route('/<label_id>/groups', methods=['GET'])
+@jwt_required()
+def get_event_label_groups(label_id):
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    user_id = f"user:{current_user}"
+
+    label_id = f"event_label:{label_id}"
+
+    result = queries.run(db, "event_labels.groups", {"label_id": label_id, "user_id": user_id})
+
+    if isinstance(result, dict) and result.get("error"):
+        return jsonify({"error": "Event label not found"}), 404
+
+    return jsonify({"groups": result}), 200
+
+@event_labels_bp.route('/<label_id>/groups/<group_id>', methods=['PUT'])
+@jwt_required()
+def share_event_label(label_id, group_id):
+    # Shares every event the requester puts this label on with everyone
+    # they tag with the relationship label group_id
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    user_id = f"user:{current_user}"
+
+    permission = (request.get_json() or {}).get("share")
+    if permission not in SHARE_PERMISSIONS:
+        return jsonify({"error": "Valid permission is required"}), 400
+
+    label_id = f"event_label:{label_id}"
+    group_id = f"relationship_label:{group_id}"
+
+    result = queries.run(db, "event_labels.grant", {"label_id": label_id, "group_id": group_id, "user_id": user_id, "permission": permission})
+
+    if result.get("error"):
+        match result["error"]:
+            case "Event label not found":
+                return jsonify({"error": "Event label not found"}), 404
+            case "Relationship label not found":
+                return jsonify({"error": "Relationship label not found"}), 404
+
+    # The events themselves are shared in the background
+    fanout.enqueue_label(db, user_id, label_id)
+    return jsonify({"message": "Event label shared successfully", "group": result}), 202
+
+@event_labels_bp.route('/<label_id>/groups/<group_id>', methods=['DELETE'])
+@jwt_required()
+def unshare_event_label(label_id, group_id):
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    user_id = f"user:{current_user}"
+
+    label_id = f"event_label:{label_id}"
+    group_id = f"relationship_label:{group_id}"
+
+    result = queries.run(db, "event_labels.revoke", {"label_id": label_id, "group_id": group_id, "user_id": user_id})
+
+    if result.get("error"):
+        match result["error"]:
+            case "Event label not found":
+                return jsonify({"error": "Event label not found"}), 404
+            case "Group not found":
+                return jsonify({"error": "Event label is not shared with this group"}), 404
+
+    fanout.enqueue_label(db, user_id, label_id)
+    return jsonify({"message": "Event label unshared successfully", "group": result}), 202
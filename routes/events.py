@@ -1,12 +1,100 @@
 # Routes relating to events
 
-from flask import Blueprint, jsonify, request
+import heapq
+import io
+import json
+import re
+import uuid
+from datetime import datetime
+
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
 from flask_jwt_extended import get_jwt_identity, jwt_required
-
-from extensions import sdb
+from surrealdb import RecordID
+
+import changelog
+import revisions
+import sharing
+import time_budget
+from availability import parse_window
+from conflicts import POLICIES
+from extensions import conflicts, fanout, permissions, queries, sdb, webhooks
+from ical import format_calendar, parse_events
+from pagination import decode_cursor, encode_cursor, parse_limit
+from permissions import PERMISSION_RANK, SHARE_PERMISSIONS
+from surreal import SurrealQueryError
+from recurrence import expand_all, match_occurrence, parse_rrule, series_end, sort_key
 
 events_bp = Blueprint('events', __name__)
 
+# An event id as a cursor carries it; every id the app creates has this form
+EVENT_ID = re.compile(r"calendar_event:[0-9A-Za-z_]+")
+
+def validate_event(event_data):
+    # Returns an error message for invalid event data, or None
+    if not event_data:
+        return "Event data is required"
+
+    if not event_data.get("start_time") or not event_data.get("end_time"):
+        return "Start time and end time are required"
+
+    if not event_data["start_time"] < event_data["end_time"]:
+        return "Start time must be before end time"
+
+    if not event_data.get("title"):
+        return "Title is required"
+
+    try:
+        prepare_recurrence(event_data)
+    except (TypeError, ValueError, AttributeError) as e:
+        return f"Invalid recurrence: {e}"
+
+    return None
+
+def prepare_recurrence(event_data):
+    # Normalises event_data["recurrence"] in place and stores the end of the
+    # series as recurrence_end so range queries can filter series in the DB
+    recurrence = event_data.get("recurrence")
+    if not recurrence:
+        event_data["recurrence"] = None
+        event_data["recurrence_end"] = None
+        return
+
+    if isinstance(recurrence, str):
+        recurrence = {"rrule": recurrence}
+    rule = parse_rrule(recurrence.get("rrule"))
+
+    # Keys are stored as the series writes them, whatever offset they came in
+    def match(key):
+        matched = match_occurrence(rule, event_data["start_time"], key)
+        if matched is None:
+            raise ValueError(f"{key} is not an occurrence of this event")
+        return matched
+
+    exdates = sorted({match(key) for key in recurrence.get("exdates") or []})
+    overrides = {match(key): dict(delta) for key, delta in (recurrence.get("overrides") or {}).items()}
+
+    event_data["recurrence"] = {"rrule": recurrence["rrule"], "exdates": exdates, "overrides": overrides}
+    event_data["recurrence_end"] = series_end(rule, event_data["start_time"], event_data["end_time"], overrides)
+
+def get_owner(db, event_id):
+    # The owner's has_access_to edge for event_id, or None
+    owners = queries.run(db, "events.owner", {"event_id": event_id})
+    return owners[0] if owners else None
+
+def get_audience(db, event_id):
+    # Every user with any access to event_id
+    return queries.run(db, "events.audience", {"event_id": event_id})
+
+def check_conflicts(db, user_id, event, policy, exclude=None):
+    # (events event overlaps on user_id's calendar, error response) for a
+    # conflict_policy; the overlaps are None when the policy is ignore
+    if policy == "ignore":
+        return None, None
+    found = conflicts.check(db, user_id, event, exclude)
+    if found and policy == "reject":
+        return found, ({"error": "Event conflicts with existing events", "conflicts": found}, 409)
+    return found, None
+
 @events_bp.route('/', methods=['POST'])
 @jwt_required()
 def create_event():
@@ -14,34 +102,44 @@ def create_event():
     
     event_data = request.json
     user = get_jwt_identity()
-    user_id = f"user:{id}"
+    user_id = f"user:{user}"
 
-    # Check data is valid 
-    if not event_data:
-        return {"error": "Event data is required"}, 400
-    
-    if not event_data["start_time"] or not event_data["end_time"]:
-        return {"error": "Start time and end time are required"}, 400
+    policy = current_app.config["CONFLICT_POLICY"]
+    if isinstance(event_data, dict):
+        policy = event_data.pop("conflict_policy", policy)
+    if policy not in POLICIES:
+        return {"error": f"conflict_policy must be one of {', '.join(POLICIES)}"}, 400
 
-    if not event_data["start_time"] < event_data["end_time"]:
-        return {"error": "Start time must be before end time"}, 400
+    # Check data is valid 
+    error = validate_event(event_data)
+    if error:
+        return {"error": error}, 400
 
-    if not event_data["title"]:
-        return {"error": "Title is required"}, 400
+    found, error = check_conflicts(db, user_id, event_data, policy)
+    if error:
+        return error
     
     # Create event
-    event_result = db.query("CREATE calendar_event CONTENT $event_data", {"event_data": event_data})
-    full_event_id = event_result[0].id
+    event_result = queries.run(db, "events.create", {"event_data": event_data})
+    full_event_id = event_result[0]["id"]
 
     # Link user to event
-    link_result = db.query("RELATE $user->has_access_to->$calendar_event SET permission='owner', because_of=['owner'], labels=[]", {"user": user_id, "calendar_event": full_event_id})
+    link_result = queries.run(db, "events.link_owner", {"user": user_id, "calendar_event": full_event_id})
+    time_budget.record_change(db, user_id, None, event_result[0])
+    revs = revisions.bump(db, [user_id], "events")
+    conflicts.apply(user_id, full_event_id, event_result[0], revs.get(user_id))
+    changelog.record(db, [user_id], upserts=[full_event_id] + [link["id"] for link in link_result])
+    webhooks.emit(db, "event.created", [user_id], {"event": event_result[0]})
 
     # Return user and link objects
-    return {
+    response = {
         "message": "Event created successfully",
         "event": event_result,
         "link": link_result
-    }, 201
+    }
+    if found is not None:
+        response["conflicts"] = found
+    return response, 201
 
 @events_bp.route('/<event_id>', methods=['GET'])
 @jwt_required()
@@ -49,41 +147,21 @@ def get_event_by_id(event_id):
     db = sdb.get_db()
 
     user = get_jwt_identity()
-    user_id = f"user:{id}"
-    
+    user_id = f"user:{user}"
+    event_id = f"calendar_event:{event_id}"
+
     # Get event and check permissions
-    result = db.query(
-        """
-        LET $event = SELECT * FROM calendar_event WHERE id = $event_id;
-        IF $event IS NULL THEN {
-            RETURN {
-                'error': 'Not found'
-            };
-        };
-        LET $link = (SELECT * FROM has_access_to WHERE in = $user_id AND user = $event_id);
-        IF $link.permission CONTAINSNONE ['owner', 'admin', 'edit', 'view'] THEN {
-            RETURN {
-                'error': 'Insufficient permissions'
-            };
-        };
-        RETURN {
-            'event': $event,
-            'link': $link
-        };
-        """,
-        {"event_id": event_id})
-    # Handle errors
-    if result["error"]:
-        match result["error"]:
-            case 'Not found':
-                return {"error": "Event not found"}, 404
-            case 'Insufficient permissions':
-                return {"error": "User does not have access to this event"}, 403
-    # Return event and link objects
-    event, link = result["event"], result["link"]
+    event = queries.run(db, "events.get", {"event_id": event_id})
+    if not event:
+        return {"error": "Event not found"}, 404
+
+    permission = permissions.get(db, user_id, event_id)
+    if permission is None:
+        return {"error": "User does not have access to this event"}, 403
+
     return {
         "event": event,
-        "link": link
+        "permission": permission
     }, 200
 
 @events_bp.route('/<event_id>', methods=["PUT"])
@@ -91,43 +169,74 @@ def get_event_by_id(event_id):
 def update_event(event_id):
     db = sdb.get_db()
 
-    event_id = f"event:{event_id}"
+    event_id = f"calendar_event:{event_id}"
     event_data = request.json
     requester = get_jwt_identity()
     requester = f"user:{requester}"
 
+    if not isinstance(event_data, dict) or not isinstance(event_data.get("content", {}), dict):
+        return {"error": "Body must be an object with the changes under content"}, 400
+
+    policy = event_data.get("conflict_policy", current_app.config["CONFLICT_POLICY"])
+    if policy not in POLICIES:
+        return {"error": f"conflict_policy must be one of {', '.join(POLICIES)}"}, 400
+
     event_data = event_data.get("content", {})
+    event_data.pop("id", None)
+    # Only a change to when the event happens can make a new conflict
+    moved = any(field in event_data for field in ("start_time", "end_time", "recurrence", "busy"))
 
     # Check if event exists
-    result = db.query("""
-        LET $event = SELECT * FROM calendar_event WHERE id = $event_id;
-        IF $event IS NULL THEN {
-            RETURN { "error": "Event not found" };
-        };
-        LET $requester_permission = (SELECT * FROM has_access_to WHERE in = $requester AND event = $event_id);
-        IF $requester_permission = [] OR NOT (['owner', 'admin'] CONTAINS $requester_permission[0].permission) THEN {
-            RETURN { "error": "Insufficient permissions" };
-        };
-        BEGIN TRANSACTION;
-        LET $updated_event = UPDATE $event MERGE $event_data RETURN AFTER;
-        IF $updated_event.start_time > $updated_event.endtime THEN {
-            RETURN { "error": "Start time must be before end time" };
-        }
-        COMMIT TRANSACTION;
-        RETURN $updated_event;
-    """, {"event_id": event_id, "requester": requester, "event_data": event_data})
-
-    if result["error"]:
-        match result["error"]:
-            case 'Event not found':
-                return {"error": "Event not found"}, 404
-            case 'Insufficient permissions':
-                return {"error": "User does not have permission to edit this event"}, 403
-
-    return jsonify({
+    current = queries.run(db, "events.get", {"event_id": event_id})
+    if not current:
+        return {"error": "Event not found"}, 404
+
+    if permissions.get(db, requester, event_id) not in ("owner", "admin"):
+        return {"error": "User does not have permission to edit this event"}, 403
+
+    # Validate the event as it will be after the update; this also moves the
+    # end of a recurring series when the times or the rule change
+    merged = {**current, **event_data}
+    error = validate_event(merged)
+    if error:
+        return {"error": error}, 400
+    event_data["recurrence"] = merged["recurrence"]
+    event_data["recurrence_end"] = merged["recurrence_end"]
+
+    # Conflicts are with the rest of the owner's calendar
+    owner = get_owner(db, event_id)
+    found, error = None, None
+    if owner and moved:
+        found, error = check_conflicts(db, owner["in"], merged, policy, event_id)
+    if error:
+        return error
+
+    # The owner's time budget is written with the event
+    budget = time_budget.change_rows(owner["in"], current, merged, owner.get("labels")) if owner else []
+    result = queries.run(db, "events.update", {
+        "event_id": event_id,
+        "event_data": event_data,
+        "timing": {field: current.get(field) for field in time_budget.TIMING_FIELDS},
+        "budget": budget,
+    })[-1]
+    if result.get("error"):
+        return {"error": "Event was changed by another request, try again"}, 409
+    result = result["event"]
+
+    audience = get_audience(db, event_id)
+    revs = revisions.bump(db, audience, "events")
+    if owner:
+        conflicts.apply(owner["in"], event_id, result, revs.get(str(owner["in"])))
+    changelog.record(db, audience, upserts=[event_id])
+    webhooks.emit(db, "event.updated", audience, {"event": result})
+
+    response = {
         "message": "Event updated successfully",
         "event": result
-    }), 200
+    }
+    if found is not None:
+        response["conflicts"] = found
+    return jsonify(response), 200
 
 @events_bp.route('/<event_id>', methods=['DELETE'])
 @jwt_required()
@@ -135,34 +244,31 @@ def delete_event(event_id):
     db = sdb.get_db()
 
     user = get_jwt_identity()
-    user_id = f"user:{id}"
-
-    result = db.query(
-        """
-        IF !record::exists($event) THEN {
-            RETURN {
-                'error': 'Not found'
-            };
-        };
-        IF (SELECT * FROM has_access_to WHERE user = $user_id AND in = $event_id).permission CONTAINS 'owner' THEN {
-            LET $event = DELETE FROM calendar_event WHERE id = $event_id RETURN BEFORE;
-            RETURN $event;
-        } ELSE {
-            RETURN {
-                'error': 'Insufficient permissions'
-            };
-        };
-        """,
-        {"event_id": event_id, "user_id": user_id}
-    )
+    user_id = f"user:{user}"
+    event_id = f"calendar_event:{event_id}"
+
+    owner = get_owner(db, event_id)
+    if not owner:
+        return {"error": "Event not found"}, 404
+    if str(owner["in"]) != user_id:
+        return {"error": "User does not have permission to delete this event"}, 403
+
+    # Deleting the event also removes its has_access_to edges
+    links = queries.run(db, "events.links", {"event_id": event_id})
+    audience = [link["in"] for link in links]
+    result = queries.run(db, "events.delete", {"event_id": event_id})
+    permissions.invalidate(event_id=event_id)
+    if result:
+        time_budget.record_change(db, owner["in"], result[0], None, owner.get("labels"))
+        revs = revisions.bump(db, audience, "events")
+        conflicts.apply(owner["in"], event_id, None, revs.get(str(owner["in"])))
+        changelog.record_many(db, [
+            entry
+            for link in links
+            for entry in ((link["in"], event_id, "delete"), (link["in"], link["id"], "delete"))
+        ])
+        webhooks.emit(db, "event.deleted", audience, {"event": result[0]})
 
-    if result["error"]:
-        match result["error"]:
-            case 'Not found':
-                return {"error": "Event not found"}, 404
-            case 'Insufficient permissions':
-                return {"error": "User does not have permission to delete this event"}, 403
-            
     return {
         "message": "Event deleted successfully",
         "event": result
@@ -170,94 +276,378 @@ def delete_event(event_id):
 
 @events_bp.route('/owned-by/<user_id>', methods=['GET'])
 @jwt_required()
+@revisions.conditional("events")
 def get_events_by_user(user_id):
     db = sdb.get_db()
 
     requester_id = get_jwt_identity()
     requester_id = f"user:{requester_id}"
+    user_id = f"user:{user_id}"
 
-    result = db.query(
-        """
-        IF !record::exists($user_id) THEN {
-                    RETURN {
-                'error': 'Not found'
-            };
-        };
-        LET $events = SELECT ->has_access_to(WHERE permission = 'owner')->event<-has_access_to<-user(WHERE id = $requester_id) FROM $user_id;
-        RETURN $events;
-        """,
-        {"user_id": user_id, "requester_id": requester_id}
-    )
+    if not queries.run(db, "events.user_exists", {"user_id": user_id}):
+        return {"error": "User not found"}, 404
 
-    if result["error"]:
-        match result["error"]:
-            case 'Not found':
-                return {"error": "User not found"}, 404
+    # Events owned by user_id that the requester can also see
+    result = queries.run(db, "events.owned_by", {"user_id": user_id, "requester_id": requester_id})
 
     return {
         "events": result
     }, 200
 
-@events_bp.route('/<event_id>/share', methods=['POST'])
+@events_bp.route('/', methods=['GET'])
 @jwt_required()
-def share_event(event_id):
+def get_events_in_range():
+    db = sdb.get_db()
+
+    requester = get_jwt_identity()
+    user_id = f"user:{requester}"
+
+    range_from = request.args.get("from")
+    range_to = request.args.get("to")
+    if not range_from or not range_to:
+        return {"error": "from and to are required"}, 400
+
+    try:
+        if datetime.fromisoformat(range_from) >= datetime.fromisoformat(range_to):
+            return {"error": "from must be before to"}, 400
+    except (TypeError, ValueError):
+        return {"error": "from and to must be ISO 8601 datetimes"}, 400
+
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        after_start, after_id = None, None
+        if request.args.get("cursor"):
+            after_start, after_id = decode_cursor(request.args["cursor"], 2)
+            # after_id is cast to a record in the query
+            if not isinstance(after_start, str) or not isinstance(after_id, str) or not EVENT_ID.fullmatch(after_id):
+                raise ValueError("Invalid cursor")
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    params = {
+        "user_id": user_id,
+        "from": range_from,
+        "to": range_to,
+        "after_start": after_start,
+        "after_id": after_id,
+        "limit": limit + 1,
+    }
+
+    # Single events are paged in the DB in (start_time, id) order to match
+    # the cursor
+    single_events = queries.run(db, "events.range_single", params)
+
+    # Recurring series are stored once, so there are few of them; their
+    # occurrences are expanded lazily and merged into the same order
+    series = queries.run(db, "events.range_series", params)
+
+    events = []
+    for event in heapq.merge(single_events, expand_all(series, range_from, range_to), key=sort_key):
+        if after_start is not None and sort_key(event) <= (after_start, after_id):
+            continue
+        events.append(event)
+        if len(events) > limit:
+            break
+
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor(*sort_key(events[-1]))
+
+    return jsonify({
+        "events": events,
+        "next_cursor": next_cursor
+    }), 200
+
+@events_bp.route('/conflicts', methods=['GET'])
+@jwt_required()
+def get_conflicts():
+    # The requester's busy events overlapping [from, to), e.g. to warn
+    # before proposing a time; exclude leaves out the event being moved
+    db = sdb.get_db()
+
+    requester = get_jwt_identity()
+    user_id = f"user:{requester}"
+
+    range_from = request.args.get("from")
+    range_to = request.args.get("to")
+    if not range_from or not range_to:
+        return {"error": "from and to are required"}, 400
+
+    try:
+        parse_window(range_from, range_to)
+    except (TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+
+    exclude = f"calendar_event:{request.args['exclude']}" if request.args.get("exclude") else None
+    result = conflicts.overlapping(db, user_id, range_from, range_to, exclude)
+
+    return jsonify({
+        "conflicts": result,
+        "count": len(result)
+    }), 200
+
+@events_bp.route('/import', methods=['POST'])
+@jwt_required()
+def import_events():
+    # Streams an uploaded .ics or NDJSON body, validating each record with
+    # the same rules as create_event and writing events and their owner
+    # edges in batched transactions. Progress and per-record errors are
+    # streamed back as NDJSON.
+    requester = get_jwt_identity()
+    user_id = RecordID("user", requester)
+    batch_size = current_app.config.get("EVENTS_IMPORT_BATCH", 500)
+
+    if request.mimetype in ("text/calendar", "text/ics"):
+        records = parse_events(io.TextIOWrapper(request.stream, encoding="utf-8", errors="replace"))
+    elif request.mimetype in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        records = _parse_ndjson(io.TextIOWrapper(request.stream, encoding="utf-8", errors="replace"))
+    else:
+        return {"error": "Body must be text/calendar or application/x-ndjson"}, 415
+
+    def generate():
+        db = sdb.get_db()
+        processed, imported, failed = 0, 0, 0
+        batch = []
+
+        def flush():
+            events = [event for _, event in batch]
+            links = [
+                {"id": RecordID("has_access_to", uuid.uuid4().hex), "in": user_id, "out": event["id"], "permission": "owner", "because_of": ["owner"], "labels": []}
+                for event in events
+            ]
+            queries.run(db, "events.import_batch", {"events": events, "links": links})
+            time_budget.record_created(db, user_id, events)
+            conflicts.invalidate(user_id)
+            revisions.bump(db, [user_id], "events")
+            changelog.record(db, [user_id], upserts=[event["id"] for event in events] + [link["id"] for link in links])
+            webhooks.emit_many(db, "event.created", [user_id], [{"event": event} for event in events])
+
+        for record_number, event_data, error in records:
+            processed += 1
+            if not error:
+                if not isinstance(event_data, dict):
+                    error = "Record must be an object"
+                else:
+                    event_data.pop("id", None)
+                    error = validate_event(event_data)
+            if error:
+                failed += 1
+                yield _ndjson({"type": "error", "record": record_number, "error": error})
+                continue
+
+            event_data["id"] = RecordID("calendar_event", uuid.uuid4().hex)
+            batch.append((record_number, event_data))
+            if len(batch) >= batch_size:
+                try:
+                    flush()
+                    imported += len(batch)
+                except SurrealQueryError as e:
+                    failed += len(batch)
+                    yield _ndjson({"type": "error", "records": [number for number, _ in batch], "error": str(e)})
+                batch = []
+                yield _ndjson({"type": "progress", "processed": processed, "imported": imported, "failed": failed})
+
+        if batch:
+            try:
+                flush()
+                imported += len(batch)
+            except SurrealQueryError as e:
+                failed += len(batch)
+                yield _ndjson({"type": "error", "records": [number for number, _ in batch], "error": str(e)})
+
+        yield _ndjson({"type": "done", "processed": processed, "imported": imported, "failed": failed})
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@events_bp.route('/export', methods=['GET'])
+@jwt_required()
+def export_events():
+    # Streams every event the requester can see, one keyset page at a time
+    requester = get_jwt_identity()
+    user_id = f"user:{requester}"
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in ("ics", "ndjson"):
+        return {"error": "format must be ics or ndjson"}, 400
+    page_size = current_app.config.get("EVENTS_EXPORT_PAGE", 500)
+
+    def events():
+        db = sdb.get_db()
+        after_start, after_id = None, None
+        while True:
+            page = queries.run(db, "events.export_page", {
+                "user_id": user_id,
+                "after_start": after_start,
+                "after_id": after_id,
+                "limit": page_size
+            })
+            yield from page
+            if len(page) < page_size:
+                return
+            after_start, after_id = page[-1]["start_time"], str(page[-1]["id"])
+
+    if export_format == "ics":
+        body = format_calendar(events())
+        mimetype = "text/calendar"
+    else:
+        body = (_ndjson(event) for event in events())
+        mimetype = "application/x-ndjson"
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=events.{export_format}"}
+    )
+
+def _parse_ndjson(lines):
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line), None
+        except ValueError:
+            yield number, None, "Invalid JSON"
+
+def _ndjson(data):
+    return current_app.json.dumps(data) + "\n"
+
+@events_bp.route('/<event_id>/occurrences/<recurrence_id>', methods=['PUT'])
+@jwt_required()
+def override_occurrence(event_id, recurrence_id):
+    return _edit_occurrence(event_id, recurrence_id, (request.json or {}).get("content", {}))
+
+@events_bp.route('/<event_id>/occurrences/<recurrence_id>', methods=['DELETE'])
+@jwt_required()
+def cancel_occurrence(event_id, recurrence_id):
+    return _edit_occurrence(event_id, recurrence_id, None)
+
+def _edit_occurrence(event_id, recurrence_id, delta):
+    # Exceptions are stored on the series as sparse deltas: a cancelled
+    # occurrence becomes an exdate, an edited one an override
     db = sdb.get_db()
 
     requester = get_jwt_identity()
     requester = f"user:{requester}"
+    event_id = f"calendar_event:{event_id}"
+
+    event = queries.run(db, "events.get", {"event_id": event_id})
+    if not event:
+        return {"error": "Event not found"}, 404
+
+    if PERMISSION_RANK.get(permissions.get(db, requester, event_id), 0) < PERMISSION_RANK["edit"]:
+        return {"error": "User does not have permission to edit this event"}, 403
+
+    recurrence = event.get("recurrence")
+    if not recurrence:
+        return {"error": "Event is not recurring"}, 400
+
+    try:
+        key = match_occurrence(parse_rrule(recurrence["rrule"]), event["start_time"], recurrence_id)
+        if key is None:
+            return {"error": "Occurrence not found"}, 404
+    except ValueError:
+        return {"error": "Occurrence id must be the ISO 8601 start of the occurrence"}, 400
+
+    before = dict(event)
+    recurrence = dict(recurrence)
+    recurrence["overrides"] = dict(recurrence.get("overrides") or {})
+    if delta is None:
+        recurrence["exdates"] = sorted(set(recurrence.get("exdates") or []) | {key})
+        recurrence["overrides"].pop(key, None)
+    else:
+        delta = {field: value for field, value in delta.items() if field not in ("id", "recurrence", "recurrence_end")}
+        recurrence["overrides"] = {**(recurrence.get("overrides") or {}), key: delta}
+
+    event["recurrence"] = recurrence
+    try:
+        prepare_recurrence(event)
+    except (TypeError, ValueError, AttributeError) as e:
+        return {"error": f"Invalid override: {e}"}, 400
+
+    result = queries.run(db, "events.set_recurrence", {
+        "event_id": event_id,
+        "recurrence": event["recurrence"],
+        "recurrence_end": event["recurrence_end"]
+    })
 
-    shares = []
+    owner = get_owner(db, event_id)
+    if owner:
+        time_budget.record_change(db, owner["in"], before, result, owner.get("labels"))
+    audience = get_audience(db, event_id)
+    revs = revisions.bump(db, audience, "events")
+    if owner:
+        conflicts.apply(owner["in"], event_id, result, revs.get(str(owner["in"])))
+    changelog.record(db, audience, upserts=[event_id])
+    webhooks.emit(db, "event.updated", audience, {"event": result})
+
+    return jsonify({
+        "message": "Occurrence updated successfully",
+        "event": result
+    }), 200
 
-    event_id = f"event:{event_id}"
-    data = request.json
+def _share_targets(data, with_permission):
+    # Parses the shares and groups lists of a share/unshare body into
+    # {user id: permission} and {label id: permission}, or returns an error
+    users, labels = {}, {}
     for share in data.get("shares", []):
-        user_id = share['user_id']
-        permission = share['share']
-
-        if not user_id or not permission or permission not in ['admin', 'edit', 'view']:
-            return {"error": "User ID and valid permission are required"}, 400
-        user_id = f"user:{user_id}"
-        shares.append({"user_id": user_id, "permission": permission})
-
-    result = db.query("""
-        IF !record::exists($event_id) THEN {
-            RETURN { "error": "Event not found" };
-        };
-        LET $requester_permission = (SELECT * FROM has_access_to WHERE in = $requester AND event = $event_id);
-        IF $requester_permission = [] OR NOT (['owner', 'admin'] CONTAINS $requester_permission) THEN {
-            RETURN { "error": "Insufficient permissions" };
-        };
-        LET $links = [];
-        FOR $share IN $shares {
-            IF !record::exists($share.user_id) THEN {
-                LET $links = array::append($links, { "error": "User $share.user_id not found" });
-                CONTINUE;
-            };
-            LET $existing = (SELECT * FROM has_access_to WHERE user = $share.user_id AND event = $event_id);
-            IF $existing = [] THEN {
-                LET $link = (RELATE ONLY $share.user_id->has_access_to->$event_id SET permission = $share.permission SET because_of = 'direct invite');
-                LET $links = array::append($links, $link);
-                CONTINUE;
-            };
-            IF $existing[0].permission = 'owner' THEN {
-                RETURN { "error": "User has higher permission" };
-            }
-            LET $updated = (UPDATE ONLY $existing[0].id SET permission = $share.permission);
-            LET $links = array::append($links, $updated);
-        };
-        RETURN $links;
-    """, {"requester": requester, "event_id": event_id, "shares": shares})
-
-    if result["error"]:
-        match result["error"]:
-            case 'Event not found':
-                return {"error": "Event not found"}, 404
-            case 'Insufficient permissions':
-                return {"error": "User does not have permission to share this event"}, 403
+        if not share.get("user_id") or (with_permission and share.get("share") not in SHARE_PERMISSIONS):
+            return None, None, "User ID and valid permission are required" if with_permission else "User ID is required"
+        users[f"user:{share['user_id']}"] = share.get("share")
+    for group in data.get("groups", []):
+        if not group.get("label_id") or (with_permission and group.get("share") not in SHARE_PERMISSIONS):
+            return None, None, "Label ID and valid permission are required" if with_permission else "Label ID is required"
+        labels[f"relationship_label:{group['label_id']}"] = group.get("share")
+    if not users and not labels:
+        return None, None, "shares or groups are required"
+    return users, labels, None
+
+def _check_can_share(db, requester, event_id):
+    permission = permissions.get(db, requester, event_id)
+    if permission is None and get_owner(db, event_id) is None:
+        return {"error": "Event not found"}, 404
+    if permission not in ("owner", "admin"):
+        return {"error": "User does not have permission to share this event"}, 403
+    return None
+
+@events_bp.route('/<event_id>/share', methods=['POST'])
+@jwt_required()
+def share_event(event_id):
+    db = sdb.get_db()
+
+    requester = get_jwt_identity()
+    requester = f"user:{requester}"
+    event_id = f"calendar_event:{event_id}"
+
+    users, labels, error = _share_targets(request.json or {}, with_permission=True)
+    if error:
+        return {"error": error}, 400
+    error = _check_can_share(db, requester, event_id)
+    if error:
+        return error
+
+    found, groups, errors = sharing.resolve_targets(db, requester, users, labels)
+    results = sharing.share(
+        db,
+        event_id,
+        {user_id: permission for user_id, permission in users.items() if user_id in found},
+        {label_id: (labels[label_id], members - {requester}) for label_id, members in groups.items()}
+    )
+    results.update({target: {"status": "error", "error": message} for target, message in errors.items()})
+
+    changed = [user_id for user_id, result in results.items() if result["status"] in ("created", "updated")]
+    permissions.invalidate(changed, event_id)
+    if changed:
+        revisions.bump(db, [requester] + changed, "events")
+        changelog.record_many(db, [
+            entry
+            for user_id in changed
+            for entry in ((user_id, event_id, "upsert"), (user_id, results[user_id]["link"], "upsert"))
+        ])
+        webhooks.emit(db, "event.shared", [requester] + changed, {"event": event_id, "users": changed})
 
     return jsonify({
-        "links": result
-    })
+        "results": [{"id": target, **result} for target, result in results.items()]
+    }), 200
 
 @events_bp.route('/<event_id>/share', methods=['DELETE'])
 @jwt_required()
@@ -266,78 +656,58 @@ def unshare_event(event_id):
 
     requester = get_jwt_identity()
     requester = f"user:{requester}"
-
-    event_id = f"event:{event_id}"
-    data = request.json
-    shares = []
-    for share in data.get("shares", []):
-        user_id = share['user_id']
-        if not user_id:
-            return {"error": "User ID is required"}, 400
-        user_id = f"user:{user_id}"
-        shares.append({"user_id": user_id})
-
-    result = db.query("""
-        IF !record::exists($event_id) THEN {
-            RETURN { "error": "Event not found" };
-        };
-        LET $requester_permission = (SELECT * FROM has_access_to WHERE in = $requester AND event = $event_id);
-        IF $requester_permission = [] OR NOT (['owner', 'admin'] CONTAINS $requester_permission[0].permission) THEN {
-            RETURN { "error": "Insufficient permissions" };
-        };
-        LET $links = [];
-        FOR $share IN $shares {
-            IF !record::exists($share.user_id) THEN {
-                LET $links = array::append($links, { "error": "User $share.user_id not found" });
-                CONTINUE;
-            };
-            LET $existing = (SELECT * FROM has_access_to WHERE user = $share.user_id AND event = $event_id);
-            IF $existing = [] THEN {
-                RETURN { "error": "Share not found };
-            };
-            IF $existing[0].permission = 'owner' THEN {
-                RETURN { "error": "User has higher permission" };
-            }
-            LET $deleted = (DELETE ONLY $existing[0].id);
-            LET $links = array::append($links, $deleted);
-        };
-        RETURN $links;
-    """, {"requester": requester, "event_id": event_id, "shares": shares})
-
-    if result["error"]:
-        match result["error"]:
-            case 'Event not found':
-                return {"error": "Event not found"}, 404
-            case 'Insufficient permissions':
-                return {"error": "User does not have edit permissions on this event"}, 403
+    event_id = f"calendar_event:{event_id}"
+
+    users, labels, error = _share_targets(request.json or {}, with_permission=False)
+    if error:
+        return {"error": error}, 400
+    error = _check_can_share(db, requester, event_id)
+    if error:
+        return error
+
+    found, groups, errors = sharing.resolve_targets(db, requester, users, labels)
+    results = sharing.unshare(
+        db,
+        event_id,
+        [user_id for user_id in users if user_id in found],
+        {label_id: members - {requester} for label_id, members in groups.items()}
+    )
+    results.update({target: {"status": "error", "error": message} for target, message in errors.items()})
+
+    changed = [user_id for user_id, result in results.items() if result["status"] in ("updated", "deleted")]
+    permissions.invalidate(changed, event_id)
+    if changed:
+        revisions.bump(db, [requester] + changed, "events")
+        changelog.record_many(db, [
+            (user_id, results[user_id]["link"], "upsert")
+            for user_id in changed if results[user_id]["status"] == "updated"
+        ] + [
+            entry
+            for user_id in changed if results[user_id]["status"] == "deleted"
+            for entry in ((user_id, event_id, "delete"), (user_id, results[user_id]["link"], "delete"))
+        ])
+        webhooks.emit(db, "event.unshared", [requester] + changed, {"event": event_id, "users": changed})
 
     return jsonify({
-        "links": result
-    })
+        "results": [{"id": target, **result} for target, result in results.items()]
+    }), 200
 
 @events_bp.route('/<event_id>/share', methods=['GET'])
-@jwt_required
+@jwt_required()
 def get_shares_by_event(event_id):
     db = sdb.get_db()
-    event_id = f"event:{event_id}"
-
-    result = db.query("""
-        IF !record::exists($event_id) THEN {
-            RETURN { "error": "Event not found" };
-        };
-        LET $requester_permission = (SELECT * FROM has_access_to WHERE user = $requester AND event = $event_id);
-        IF $requester_permission = [] OR NOT (['owner', 'admin'] CONTAINS $requester_permission[0].permission.) THEN {
-            RETURN { "error": "Insufficient permissions" };
-        };
-        RETURN (SELECT * FROM has_access_to WHERE event = $event_id);
-    """, {"event_id": event_id})
-
-    if result["error"]:
-        match result["error"]:
-            case 'Event not found':
-                return {"error": "Event not found"}, 404
-            case 'Insufficient permissions':
-                return {"error": "User does not have permission to view shares for this event"}, 403
+
+    requester = get_jwt_identity()
+    requester = f"user:{requester}"
+    event_id = f"calendar_event:{event_id}"
+
+    permission = permissions.get(db, requester, event_id)
+    if permission is None and get_owner(db, event_id) is None:
+        return {"error": "Event not found"}, 404
+    if permission not in ("owner", "admin"):
+        return {"error": "User does not have permission to view shares for this event"}, 403
+
+    result = queries.run(db, "events.shares", {"event_id": event_id})
 
     return jsonify({
         "links": result
@@ -349,35 +719,58 @@ def get_share_by_event_and_user(event_id, user_id):
     db = sdb.get_db()
 
     requesting_user = get_jwt_identity()
-    event_id = f"event:{event_id}"
+    requesting_user = f"user:{requesting_user}"
+    event_id = f"calendar_event:{event_id}"
     user_id = f"user:{user_id}"
 
-    result = db.query("""
-        IF !record::exists($event_id) THEN {
-            RETURN { "error": "Event not found" };
-        };
-        IF !record::exists($user_id) THEN {
-            RETURN { "error": "User not found" };
-        };
-        IF $requesting_user = $user_id THEN {
-            RETURN (SELECT * FROM has_access_to WHERE event = $event_id AND user = $user_id);
-        };
-        LET $requesting_user_permission = (SELECT * FROM has_access_to WHERE user = $requesting_user AND event = $event_id);
-        IF $requesting_user != $user_id AND ($requesting_user_permission != [] OR NOT (['owner', 'admin'] CONTAINS $requesting_user_permission[0].permission)) THEN {
-            RETURN { "error": "User does not have permission to view this share" };
-        };
-    """, {"event_id": event_id, "user_id": user_id})
-
-    if result["error"]:
-        match result["error"]:
-            case 'Event not found':
-                return {"error": "Event not found"}, 404
-            case 'User not found':
-                return {"error": "User not found"}, 404
-            case 'Insufficient permissions':
-                return {"error": "User does not have permission to view this share"}, 403
+    if requesting_user != user_id:
+        permission = permissions.get(db, requesting_user, event_id)
+        if permission is None and get_owner(db, event_id) is None:
+            return {"error": "Event not found"}, 404
+        if permission not in ("owner", "admin"):
+            return {"error": "User does not have permission to view this share"}, 403
+
+    result = queries.run(db, "events.share_for_user", {"user_id": user_id, "event_id": event_id})
+    if not result:
+        return {"error": "Share not found"}, 404
 
     return jsonify({
         "links": result
     })
 
+@events_bp.route('/<event_id>/labels', methods=['PUT'])
+@jwt_required()
+def set_event_labels(event_id):
+    # Labels are the requester's own; on an event they own, the relationship
+    # label groups the labels are shared with get access in the background
+    db = sdb.get_db()
+
+    requester = get_jwt_identity()
+    requester = f"user:{requester}"
+    event_id = f"calendar_event:{event_id}"
+
+    label_ids = (request.json or {}).get("label_ids")
+    if not isinstance(label_ids, list):
+        return {"error": "label_ids is required"}, 400
+    label_ids = list(dict.fromkeys(f"event_label:{label_id}" for label_id in label_ids))
+
+    result = queries.run(db, "events.set_labels", {"user_id": requester, "event_id": event_id, "label_ids": label_ids})
+
+    if result.get("error"):
+        match result["error"]:
+            case "Event not found":
+                return {"error": "Event not found"}, 404
+            case "Event label not found":
+                return {"error": "Event label not found"}, 404
+
+    if result["permission"] == "owner":
+        event = queries.run(db, "events.get", {"event_id": event_id})
+        time_budget.record_change(db, requester, event, event, label_ids, result["before"])
+        fanout.enqueue_events(db, [event_id])
+    revisions.bump(db, [requester], "events")
+    changelog.record(db, [requester], upserts=[result["link"]])
+
+    return jsonify({
+        "message": "Event labels updated successfully",
+        "labels": label_ids
+    }), 200
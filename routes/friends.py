@@ -3,48 +3,100 @@
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import get_jwt_identity, jwt_required
 
-from extensions import sdb
+import revisions
+from extensions import fanout, queries, sdb, social_graph, suggestions
+from pagination import decode_cursor, encode_cursor, parse_limit
 
 social_bp = Blueprint('social', __name__)
 
-@social_bp.route('/friends', methods=['GET'])
-@jwt_required()
-def get_friends():
+def list_relationships(kind):
+    # One page of the requester's edges of kind, ordered by the other
+    # user's id, plus the total; the ids come from the cached graph and
+    # only the page's edges are read
     db = sdb.get_db()
 
     user = get_jwt_identity()
     user_id = f"user:{user}"
 
-    result = db.query(
-        """
-        LET $friends = SELECT * FROM relationship_with WHERE in = $user_id AND type = 'friends';
-        RETURN $friends;
-        """,
-        {"user_id": user_id}
-    )
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        after = decode_cursor(request.args["cursor"], 1)[0] if request.args.get("cursor") else None
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    edge_ids, last = social_graph.page(db, user_id, kind, after, limit)
+    result = queries.run(db, "social.edges", {"ids": edge_ids}) if edge_ids else []
 
     return {
-        "friends": result
+        kind: result,
+        "count": social_graph.count(db, user_id, kind),
+        "next_cursor": encode_cursor(last) if last else None
     }, 200
 
+@social_bp.route('/friends', methods=['GET'])
+@jwt_required()
+@revisions.conditional("social")
+def get_friends():
+    return list_relationships("friends")
+
 @social_bp.route('/following', methods=['GET'])
 @jwt_required()
+@revisions.conditional("social")
 def get_following():
+    return list_relationships("following")
+
+@social_bp.route('/counts', methods=['GET'])
+@jwt_required()
+@revisions.conditional("social")
+def get_counts():
     db = sdb.get_db()
 
     user = get_jwt_identity()
     user_id = f"user:{user}"
 
-    result = db.query(
-        """
-        LET $following = SELECT * FROM relationship_with WHERE in = $user_id AND (type = 'following' OR type = 'friends');
-        RETURN $following;
-        """,
-        {"user_id": user_id}
-    )
+    return {
+        kind: social_graph.count(db, user_id, kind)
+        for kind in ("following", "followers", "friends", "blocked")
+    }, 200
+
+@social_bp.route('/suggestions', methods=['GET'])
+@jwt_required()
+def get_suggestions():
+    db = sdb.get_db()
+
+    user = get_jwt_identity()
+    user_id = f"user:{user}"
+
+    try:
+        limit = parse_limit(request.args.get("limit"), default=20, maximum=100)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    # partial means the walk ran out of time or neighbours to look at
+    result, partial = suggestions.suggest(db, user_id, limit)
 
     return {
-        "following": result
+        "suggestions": result,
+        "partial": partial
+    }, 200
+
+@social_bp.route('/mutual/<user_id>', methods=['GET'])
+@jwt_required()
+def get_mutual_friends(user_id):
+    db = sdb.get_db()
+
+    user = get_jwt_identity()
+    requester_id = f"user:{user}"
+    target_user_id = f"user:{user_id}"
+
+    if "blocked" in social_graph.relation(db, requester_id, target_user_id):
+        return {"error": "Cannot view mutual friends with this user"}, 403
+
+    result = suggestions.mutual_friends(db, requester_id, target_user_id)
+
+    return {
+        "mutual_friends": result,
+        "count": len(result)
     }, 200
 
 @social_bp.route('/following', methods=['POST'])
@@ -62,28 +114,28 @@ def follow_user():
         return {"error": "Target user ID is required"}, 400
     target_user_id = f"user:{target_user_id}"
 
-    # Create a following relationship
-    result = db.query(
-        """
-        IF NOT (record::exists($target_user_id)) THEN {
-            RETURN {"error": "Target user does not exist"};
-        };
-        LET $reverse_relation = SELECT * FROM relationship_with WHERE in = $target_user_id AND out = $requester_id;
-        IF $reverse_relation != [] AND $reverse_relation[0].type == 'blocked' THEN {
-            RETURN {"error": "Requester blocked by target"};
-        };
-        RELATE ONLY $requester_id->relationship_with->($target_user_id) SET type = 'following', labels = [];
-        """,
-        {"requester_id": requester_id, "target_user_id": target_user_id}
-    )
-
-    if result["error"]:
+    if social_graph.is_blocked_by(db, requester_id, target_user_id):
+        return {"error": "You have been blocked by target"}, 403
+
+    # Create a following relationship, or return the one there is
+    result = queries.run(db, "social.follow", {"requester_id": requester_id, "target_user_id": target_user_id})
+
+    if result.get("error"):
         match result["error"]:
             case "Target user does not exist":
                 return {"error": "Target user does not exist"}, 404
             case "Requester blocked by target":
                 return {"error": "You have been blocked by target"}, 403
-
+            case "Requester blocked target":
+                return {"error": "Unblock this user before following them"}, 409
+
+    social_graph.apply(requester_id, target_user_id, result["type"], result["id"])
+    suggestions.followed(db, requester_id, target_user_id)
+    # Following back turned the target's follow into a friendship too
+    if result["type"] == "friends":
+        social_graph.apply(target_user_id, requester_id, "friends")
+        suggestions.befriended(db, requester_id, target_user_id)
+    revisions.bump(db, [requester_id, target_user_id], "social")
     return {
         "message": "Successfully followed user",
         "relationship": result}, 201
@@ -97,45 +149,30 @@ def unfollow_user(user_id):
     requester_id = f"user:{user}"
     target_user_id = f"user:{user_id}"
 
-    result = db.query(
-        """
-        LET $relationship = SELECT * FROM relationship_with WHERE in = $requester_id AND out = $target_user_id;
-        IF $relationship == [] THEN {
-            RETURN {"error": "Requester not following target"};
-        };
-        RETURN DELETE $relationship RETURN AFTER;
-        """,
-        {"requester_id": requester_id, "target_user_id": target_user_id}
-    )
-
-    if result["error"]:
+    result = queries.run(db, "social.unfollow", {"requester_id": requester_id, "target_user_id": target_user_id})
+
+    if result.get("error"):
         match result["error"]:
             case "Requester not following target":
                 return {"error": "You are not following this user"}, 404
 
+    # Unfollowing a friend leaves them following the requester
+    social_graph.apply(requester_id, target_user_id, None)
+    if result["type"] == "friends":
+        social_graph.apply(target_user_id, requester_id, "following")
+    suggestions.invalidate(requester_id, target_user_id)
+    if result.get("labels"):
+        fanout.enqueue_members(db, requester_id, [target_user_id])
+    revisions.bump(db, [requester_id, target_user_id], "social")
     return {
         "message": "Successfully unfollowed user",
         "relationship": result}, 200
 
 @social_bp.route('/followers', methods=['GET'])
 @jwt_required()
+@revisions.conditional("social")
 def get_followers():
-    db = sdb.get_db()
-
-    user = get_jwt_identity()
-    user_id = f"user:{user}"
-
-    result = db.query(
-        """
-        LET $followers = SELECT * FROM relationship_with WHERE in = $user_id AND (type = 'follower' OR type = 'friends');
-        RETURN $followers;
-        """,
-        {"user_id": user_id}
-    )
-
-    return {
-        "followers": result
-    }, 200
+    return list_relationships("followers")
 
 @social_bp.route('/followers/<user_id>', methods=['DELETE'])
 @jwt_required()
@@ -146,31 +183,23 @@ def remove_follower(user_id):
     requester_id = f"user:{user}"
     target_user_id = f"user:{user_id}"
 
-    result = db.query(
-        """
-        IF NOT (record::exists($target_user_id)) THEN {
-            RETURN {"error": "Target user does not exist"};
-        };
-        LET $relationship = SELECT * FROM relationship_with WHERE in = $target_user_id AND out = $requester_id;
-        IF $relationship == [] OR $relationship[0].type = 'blocked' THEN {
-            RETURN {"error": "Target is not following requester"};
-        };
-        LET $reverse_relationship = SELECT * FROM relationship_with WHERE in = $requester_id AND out = $target_user_id;
-        IF $reverse_relationship != [] AND $reverse_relationship[0].type = 'friends' THEN {
-            UPDATE ONLY $reverse_relationship SET type = 'follows';
-        };
-        RETURN DELETE $relationship RETURN AFTER;
-        """,
-        {"requester_id": requester_id, "target_user_id": target_user_id}
-    )
-
-    if result["error"]:
+    result = queries.run(db, "social.remove_follower", {"requester_id": requester_id, "target_user_id": target_user_id})
+
+    if result.get("error"):
         match result["error"]:
             case "Target user does not exist":
                 return {"error": "Target user does not exist"}, 404
             case "Target is not following user":
                 return {"error": "Target is not following user"}, 404
 
+    # Removing a friend's follow leaves the requester following them
+    social_graph.apply(target_user_id, requester_id, None)
+    if result["type"] == "friends":
+        social_graph.apply(requester_id, target_user_id, "following")
+    suggestions.invalidate(requester_id, target_user_id)
+    if result.get("labels"):
+        fanout.enqueue_members(db, target_user_id, [requester_id])
+    revisions.bump(db, [requester_id, target_user_id], "social")
     return {
         "message": "Successfully unfollowed user",
         "relationship": result
@@ -185,29 +214,19 @@ def remove_friend(user_id):
     requester_id = f"user:{user}"
     target_user_id = f"user:{user_id}"
 
-    result = db.query(
-        """
-        IF NOT (record::exists($target_user_id)) THEN {
-            RETURN {"error": "Target user does not exist"};
-        };
-        LET $relationship = SELECT * FROM relationship_with WHERE in = $requester_id AND out = $target_user_id;
-        IF $relationship == [] OR $relationship[0].type != 'friends' THEN {
-            RETURN {"error": "Target is not friends with requester"};
-        };
-        LET $reverse_relationship = SELECT * FROM relationship_with WHERE in = $target_user_id AND out = $requester_id;
-        UPDATE ONLY $reverse_relationship.id SET type = 'follows';
-        UPDATE ONLY $relationship.id SET type = 'follows';
-        """,
-        {"requester_id": requester_id, "target_user_id": target_user_id}
-    )
-
-    if result["error"]:
+    result = queries.run(db, "social.remove_friend", {"requester_id": requester_id, "target_user_id": target_user_id})
+
+    if result.get("error"):
         match result["error"]:
             case "Target user does not exist":
                 return {"error": "Target user does not exist"}, 404
             case "Target is not friends with user":
                 return {"error": "Target is not friends with user"}, 404
 
+    social_graph.apply(requester_id, target_user_id, "following", result["id"])
+    social_graph.apply(target_user_id, requester_id, "following")
+    suggestions.unfriended(db, requester_id, target_user_id)
+    revisions.bump(db, [requester_id, target_user_id], "social")
     return {
         "message": "Successfully unfollowed user",
         "relationship": result
@@ -228,24 +247,25 @@ def block_user():
         return {"error": "Target user ID is required"}, 400
     target_user_id = f"user:{target_user_id}"
 
+    # The target's follow goes, unless it is a block of its own
+    reverse = social_graph.relation(db, requester_id, target_user_id)[1]
+
     # Create a block relationship
-    result = db.query(
-        """
-        IF NOT (record::exists($target_user_id)) THEN {
-            RETURN {"error": "Target user does not exist"};
-        };
-        LET $reverse_relation = SELECT * FROM relationship_with WHERE in = $target_user_id AND out = $requester_id AND type != 'blocked';
-        DELETE ONLY $reverse_relation;
-        RELATE ONLY $requester_id->relationship_with->($target_user_id) SET type = 'blocked', labels = [];
-        """,
-        {"requester_id": requester_id, "target_user_id": target_user_id}
-    )
-
-    if result["error"]:
+    result = queries.run(db, "social.block", {"requester_id": requester_id, "target_user_id": target_user_id})
+
+    if result.get("error"):
         match result["error"]:
             case "Target user does not exist":
                 return {"error": "Target user does not exist"}, 404
 
+    social_graph.apply(requester_id, target_user_id, "blocked", result["id"])
+    if reverse != "blocked":
+        social_graph.apply(target_user_id, requester_id, None)
+    suggestions.invalidate(requester_id, target_user_id)
+    # Both sides' tags on the other went with their edges
+    fanout.enqueue_members(db, requester_id, [target_user_id])
+    fanout.enqueue_members(db, target_user_id, [requester_id])
+    revisions.bump(db, [requester_id, target_user_id], "social")
     return {
         "message": "Successfully blocked user",
         "relationship": result
@@ -260,27 +280,18 @@ def unblock_user(user_id):
     requester_id = f"user:{user}"
     target_user_id = f"user:{user_id}"
 
-    result = db.query(
-        """
-        IF NOT (record::exists($target_user_id)) THEN {
-            RETURN {"error": "Target user does not exist"};
-        };
-        LET $relationship = SELECT * FROM relationship_with WHERE in = $requester_id AND out = $target_user_id;
-        IF $relationship == [] OR $relationship[0].type != 'blocked' THEN {
-            RETURN {"error": "Target is not blocked by requester"};
-        };
-        DELETE ONLY $relationship.id;
-        """,
-        {"requester_id": requester_id, "target_user_id": target_user_id}
-    )
-
-    if result["error"]:
+    result = queries.run(db, "social.unblock", {"requester_id": requester_id, "target_user_id": target_user_id})
+
+    if result.get("error"):
         match result["error"]:
             case "Target user does not exist":
                 return {"error": "Target user does not exist"}, 404
             case "Target is not blocked by user":
                 return {"error": "Target is not blocked by user"}, 404
 
+    social_graph.apply(requester_id, target_user_id, None)
+    suggestions.invalidate(requester_id, target_user_id)
+    revisions.bump(db, [requester_id, target_user_id], "social")
     return {
         "message": "Successfully unblocked user",
         "relationship": result
@@ -0,0 +1,30 @@
+# Liveness and readiness probes for load balancers and orchestrators
+
+from flask import Blueprint, current_app
+
+from extensions import sdb
+
+health_bp = Blueprint('health', __name__)
+
+@health_bp.route('/live', methods=['GET'])
+def liveness():
+    # The process is up and serving requests
+    return {"status": "ok"}, 200
+
+@health_bp.route('/ready', methods=['GET'])
+def readiness():
+    # Ready once start_services() has run, until the worker starts draining,
+    # and only while the database answers
+    state = current_app.extensions["health"]
+    if state["draining"]:
+        return {"status": "draining"}, 503
+    if not state["ready"]:
+        return {"status": "starting"}, 503
+
+    try:
+        with sdb.connection(timeout=current_app.config["READINESS_DB_TIMEOUT"]) as db:
+            db.query("RETURN true")
+    except Exception as e:
+        return {"status": "unavailable", "error": str(e)}, 503
+
+    return {"status": "ready", "pool": sdb.stats()}, 200
@@ -0,0 +1,34 @@
+# Server-sent events stream of changes visible to the current user
+
+from flask import Blueprint, Response, current_app, stream_with_context
+from flask_jwt_extended import get_jwt_identity, jwt_required
+
+from extensions import change_feed
+from live import format_event
+
+live_bp = Blueprint('live', __name__)
+
+@live_bp.route('/', methods=['GET'])
+@jwt_required()
+def stream_changes():
+    # No database connection is held for the life of the stream, the shared
+    # change feed does all of the reading
+    user = get_jwt_identity()
+    user_id = f"user:{user}"
+
+    subscription = change_feed.subscribe(user_id)
+    dumps = current_app.json.dumps
+
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                yield format_event(subscription.get(change_feed.heartbeat), dumps)
+        finally:
+            change_feed.unsubscribe(subscription)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,51 @@
+# Prometheus scrape endpoint for this process
+
+from flask import Blueprint, Response, current_app
+
+import metrics
+from extensions import queries, tracer
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/', methods=['GET'])
+def get_metrics():
+    # Request and phase histograms need TRACING; the rest is always there
+    lines = []
+    lines += metrics.histogram(
+        "http_request_duration_seconds",
+        "Request latency by blueprint, route, method and status",
+        tracer.route_histograms()
+    )
+    lines += metrics.histogram(
+        "http_phase_duration_seconds",
+        "Time spent in each traced phase of a request",
+        tracer.phase_histograms()
+    )
+
+    statements = queries.stats()
+    lines += metrics.histogram(
+        "surrealdb_statement_duration_seconds",
+        "Latency of each named statement",
+        [({"statement": name}, stats) for name, stats in sorted(statements.items())]
+    )
+    lines += metrics.gauge(
+        "surrealdb_statement_errors_total",
+        "Failed runs of each named statement",
+        [({"statement": name}, stats["errors"]) for name, stats in sorted(statements.items())]
+    )
+    lines += metrics.gauge(
+        "surrealdb_statement_rows_total",
+        "Rows returned by each named statement",
+        [({"statement": name}, stats["rows"]) for name, stats in sorted(statements.items())]
+    )
+
+    # Every extension that keeps a stats() gets its numbers exported as
+    # calendar_<extension>_<stat>
+    for name, extension in sorted(current_app.extensions.items()):
+        if extension is queries or not callable(getattr(extension, "stats", None)):
+            continue
+        prefix = "calendar_" + name.replace("-", "_")
+        for key, value in metrics.flatten(extension.stats()):
+            lines += metrics.gauge(f"{prefix}_{key}", f"{name} {key}", [({}, value)])
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
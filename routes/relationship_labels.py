@@ -3,18 +3,21 @@
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import get_jwt_identity, jwt_required
 
-from extensions import sdb
+import changelog
+import revisions
+from extensions import fanout, permissions, queries, sdb
 
 relationship_labels_bp = Blueprint('relationship-labels', __name__)
 
 @relationship_labels_bp.route('/', methods=['GET'])
 @jwt_required()
+@revisions.conditional("relationship_labels")
 def get_relationship_labels():
     db = sdb.get_db()
     current_user = get_jwt_identity()
     user_id = f"user:{current_user}"
 
-    result = sdb.query("SELECT * FROM relationship_label WHERE owner = $user_id", {"user_id": user_id})
+    result = queries.run(db, "relationship_labels.list", {"user_id": user_id})
     return jsonify(result), 200
 
 @relationship_labels_bp.route('/', methods=['POST'])
@@ -30,7 +33,9 @@ def create_relationship_label():
     if not name:
         return jsonify({"error": "Name is required"}), 400
 
-    result = sdb.query("CREATE relationship_label SET owner = $user_id, name = $name RETURN AFTER", {"user_id": user_id, "name": name})
+    result = queries.run(db, "relationship_labels.create", {"user_id": user_id, "name": name})
+    revisions.bump(db, [user_id], "relationship_labels")
+    changelog.record(db, [user_id], upserts=[label["id"] for label in result])
     return jsonify({"message": "Label created successfully", "label": result}), 201
 
 @relationship_labels_bp.route('/<label_id>', methods=['PUT'])
@@ -45,25 +50,20 @@ def update_relationship_label(label_id):
     if not merge_data:
         return jsonify({"error": "Merge data is required"}), 400
 
-    name = merge_data["name"]
-
-    result = sdb.execute("""
-                IF NOT record::exists($label_id) THEN {
-                    RETURN { "error": "Label not found" };
-                }
-                IF $label_id.owner != $user_id THEN {
-                    RETURN { "error": "Requester is not the owner" };
-                }
-                UPDATE $label_id MERGE $merge_data;
-                """, {"merge_data": merge_data, "label_id": label_id, "user_id": user_id})
-    
-    if result["error"]:
+    merge_data = {field: value for field, value in merge_data.items() if field not in ("id", "owner")}
+    label_id = f"relationship_label:{label_id}"
+
+    result = queries.run(db, "relationship_labels.update", {"merge_data": merge_data, "label_id": label_id, "user_id": user_id})
+
+    if result.get("error"):
         match result["error"]:
             case "Label not found":
                 return jsonify({"error": "Label not found"}), 404
             case "Requester is not the owner":
                 return jsonify({"error": "Requester is not the owner"}), 403
 
+    revisions.bump(db, [user_id], "relationship_labels")
+    changelog.record(db, [user_id], upserts=[label_id])
     return jsonify({"message": "Label updated successfully", "label": result}), 200
 
 @relationship_labels_bp.route('/<label_id>', methods=['DELETE'])
@@ -72,20 +72,62 @@ def delete_relationship_label(label_id):
     db = sdb.get_db()
     current_user = get_jwt_identity()
     user_id = f"user:{current_user}"
+    label_id = f"relationship_label:{label_id}"
+
+    label = queries.run(db, "relationship_labels.owner", {"label_id": label_id})
+    if not label:
+        return jsonify({"error": "Label not found"}), 404
+    if str(label["owner"]) != user_id:
+        return jsonify({"error": "Requester is not the owner"}), 403
+
+    result = queries.run(db, "relationship_labels.delete", {"label_id": label_id})
+    # Access shared through this label's group is gone, and events under
+    # event labels shared with the group lose it in the background
+    permissions.invalidate_label(label_id)
+    for event_label in result["event_labels"]:
+        fanout.enqueue_label(db, user_id, event_label)
+    revisions.bump(db, [user_id], "relationship_labels")
+    changelog.record(db, [user_id], deletes=[label_id])
+
+    changed = {}
+    for edge in result["updated"]:
+        changed.setdefault(str(edge["out"]), []).append((str(edge["in"]), edge["id"], "updated"))
+    for edge in result["revoked"]:
+        changed.setdefault(str(edge["out"]), []).append((str(edge["in"]), edge["id"], "deleted"))
+    for event_id, edges in changed.items():
+        fanout.notify(db, event_id, edges)
+
+    return jsonify({"message": "Label deleted successfully"}), 200
+
+def tag_member(label_id, user_id, statement):
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    requester_id = f"user:{current_user}"
+    label_id = f"relationship_label:{label_id}"
+    target_user_id = f"user:{user_id}"
+
+    result = queries.run(db, statement, {"label_id": label_id, "user_id": requester_id, "target_id": target_user_id})
 
-    result = sdb.execute("""
-                IF NOT record::exists($label_id) THEN {
-                    RETURN { "error": "Label not found" };
-                }
-                IF $label_id.owner != $user_id THEN {
-                    RETURN { "error": "Requester is not the owner" };
-                }
-                DELETE ONLY $label_id RETURN AFTER;
-                """, {"label_id": label_id, "user_id": user_id})
-
-    if result["error"]:
+    if result.get("error"):
         match result["error"]:
             case "Label not found":
                 return jsonify({"error": "Label not found"}), 404
+            case "Requester not following target":
+                return jsonify({"error": "You are not following this user"}), 404
+            case "Target is not tagged with label":
+                return jsonify({"error": "User is not tagged with this label"}), 404
 
-    return jsonify({"message": "Label deleted successfully"}), 200
\ No newline at end of file
+    # Event labels shared with the label's group follow in the background
+    fanout.enqueue_members(db, requester_id, [target_user_id])
+    revisions.bump(db, [requester_id], "social")
+    return jsonify({"message": "Label members updated successfully", "relationship": result}), 200
+
+@relationship_labels_bp.route('/<label_id>/members/<user_id>', methods=['PUT'])
+@jwt_required()
+def add_label_member(label_id, user_id):
+    return tag_member(label_id, user_id, "relationship_labels.tag")
+
+@relationship_labels_bp.route('/<label_id>/members/<user_id>', methods=['DELETE'])
+@jwt_required()
+def remove_label_member(label_id, user_id):
+    return tag_member(label_id, user_id, "relationship_labels.untag")
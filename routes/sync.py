@@ -0,0 +1,45 @@
+# Incremental sync for offline clients
+
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+
+import changelog
+from extensions import sdb
+from pagination import parse_limit
+
+sync_bp = Blueprint('sync', __name__)
+
+@sync_bp.route('/', methods=['GET'])
+@jwt_required()
+def sync():
+    # Without since, returns everything the user can see. With it, returns
+    # what was created, updated or deleted after it, deletes as tombstones.
+    db = sdb.get_db()
+
+    user = get_jwt_identity()
+    user_id = f"user:{user}"
+
+    since = request.args.get("since")
+    if not since:
+        changes, token = changelog.snapshot(db, user_id)
+        return jsonify({
+            "changes": changes,
+            "next": token,
+            "has_more": False,
+            "full": True
+        }), 200
+
+    try:
+        limit = parse_limit(request.args.get("limit"), default=500, maximum=2000)
+        changes, token, has_more = changelog.changes_since(db, user_id, since, limit)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except changelog.TokenExpired:
+        return {"error": "Sync token has expired, sync again without since"}, 410
+
+    return jsonify({
+        "changes": changes,
+        "next": token,
+        "has_more": has_more,
+        "full": False
+    }), 200
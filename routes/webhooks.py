@@ -0,0 +1,106 @@
+# Routes relating to webhook subscriptions
+
+import secrets
+
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from surrealdb import RecordID
+
+from extensions import sdb, webhooks
+from webhooks import EVENT_TYPES
+
+webhooks_bp = Blueprint('webhooks', __name__)
+
+@webhooks_bp.route('/', methods=['POST'])
+@jwt_required()
+def create_subscription():
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    user_id = f"user:{current_user}"
+
+    data = request.get_json() or {}
+    url = data.get("url")
+    events = data.get("events", ["*"])
+
+    if not isinstance(url, str) or not url:
+        return jsonify({"error": "A http or https url is required"}), 400
+    error = webhooks.check_url(url)
+    if error:
+        return jsonify({"error": error}), 400
+    if not isinstance(events, list) or any(event != "*" and event not in EVENT_TYPES for event in events):
+        return jsonify({"error": "events must be a list of " + ", ".join(EVENT_TYPES) + " or *"}), 400
+
+    # The secret is only ever returned here; deliveries are signed with it
+    secret = data.get("secret") or secrets.token_hex(32)
+    result = db.query(
+        "CREATE ONLY webhook_subscription SET owner = <record> $user_id, url = $url, events = $events, secret = $secret, active = true, created_at = time::now()",
+        {"user_id": user_id, "url": url, "events": events, "secret": secret}
+    )
+    return jsonify({"message": "Webhook created successfully", "webhook": result}), 201
+
+@webhooks_bp.route('/', methods=['GET'])
+@jwt_required()
+def get_subscriptions():
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    user_id = f"user:{current_user}"
+
+    result = db.query("SELECT * OMIT secret FROM webhook_subscription WHERE owner = $user_id", {"user_id": RecordID.parse(user_id)})
+    return jsonify(result), 200
+
+@webhooks_bp.route('/<webhook_id>', methods=['DELETE'])
+@jwt_required()
+def delete_subscription(webhook_id):
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    user_id = f"user:{current_user}"
+    webhook_id = f"webhook_subscription:{webhook_id}"
+
+    result = db.query(
+        "DELETE webhook_subscription WHERE id = $webhook_id AND owner = $user_id RETURN BEFORE",
+        {"webhook_id": RecordID.parse(webhook_id), "user_id": RecordID.parse(user_id)}
+    )
+    if not result:
+        return jsonify({"error": "Webhook not found"}), 404
+
+    return jsonify({"message": "Webhook deleted successfully"}), 200
+
+@webhooks_bp.route('/<webhook_id>/deliveries', methods=['GET'])
+@jwt_required()
+def get_deliveries(webhook_id):
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    user_id = f"user:{current_user}"
+    webhook_id = f"webhook_subscription:{webhook_id}"
+
+    # Only filters on status when asked to; an OR keeps the planner off the indexes
+    status = request.args.get("status")
+    result = db.query(
+        f"""
+        SELECT * FROM webhook_delivery
+        WHERE subscription = $webhook_id AND subscription.owner = $user_id{" AND status = $status" if status else ""}
+        ORDER BY id DESC
+        LIMIT 100;
+        """,
+        {"webhook_id": RecordID.parse(webhook_id), "user_id": RecordID.parse(user_id), "status": status}
+    )
+    return jsonify(result), 200
+
+@webhooks_bp.route('/<webhook_id>/deliveries/retry', methods=['POST'])
+@jwt_required()
+def retry_dead_deliveries(webhook_id):
+    db = sdb.get_db()
+    current_user = get_jwt_identity()
+    user_id = f"user:{current_user}"
+    webhook_id = f"webhook_subscription:{webhook_id}"
+
+    # Moves dead-lettered deliveries back onto the queue
+    result = db.query(
+        """
+        UPDATE webhook_delivery SET status = 'pending', attempts = 0, next_attempt_at = NONE
+        WHERE subscription = $webhook_id AND subscription.owner = $user_id AND status = 'dead'
+        RETURN NONE;
+        """,
+        {"webhook_id": RecordID.parse(webhook_id), "user_id": RecordID.parse(user_id)}
+    )
+    return jsonify({"message": "Dead deliveries requeued"}), 200
@@ -0,0 +1,46 @@
+# Indexes and other definitions the app expects to exist in SurrealDB, and
+# the removal of ones it no longer uses
+
+INDEXES = [
+    # Range queries start from the user's access edges and filter those
+    # events by time (see events.range_single), so indexes on start_time and
+    # end_time were never read and only slowed down writes
+    "REMOVE INDEX IF EXISTS calendar_event_start ON calendar_event",
+    "REMOVE INDEX IF EXISTS calendar_event_end ON calendar_event",
+    # Walking access edges from either side
+    "DEFINE INDEX IF NOT EXISTS has_access_to_in ON has_access_to FIELDS in",
+    "DEFINE INDEX IF NOT EXISTS has_access_to_out ON has_access_to FIELDS out",
+    # Events an event label is on, and the edges a label grants access
+    # through; both fields are arrays, indexed per element
+    "DEFINE INDEX IF NOT EXISTS has_access_to_labels ON has_access_to FIELDS labels",
+    "DEFINE INDEX IF NOT EXISTS has_access_to_because_of ON has_access_to FIELDS because_of",
+    # Label group sharing and its fan-out queue
+    "DEFINE INDEX IF NOT EXISTS label_grant_owner ON label_grant FIELDS owner",
+    "DEFINE INDEX IF NOT EXISTS label_grant_event_label ON label_grant FIELDS event_label",
+    "DEFINE INDEX IF NOT EXISTS label_grant_relationship_label ON label_grant FIELDS relationship_label",
+    "DEFINE INDEX IF NOT EXISTS fanout_job_status ON fanout_job FIELDS status, queued_at",
+    # Expanding relationship label groups when sharing, and loading the
+    # social graph from either side
+    "DEFINE INDEX IF NOT EXISTS relationship_with_in ON relationship_with FIELDS in",
+    "DEFINE INDEX IF NOT EXISTS relationship_with_out ON relationship_with FIELDS out",
+    # Time budget reads by user and day
+    "DEFINE INDEX IF NOT EXISTS time_budget_user_day ON time_budget FIELDS user, day",
+    # Webhook fan-out and the delivery queue
+    "DEFINE INDEX IF NOT EXISTS webhook_subscription_owner ON webhook_subscription FIELDS owner",
+    "DEFINE INDEX IF NOT EXISTS webhook_delivery_status ON webhook_delivery FIELDS status, next_attempt_at",
+    "DEFINE INDEX IF NOT EXISTS webhook_delivery_subscription ON webhook_delivery FIELDS subscription",
+    # Incremental sync reads a user's change log in time order
+    "DEFINE INDEX IF NOT EXISTS change_log_user_at ON change_log FIELDS user, at",
+    # Revoked token lookups, and purging them once they've expired
+    "DEFINE INDEX IF NOT EXISTS blocked_token_jti ON blocked_token FIELDS jti",
+    "DEFINE INDEX IF NOT EXISTS blocked_token_expiry ON blocked_token FIELDS expiry",
+    # Other workers reading the tokens revoked since they last looked
+    "DEFINE INDEX IF NOT EXISTS blocked_token_revoked_at ON blocked_token FIELDS revoked_at",
+    # Compacting the change log
+    "DEFINE INDEX IF NOT EXISTS change_log_at ON change_log FIELDS at",
+]
+
+
+def define_schema(db):
+    # Every statement is idempotent so this is safe to run on every startup
+    db.query(";\n".join(INDEXES) + ";")
@@ -0,0 +1,22 @@
+# Prefork production server: gunicorn -c gunicorn.conf.py serve:app
+#
+# This module only builds the app; the server settings and the hooks that
+# start and stop each worker's services are in gunicorn.conf.py. Gunicorn
+# loads its config file as a module of its own, so the app is kept out of
+# it and the hooks import it from here: there is one app per process, the
+# one serving requests, and that's the one marked ready and draining.
+#
+# SERVER_MODE=asgi serves asgi:app under uvicorn workers instead, for the
+# long-lived /live and /sync?wait= connections.
+
+import os
+
+from main import create_app
+
+SERVER_MODE = os.getenv("SERVER_MODE", "wsgi")
+
+if SERVER_MODE == "asgi":
+    # The ASGI app starts its services in its lifespan handler
+    from asgi import app
+else:
+    app = create_app({"LAZY_START": True})
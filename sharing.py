@@ -0,0 +1,218 @@
+# Set-based sharing of an event with many users at once
+#
+# Targets are validated with one lookup, relationship label groups are
+# expanded with one more, existing has_access_to edges are read once and
+# every insert, update and delete is applied in a single transaction, so
+# the number of statements doesn't grow with the number of users.
+#
+# because_of records why a user has access: "owner", "direct" for users
+# shared with by id, or the id of the relationship_label whose group they
+# were shared with. fanout.py adds the ids of event_labels shared with a
+# group. An edge goes away once nothing is left in because_of.
+#
+# reason_permissions maps each of those reasons to the permission it
+# grants, and the edge's permission is the highest of them, so taking one
+# reason away also takes away whatever it alone raised the edge to.
+
+import uuid
+
+from surrealdb import RecordID
+
+from permissions import strongest
+from surreal import query_all
+
+DIRECT = "direct"
+
+
+def _record(value):
+    return RecordID.parse(value) if isinstance(value, str) else value
+
+
+def resolve_targets(db, requester, user_ids=(), label_ids=()):
+    # Returns (users, groups, errors). users is the set of user ids that
+    # exist, groups maps each of the requester's label ids to the users
+    # they have tagged with it and errors maps unknown ids to a message.
+    errors = {}
+    users = set()
+    if user_ids:
+        found = db.query("SELECT VALUE id FROM $ids", {"ids": [_record(user_id) for user_id in set(user_ids)]})
+        users = {str(user_id) for user_id in found}
+        errors.update({user_id: "User not found" for user_id in user_ids if user_id not in users})
+
+    groups = {}
+    if label_ids:
+        labels = [_record(label_id) for label_id in set(label_ids)]
+        owned = db.query(
+            "SELECT VALUE id FROM $labels WHERE owner = $requester",
+            {"labels": labels, "requester": _record(requester)}
+        )
+        groups = {str(label_id): set() for label_id in owned}
+        errors.update({label_id: "Label not found" for label_id in label_ids if label_id not in groups})
+
+        if groups:
+            relationships = db.query(
+                """
+                SELECT out, labels FROM relationship_with
+                WHERE in = $requester AND labels CONTAINSANY $labels AND type != 'blocked';
+                """,
+                {"requester": _record(requester), "labels": [_record(label_id) for label_id in groups]}
+            )
+            for relationship in relationships:
+                for label in relationship["labels"]:
+                    if str(label) in groups:
+                        groups[str(label)].add(str(relationship["out"]))
+
+    return users, groups, errors
+
+
+def _existing(db, event_id, user_ids):
+    # Filtered outside the edge scan: given `in IN $users` the planner
+    # unions the in index over every user instead of reading one event
+    edges = db.query(
+        "SELECT id, in, permission, because_of, reason_permissions FROM (SELECT * FROM has_access_to WHERE out = $event_id) WHERE in IN $users",
+        {"event_id": _record(event_id), "users": [_record(user_id) for user_id in user_ids]}
+    )
+    return {str(edge["in"]): edge for edge in edges}
+
+
+def _because_of(edge):
+    because_of = edge.get("because_of") or []
+    # Edges made before because_of was a list hold a single string
+    return [because_of] if isinstance(because_of, str) else [str(reason) for reason in because_of]
+
+
+def reason_permissions(edge):
+    # {reason: permission it grants} for edge. Edges written before this
+    # was kept count every reason at the edge's permission.
+    granted = edge.get("reason_permissions") or {}
+    return {reason: granted.get(reason, edge["permission"]) for reason in _because_of(edge)}
+
+
+def share(db, event_id, direct=None, groups=None):
+    # direct maps user id -> permission and replaces the user's direct
+    # share. groups maps label id -> (permission, members) and sets what
+    # each group grants. Users end up with the highest permission any of
+    # their reasons grants. Returns {user id: result}.
+    wanted = {}
+    for user_id, permission in (direct or {}).items():
+        wanted.setdefault(user_id, {})[DIRECT] = permission
+    for label_id, (permission, members) in (groups or {}).items():
+        for user_id in members:
+            wanted.setdefault(user_id, {})[label_id] = permission
+    if not wanted:
+        return {}
+
+    existing = _existing(db, event_id, wanted)
+    results, inserts, updates, permissions, reasons, granted = {}, [], [], {}, {}, {}
+    for user_id, target in wanted.items():
+        edge = existing.get(user_id)
+        if edge is None:
+            link = RecordID("has_access_to", uuid.uuid4().hex)
+            permission = strongest(target.values())
+            inserts.append({
+                "id": link,
+                "in": _record(user_id),
+                "out": _record(event_id),
+                "permission": permission,
+                "because_of": sorted(target),
+                "reason_permissions": target,
+                "labels": [],
+            })
+            results[user_id] = {"status": "created", "permission": permission, "link": link}
+            continue
+
+        if edge["permission"] == "owner":
+            results[user_id] = {"status": "error", "error": "User has higher permission"}
+            continue
+
+        target = {**reason_permissions(edge), **target}
+        permission = strongest(target.values())
+        if permission == edge["permission"] and sorted(target) == edge.get("because_of") and target == edge.get("reason_permissions"):
+            results[user_id] = {"status": "unchanged", "permission": permission}
+            continue
+
+        updates.append(edge["id"])
+        permissions[user_id] = permission
+        reasons[user_id] = sorted(target)
+        granted[user_id] = target
+        results[user_id] = {"status": "updated", "permission": permission, "link": edge["id"]}
+
+    statements = []
+    if inserts:
+        statements.append("INSERT RELATION INTO has_access_to $inserts RETURN NONE;")
+    if updates:
+        statements.append(
+            "UPDATE $updates SET permission = $permissions[<string> in], because_of = $reasons[<string> in], "
+            "reason_permissions = $granted[<string> in] RETURN NONE;"
+        )
+    if statements:
+        query_all(db, "BEGIN TRANSACTION;\n" + "\n".join(statements) + "\nCOMMIT TRANSACTION;", {
+            "inserts": inserts,
+            "updates": updates,
+            "permissions": permissions,
+            "reasons": reasons,
+            "granted": granted,
+        })
+    return results
+
+
+def unshare(db, event_id, direct=(), groups=None):
+    # Users in direct lose access outright. Users in a label group only lose
+    # that label as a reason and keep access while another reason remains,
+    # at the highest permission the remaining reasons grant. groups maps
+    # label id -> members. Returns {user id: result}.
+    removals = {user_id: None for user_id in direct}
+    for label_id, members in (groups or {}).items():
+        for user_id in members:
+            if user_id in removals and removals[user_id] is None:
+                continue
+            removals.setdefault(user_id, set()).add(label_id)
+    if not removals:
+        return {}
+
+    existing = _existing(db, event_id, removals)
+    results, deletes, updates, permissions, reasons, granted = {}, [], [], {}, {}, {}
+    for user_id, labels in removals.items():
+        edge = existing.get(user_id)
+        if edge is None:
+            if labels is None:
+                results[user_id] = {"status": "error", "error": "Share not found"}
+            else:
+                results[user_id] = {"status": "unchanged"}
+            continue
+        if edge["permission"] == "owner":
+            results[user_id] = {"status": "error", "error": "User has higher permission"}
+            continue
+
+        current = reason_permissions(edge)
+        remaining = {} if labels is None else {reason: permission for reason, permission in current.items() if reason not in labels}
+        if remaining == current:
+            results[user_id] = {"status": "unchanged", "permission": edge["permission"]}
+        elif remaining:
+            permission = strongest(remaining.values())
+            updates.append(edge["id"])
+            permissions[user_id] = permission
+            reasons[user_id] = sorted(remaining)
+            granted[user_id] = remaining
+            results[user_id] = {"status": "updated", "permission": permission, "link": edge["id"]}
+        else:
+            deletes.append(edge["id"])
+            results[user_id] = {"status": "deleted", "link": edge["id"]}
+
+    statements = []
+    if deletes:
+        statements.append("DELETE $deletes;")
+    if updates:
+        statements.append(
+            "UPDATE $updates SET permission = $permissions[<string> in], because_of = $reasons[<string> in], "
+            "reason_permissions = $granted[<string> in] RETURN NONE;"
+        )
+    if statements:
+        query_all(db, "BEGIN TRANSACTION;\n" + "\n".join(statements) + "\nCOMMIT TRANSACTION;", {
+            "deletes": deletes,
+            "updates": updates,
+            "permissions": permissions,
+            "reasons": reasons,
+            "granted": granted,
+        })
+    return results
@@ -0,0 +1,195 @@
+# Per-user social adjacency, cached in process
+#
+# For each user the cache holds every relationship_with edge they're on,
+# as two maps other user -> (type, edge id): out for edges from the user
+# (following, friends, blocked) and into for edges to them. That answers
+# "does a follow b", "is a blocked by b" and the counts without a query,
+# and lists page through the sorted member ids, fetching only the page's
+# edges by id. Entries load with one indexed query, are kept in an LRU
+# with a TTL like the permission cache, and are updated in place by
+# apply() after every relationship write; the TTL bounds how stale
+# another worker process can be.
+
+import bisect
+import collections
+import threading
+import time
+
+# kind -> (direction, edge types)
+KINDS = {
+    "following": ("out", ("following", "friends")),
+    "followers": ("into", ("following", "friends")),
+    "friends": ("out", ("friends",)),
+    "blocked": ("out", ("blocked",)),
+    "blocked_by": ("into", ("blocked",)),
+}
+
+
+class Adjacency:
+    __slots__ = ("out", "into", "expires", "_members")
+
+    def __init__(self, out, into, expires):
+        self.out = out
+        self.into = into
+        self.expires = expires
+        # kind -> sorted member ids, built on first use
+        self._members = {}
+
+    def members(self, kind):
+        members = self._members.get(kind)
+        if members is None:
+            direction, types = KINDS[kind]
+            edges = getattr(self, direction)
+            members = self._members[kind] = sorted(other for other, (edge_type, _) in edges.items() if edge_type in types)
+        return members
+
+    def set(self, direction, other, edge_type, edge_id):
+        edges = getattr(self, direction)
+        if edge_type is None:
+            edges.pop(other, None)
+        else:
+            # Keeps the id it had when only the type changed
+            edges[other] = (edge_type, edge_id or edges.get(other, (None, None))[1])
+        self._members.clear()
+
+
+class SocialGraph:
+    def __init__(self, queries):
+        self.queries = queries
+        self.max_size = 10000
+        self.ttl = 60.0
+
+        self._lock = threading.Lock()
+        # user id -> Adjacency
+        self._entries = collections.OrderedDict()
+        # Bumped by every write, so a load that raced one isn't cached
+        self._version = 0
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "updates": 0,
+            "evictions": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("SOCIAL_GRAPH_CACHE_SIZE", 10000)
+        app.config.setdefault("SOCIAL_GRAPH_TTL", 60.0)
+        self.max_size = app.config["SOCIAL_GRAPH_CACHE_SIZE"]
+        self.ttl = app.config["SOCIAL_GRAPH_TTL"]
+        app.extensions["social_graph"] = self
+
+    def relation(self, db, user_id, other_id):
+        # (type of user_id -> other_id, type of other_id -> user_id), each
+        # None when there is no edge
+        entry = self._entry(db, user_id)
+        other_id = str(other_id)
+        with self._lock:
+            return entry.out.get(other_id, (None,))[0], entry.into.get(other_id, (None,))[0]
+
+    def is_following(self, db, user_id, other_id):
+        return self.relation(db, user_id, other_id)[0] in ("following", "friends")
+
+    def is_blocked_by(self, db, user_id, other_id):
+        return self.relation(db, user_id, other_id)[1] == "blocked"
+
+    def members(self, db, user_id, kind):
+        # Sorted ids of user_id's kind, a copy
+        entry = self._entry(db, user_id)
+        with self._lock:
+            return list(entry.members(kind))
+
+    def count(self, db, user_id, kind):
+        entry = self._entry(db, user_id)
+        with self._lock:
+            return len(entry.members(kind))
+
+    def page(self, db, user_id, kind, after=None, limit=100):
+        # (edge ids for up to limit members after the member id after, in
+        # member order, the last member id if there are more)
+        entry = self._entry(db, user_id)
+        with self._lock:
+            edges = getattr(entry, KINDS[kind][0])
+            members = entry.members(kind)
+            start = bisect.bisect_right(members, after) if after is not None else 0
+            chosen = members[start:start + limit]
+            edge_ids = [edges[member][1] for member in chosen]
+            more = start + limit < len(members)
+        return edge_ids, chosen[-1] if more and chosen else None
+
+    def following_many(self, db, user_ids):
+        # {user id: ids they follow} for many users, from the cache where
+        # possible and one batched read for the rest, which isn't cached
+        # because it only covers one direction
+        result, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for user_id in map(str, user_ids):
+                entry = self._entries.get(user_id)
+                if entry is not None and entry.expires > now:
+                    result[user_id] = set(entry.members("following"))
+                else:
+                    missing.append(user_id)
+                    result[user_id] = set()
+        if missing:
+            for user_id, other in self.queries.run(db, "social.following_many", {"users": missing}):
+                result[str(user_id)].add(str(other))
+        return result
+
+    def apply(self, in_id, out_id, edge_type, edge_id=None):
+        # Records that the edge in_id -> out_id is now edge_type (None when
+        # it was deleted) in whichever of the two users are cached
+        in_id, out_id = str(in_id), str(out_id)
+        edge_id = str(edge_id) if edge_id is not None else None
+        with self._lock:
+            for user_id, direction, other in ((in_id, "out", out_id), (out_id, "into", in_id)):
+                entry = self._entries.get(user_id)
+                if entry is not None:
+                    entry.set(direction, other, edge_type, edge_id)
+            self._version += 1
+            self._counters["updates"] += 1
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(str(user_id), None)
+            self._version += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _entry(self, db, user_id):
+        user_id = str(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end(user_id)
+                self._counters["hits"] += 1
+                return entry
+            self._counters["misses"] += 1
+            version = self._version
+
+        adjacency = self.queries.run(db, "social.adjacency", {"user_id": user_id})
+        entry = Adjacency(
+            {str(other): (edge_type, str(edge_id)) for other, edge_type, edge_id in adjacency["out"]},
+            {str(other): (edge_type, str(edge_id)) for other, edge_type, edge_id in adjacency["in"]},
+            now + self.ttl,
+        )
+        with self._lock:
+            if version != self._version:
+                return entry
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+        return entry
@@ -0,0 +1,195 @@
+# "People you may know", cached per user
+#
+# Candidates are two hops out: the people the user's friends and follows
+# follow. Each is ranked by how many of the user's friends lead to them,
+# then by how many of their connections do. Anyone the user already
+# follows and anyone on either side of a block with the user is left
+# out. Neighbours' follow sets come from the social graph cache or one
+# batched read per SUGGESTIONS_BATCH neighbours, friends first, and the
+# walk stops at SUGGESTIONS_BUDGET_MS or SUGGESTIONS_MAX_NEIGHBORS with
+# the result marked partial.
+#
+# Results are kept for SUGGESTIONS_TTL. A follow, a follow back that
+# makes two users friends, or an unfriend by the user adjusts the cached
+# counts in place; other relationship writes drop the cached result so
+# the next request rebuilds it.
+
+import collections
+import heapq
+import threading
+import time
+
+
+class Candidates:
+    __slots__ = ("counts", "partial", "expires")
+
+    def __init__(self, counts, partial, expires):
+        # candidate id -> [mutual friends, mutual connections]
+        self.counts = counts
+        self.partial = partial
+        self.expires = expires
+
+
+class SuggestionEngine:
+    def __init__(self, social_graph):
+        self.social_graph = social_graph
+        self.max_size = 10000
+        self.ttl = 300.0
+        self.budget = 0.2
+        self.max_neighbors = 500
+        self.batch_size = 100
+
+        self._lock = threading.Lock()
+        # user id -> Candidates
+        self._entries = collections.OrderedDict()
+        # Bumped by every change, so a result computed across one isn't cached
+        self._version = 0
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "partial": 0,
+            "updates": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("SUGGESTIONS_CACHE_SIZE", 10000)
+        app.config.setdefault("SUGGESTIONS_TTL", 300.0)
+        app.config.setdefault("SUGGESTIONS_BUDGET_MS", 200.0)
+        app.config.setdefault("SUGGESTIONS_MAX_NEIGHBORS", 500)
+        app.config.setdefault("SUGGESTIONS_BATCH", 100)
+        self.max_size = app.config["SUGGESTIONS_CACHE_SIZE"]
+        self.ttl = app.config["SUGGESTIONS_TTL"]
+        self.budget = app.config["SUGGESTIONS_BUDGET_MS"] / 1000
+        self.max_neighbors = app.config["SUGGESTIONS_MAX_NEIGHBORS"]
+        self.batch_size = app.config["SUGGESTIONS_BATCH"]
+        app.extensions["suggestions"] = self
+
+    def suggest(self, db, user_id, limit=20):
+        # ([{user_id, mutual_friends, mutual}], partial) best first
+        entry = self._entry(db, str(user_id))
+        with self._lock:
+            best = heapq.nsmallest(limit, entry.counts.items(), key=lambda item: (-item[1][0], -item[1][1], item[0]))
+            partial = entry.partial
+        return [{"user_id": other, "mutual_friends": friends, "mutual": mutual} for other, (friends, mutual) in best], partial
+
+    def mutual_friends(self, db, user_id, other_id):
+        # Sorted ids of the friends user_id and other_id have in common
+        mine = set(self.social_graph.members(db, user_id, "friends"))
+        return sorted(mine.intersection(self.social_graph.members(db, other_id, "friends")))
+
+    def followed(self, db, user_id, target_id):
+        # user_id now follows target_id: target_id stops being a candidate
+        # and everyone target_id follows gains a mutual connection
+        user_id, target_id = str(user_id), str(target_id)
+        with self._lock:
+            cached = user_id in self._entries
+        if not cached:
+            return
+        following = self.social_graph.members(db, target_id, "following")
+        excluded = self._excluded(db, user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            entry.counts.pop(target_id, None)
+            for other in following:
+                if other not in excluded:
+                    entry.counts.setdefault(other, [0, 0])[1] += 1
+            self._version += 1
+            self._counters["updates"] += 1
+
+    def befriended(self, db, user_id, target_id):
+        # The two now follow each other, so each counts as a mutual friend
+        # for the people the other follows
+        self._adjust_friend(db, str(user_id), str(target_id), 1)
+
+    def unfriended(self, db, user_id, target_id):
+        # The two are back to following each other, so each stops counting
+        # as a mutual friend for the people the other follows
+        self._adjust_friend(db, str(user_id), str(target_id), -1)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(str(user_id), None)
+            self._version += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._entries)
+        return stats
+
+    def _adjust_friend(self, db, user_id, target_id, delta):
+        for one, other in ((user_id, target_id), (target_id, user_id)):
+            with self._lock:
+                cached = one in self._entries
+            if not cached:
+                continue
+            following = self.social_graph.members(db, other, "following")
+            with self._lock:
+                entry = self._entries.get(one)
+                if entry is None:
+                    continue
+                # Only candidates already counted through the follow
+                for candidate in following:
+                    counts = entry.counts.get(candidate)
+                    if counts is not None:
+                        counts[0] = max(counts[0] + delta, 0)
+                self._version += 1
+                self._counters["updates"] += 1
+
+    def _excluded(self, db, user_id):
+        # The user, everyone they have an edge to and everyone blocking them
+        excluded = {user_id}
+        for kind in ("following", "blocked", "blocked_by"):
+            excluded.update(self.social_graph.members(db, user_id, kind))
+        return excluded
+
+    def _entry(self, db, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end(user_id)
+                self._counters["hits"] += 1
+                return entry
+            self._counters["misses"] += 1
+            version = self._version
+
+        entry = self._compute(db, user_id, now)
+        with self._lock:
+            if entry.partial:
+                self._counters["partial"] += 1
+            if version != self._version:
+                return entry
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _compute(self, db, user_id, started):
+        deadline = started + self.budget
+        friends = set(self.social_graph.members(db, user_id, "friends"))
+        # Friends first so a cut-short walk has the strongest signal
+        neighbors = sorted(friends) + [other for other in self.social_graph.members(db, user_id, "following") if other not in friends]
+        partial = len(neighbors) > self.max_neighbors
+        neighbors = neighbors[:self.max_neighbors]
+        excluded = self._excluded(db, user_id)
+
+        counts = {}
+        for offset in range(0, len(neighbors), self.batch_size):
+            if offset and time.monotonic() > deadline:
+                partial = True
+                break
+            batch = neighbors[offset:offset + self.batch_size]
+            for neighbor, following in self.social_graph.following_many(db, batch).items():
+                friend = neighbor in friends
+                for other in following:
+                    if other in excluded:
+                        continue
+                    entry = counts.setdefault(other, [0, 0])
+                    entry[0] += friend
+                    entry[1] += 1
+        return Candidates(counts, partial, time.monotonic() + self.ttl)
@@ -1,39 +1,501 @@
 # Database connection related stuff
 
-import surrealdb
-import dotenv
+import asyncio
+import collections
+import contextlib
+import logging
 import os
+import threading
+import time
+
+import dotenv
+import flask
+import flask.json.provider
+import surrealdb
+from websockets.exceptions import ConnectionClosed
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean the socket underneath a driver is gone and the driver
+# should not be handed out again
+CONNECTION_ERRORS = (surrealdb.ConnectionUnavailableError, ConnectionClosed, ConnectionError, OSError)
+
+
+class SurrealQueryError(Exception):
+    pass
+
+
+def query_all(db, query, vars=None):
+    # Runs a multi statement script and returns the result of every
+    # statement. db.query() only returns and checks the first statement, so
+    # use this when a later statement failing has to be noticed.
+    response = db.query_raw(query, vars or {})
+    if response.get("error"):
+        raise SurrealQueryError(response["error"].get("message", response["error"]))
+
+    results = []
+    for statement in response.get("result", []):
+        if statement.get("status") != "OK":
+            raise SurrealQueryError(statement.get("result"))
+        results.append(statement.get("result"))
+    return results
+
+
+class SurrealJSONProvider(flask.json.provider.DefaultJSONProvider):
+    # Lets jsonify() serialize the record ids and datetimes the driver returns
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, (surrealdb.RecordID, surrealdb.Table)):
+            return str(o)
+        if isinstance(o, surrealdb.Datetime):
+            return o.dt
+        return flask.json.provider.DefaultJSONProvider.default(o)
+
+    def loads(self, s, **kwargs):
+        with tracing.span("json.parse"):
+            return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        with tracing.span("json.serialize"):
+            return super().response(*args, **kwargs)
+
+
+def connection_settings():
+    dotenv.load_dotenv()
+    DB_URL = os.getenv("DB_URL")
+    DB_USER = os.getenv("DB_USER")
+    DB_PASS = os.getenv("DB_PASS")
+
+    if not DB_URL or not DB_USER or not DB_PASS:
+        raise ValueError("DB_URL, DB_USER, and DB_PASS environment variables must be set.")
+    return DB_URL, DB_USER, DB_PASS
+
+
+class PooledConnection:
+    # Thin wrapper around a surrealdb.Surreal driver that remembers whether
+    # the driver failed with a connection error while it was checked out
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.broken = False
+        self.last_used = time.monotonic()
+
+    def __getattr__(self, name):
+        attr = getattr(self.driver, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                with tracing.span(f"surrealdb.{name}", tracing.CLIENT):
+                    return attr(*args, **kwargs)
+            except CONNECTION_ERRORS:
+                self.broken = True
+                raise
+
+        return call
 
 
 class SurrealInstance:
     def __init__(self):
-        self.app = None,
-        self.driver = None
+        self.app = None
+        self.min_size = 1
+        self.max_size = 10
+        self.timeout = 5.0
+        self.health_check_interval = 30.0
+
+        self._idle = collections.deque()
+        self._size = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self._metrics = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "connect_failures": 0,
+            "health_check_failures": 0,
+            "broken": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
 
     def init_app(self, app):
         self.app = app
-        self.connect()
+        dotenv.load_dotenv()
+        app.config.setdefault("DB_POOL_MIN", int(os.getenv("DB_POOL_MIN", 1)))
+        app.config.setdefault("DB_POOL_MAX", int(os.getenv("DB_POOL_MAX", 10)))
+        app.config.setdefault("DB_POOL_TIMEOUT", float(os.getenv("DB_POOL_TIMEOUT", 5)))
+        app.config.setdefault("DB_POOL_HEALTH_CHECK", float(os.getenv("DB_POOL_HEALTH_CHECK", 30)))
+
+        self.min_size = app.config["DB_POOL_MIN"]
+        self.max_size = max(app.config["DB_POOL_MAX"], self.min_size, 1)
+        self.timeout = app.config["DB_POOL_TIMEOUT"]
+        self.health_check_interval = app.config["DB_POOL_HEALTH_CHECK"]
+
+        app.extensions["surreal"] = self
+        app.teardown_appcontext(self._teardown)
+
+    def start(self):
+        # Open the minimum number of connections up front so the first
+        # requests don't pay for the handshake
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = PooledConnection(self.connect())
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._metrics["connect_failures"] += 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(connection)
+                self._cond.notify()
 
     def connect(self):
-        print("Connecting to SurrealDB...")
-        dotenv.load_dotenv()
-        DB_URL = os.getenv("DB_URL")
-        DB_USER = os.getenv("DB_USER")
-        DB_PASS = os.getenv("DB_PASS")
-
-        if not DB_URL or not DB_USER or not DB_PASS:
-            raise ValueError("DB_URL, DB_USER, and DB_PASS environment variables must be set.")
-    
-        self.driver = surrealdb.Surreal(DB_URL)
-        self.driver.use("Test", "Test")
-        self.driver.signin({
+        logger.info("Connecting to SurrealDB...")
+        DB_URL, DB_USER, DB_PASS = connection_settings()
+
+        driver = surrealdb.Surreal(DB_URL)
+        driver.use("Test", "Test")
+        driver.signin({
             "username": DB_USER,
             "password": DB_PASS
         })
-        print("Connected to SurrealDB!")
-        return self.driver
+        logger.info("Connected to SurrealDB!")
+        return driver
+
+    def acquire(self, timeout=None):
+        # Check a connection out of the pool, opening a new one if the pool
+        # is below its maximum size, otherwise waiting for one to be returned
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        with self._cond:
+            self._waiting += 1
+            try:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._metrics["timeouts"] += 1
+                        raise TimeoutError(f"Timed out after {timeout}s waiting for a SurrealDB connection")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                connection = None
+                self._size += 1
+
+            waited = time.monotonic() - started
+            self._metrics["checkouts"] += 1
+            self._metrics["wait_seconds_total"] += waited
+            self._metrics["wait_seconds_max"] = max(self._metrics["wait_seconds_max"], waited)
+
+        try:
+            if connection is None:
+                connection = self._open()
+            elif not self._healthy(connection):
+                self._close(connection)
+                connection = self._open()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        return connection
+
+    def release(self, connection):
+        if connection.broken:
+            with self._cond:
+                self._metrics["broken"] += 1
+            self.discard(connection)
+            return
+
+        connection.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(connection)
+            self._cond.notify()
+
+    def discard(self, connection):
+        self._close(connection)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        # For code that runs outside of a request (startup, background
+        # threads); inside a request use get_db()
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
 
     def get_db(self):
-        if not self.driver:
-            self.driver = self.connect
-        return self.driver
\ No newline at end of file
+        # One connection per app context, returned to the pool on teardown
+        if not flask.has_app_context():
+            raise RuntimeError("get_db() needs an app context, use sdb.connection() outside of requests")
+
+        if "surreal_connection" not in flask.g:
+            flask.g.surreal_connection = self.acquire()
+        return flask.g.surreal_connection
+
+    def waiting(self):
+        # Requests queued for a connection right now, for load shedding
+        return self._waiting
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._metrics)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            stats["waiting"] = self._waiting
+            stats["min_size"] = self.min_size
+            stats["max_size"] = self.max_size
+        return stats
+
+    def close(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for connection in idle:
+            self._close(connection)
+
+    def _teardown(self, exception):
+        connection = flask.g.pop("surreal_connection", None)
+        if connection is not None:
+            self.release(connection)
+
+    def _open(self):
+        try:
+            return PooledConnection(self.connect())
+        except Exception:
+            with self._cond:
+                self._metrics["connect_failures"] += 1
+            raise
+
+    def _healthy(self, connection):
+        if time.monotonic() - connection.last_used < self.health_check_interval:
+            return True
+        try:
+            connection.driver.query("RETURN true")
+            return True
+        except Exception:
+            logger.warning("SurrealDB connection failed health check, reconnecting")
+            with self._cond:
+                self._metrics["health_check_failures"] += 1
+            return False
+
+    def _close(self, connection):
+        try:
+            connection.driver.close()
+        except Exception:
+            pass
+
+
+class AsyncPooledConnection(PooledConnection):
+    # PooledConnection for surrealdb.AsyncSurreal, whose methods are
+    # coroutines that only fail once awaited
+
+    def __getattr__(self, name):
+        attr = getattr(self.driver, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            try:
+                return await attr(*args, **kwargs)
+            except CONNECTION_ERRORS:
+                self.broken = True
+                raise
+
+        return call
+
+
+class AsyncSurrealInstance:
+    # asyncio counterpart of SurrealInstance for the ASGI entry point. It
+    # reads the same DB_POOL_* settings, but waiting for a connection or a
+    # query suspends the coroutine instead of holding a thread.
+
+    def __init__(self):
+        self.min_size = 1
+        self.max_size = 10
+        self.timeout = 5.0
+        self.health_check_interval = 30.0
+
+        self._idle = collections.deque()
+        self._size = 0
+        # Created on first use so it binds to the running event loop
+        self._cond = None
+        self._metrics = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "connect_failures": 0,
+            "health_check_failures": 0,
+            "broken": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def init_app(self, app):
+        dotenv.load_dotenv()
+        app.config.setdefault("DB_POOL_MIN", int(os.getenv("DB_POOL_MIN", 1)))
+        app.config.setdefault("DB_POOL_MAX", int(os.getenv("DB_POOL_MAX", 10)))
+        app.config.setdefault("DB_POOL_TIMEOUT", float(os.getenv("DB_POOL_TIMEOUT", 5)))
+        app.config.setdefault("DB_POOL_HEALTH_CHECK", float(os.getenv("DB_POOL_HEALTH_CHECK", 30)))
+
+        self.min_size = app.config["DB_POOL_MIN"]
+        self.max_size = max(app.config["DB_POOL_MAX"], self.min_size, 1)
+        self.timeout = app.config["DB_POOL_TIMEOUT"]
+        self.health_check_interval = app.config["DB_POOL_HEALTH_CHECK"]
+        app.extensions["surreal_async"] = self
+
+    async def start(self):
+        while self._size < self.min_size:
+            self._size += 1
+            try:
+                connection = await self._open()
+            except Exception:
+                self._size -= 1
+                raise
+            self._idle.append(connection)
+
+    async def connect(self):
+        logger.info("Connecting to SurrealDB (async)...")
+        DB_URL, DB_USER, DB_PASS = connection_settings()
+
+        driver = surrealdb.AsyncSurreal(DB_URL)
+        if hasattr(driver, "connect"):
+            await driver.connect()
+        await driver.use("Test", "Test")
+        await driver.signin({
+            "username": DB_USER,
+            "password": DB_PASS
+        })
+        logger.info("Connected to SurrealDB (async)!")
+        return driver
+
+    async def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        cond = self._condition()
+
+        async with cond:
+            try:
+                await asyncio.wait_for(
+                    cond.wait_for(lambda: self._idle or self._size < self.max_size),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                self._metrics["timeouts"] += 1
+                raise TimeoutError(f"Timed out after {timeout}s waiting for a SurrealDB connection")
+
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                connection = None
+                self._size += 1
+
+            waited = time.monotonic() - started
+            self._metrics["checkouts"] += 1
+            self._metrics["wait_seconds_total"] += waited
+            self._metrics["wait_seconds_max"] = max(self._metrics["wait_seconds_max"], waited)
+
+        try:
+            if connection is None:
+                connection = await self._open()
+            elif not await self._healthy(connection):
+                await self._close(connection)
+                connection = await self._open()
+        except Exception:
+            async with cond:
+                self._size -= 1
+                cond.notify()
+            raise
+
+        return connection
+
+    async def release(self, connection):
+        if connection.broken:
+            self._metrics["broken"] += 1
+            await self.discard(connection)
+            return
+
+        connection.last_used = time.monotonic()
+        cond = self._condition()
+        async with cond:
+            self._idle.append(connection)
+            cond.notify()
+
+    async def discard(self, connection):
+        await self._close(connection)
+        cond = self._condition()
+        async with cond:
+            self._size -= 1
+            cond.notify()
+
+    @contextlib.asynccontextmanager
+    async def connection(self, timeout=None):
+        connection = await self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            await self.release(connection)
+
+    def stats(self):
+        stats = dict(self._metrics)
+        stats["size"] = self._size
+        stats["idle"] = len(self._idle)
+        stats["in_use"] = self._size - len(self._idle)
+        stats["min_size"] = self.min_size
+        stats["max_size"] = self.max_size
+        return stats
+
+    async def close(self):
+        idle = list(self._idle)
+        self._idle.clear()
+        self._size -= len(idle)
+        for connection in idle:
+            await self._close(connection)
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def _open(self):
+        try:
+            return AsyncPooledConnection(await self.connect())
+        except Exception:
+            self._metrics["connect_failures"] += 1
+            raise
+
+    async def _healthy(self, connection):
+        if time.monotonic() - connection.last_used < self.health_check_interval:
+            return True
+        try:
+            await connection.driver.query("RETURN true")
+            return True
+        except Exception:
+            logger.warning("SurrealDB connection failed health check, reconnecting")
+            self._metrics["health_check_failures"] += 1
+            return False
+
+    async def _close(self, connection):
+        try:
+            await connection.driver.close()
+        except Exception:
+            pass
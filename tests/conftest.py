@@ -0,0 +1,57 @@
+# Fixtures that run the app against SurrealDB's embedded in-memory engine
+#
+# Every test gets a fresh database. The extensions are process-wide
+# singletons whose caches outlive a test, so users get ids unique to the
+# test rather than relying on the caches being cleared.
+
+import uuid
+
+import flask_jwt_extended
+import pytest
+
+import extensions
+import main
+from bench import backend
+
+
+@pytest.fixture
+def app():
+    app = main.create_app({
+        "JWT_SECRET_KEY": "test-secret-key-that-is-long-enough-for-hs256",
+        "LAZY_START": True,
+        "WEBHOOK_DISPATCH": False,
+        "FANOUT_WORKER": False,
+        "JOBS_ENABLED": False,
+        "PASSWORD_HASH_WORKERS": 0,
+        "RATE_LIMIT_ENABLED": False,
+    })
+    backend.configure(extensions.sdb, "mem://", extensions.adb)
+    main.start_services(app)
+    yield app
+    main.stop_services(app)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def db(app):
+    with extensions.sdb.connection() as db:
+        yield db
+
+
+@pytest.fixture
+def make_user(app, db):
+    # make_user() creates a user and returns (user key, auth headers)
+    def make_user():
+        # The letter keeps the key from being all digits, which SurrealDB
+        # writes as user:⟨123⟩ and the routes' f"user:{key}" would not match
+        key = "u" + uuid.uuid4().hex[:12]
+        db.query("CREATE type::thing('user', $key) SET username = $key", {"key": key})
+        with app.app_context():
+            token = flask_jwt_extended.create_access_token(key)
+        return key, {"Authorization": f"Bearer {token}"}
+    return make_user
+
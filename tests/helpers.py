@@ -0,0 +1,70 @@
+# Request helpers shared by the tests
+
+import extensions
+
+
+def create_event(client, headers, title="Event", start="2026-11-02T10:00:00Z", end="2026-11-02T11:00:00Z", **fields):
+    # Creates an event and returns its id without the table name
+    response = client.post("/events/", json={"title": title, "start_time": start, "end_time": end, **fields}, headers=headers)
+    assert response.status_code == 201, response.json
+    return str(response.json["event"][0]["id"]).split(":", 1)[1]
+
+
+def create_relationship_label(client, headers, name="Team"):
+    response = client.post("/relationship-labels/", json={"name": name}, headers=headers)
+    assert response.status_code == 201, response.json
+    return str(response.json["label"][0]["id"]).split(":", 1)[1]
+
+
+def create_event_label(db, client, headers, user, name="Work"):
+    assert client.post("/event-labels/", json={"name": name}, headers=headers).status_code == 201
+    # event_labels.create stores the owner as it was given, a string
+    labels = db.query("SELECT VALUE id FROM event_label WHERE owner = $owner AND name = $name", {"owner": f"user:{user}", "name": name})
+    return str(labels[0]).split(":", 1)[1]
+
+
+def follow_and_tag(client, headers, label, target):
+    assert client.post("/social/following", json={"target_user_id": target}, headers=headers).status_code == 201
+    assert client.put(f"/relationship-labels/{label}/members/{target}", headers=headers).status_code == 200
+
+
+def edge(db, user, event):
+    # user's has_access_to edge on event, or None
+    edges = db.query(
+        "SELECT * FROM has_access_to WHERE in = type::thing('user', $user) AND out = type::thing('calendar_event', $event)",
+        {"user": user, "event": event}
+    )
+    return edges[0] if edges else None
+
+
+def permission(client, headers, event):
+    # The permission GET /events/<id> reports, or None without access
+    response = client.get(f"/events/{event}", headers=headers)
+    return response.json["permission"] if response.status_code == 200 else None
+
+
+def run_fanout():
+    # Runs queued fan-out jobs until none are left
+    while extensions.fanout.run_pending():
+        pass
+
+
+class RecordingConnection:
+    # Stands in for a connection and keeps every query run through it
+    def __init__(self, db):
+        self.db = db
+        self.queries = []
+
+    def query(self, text, vars=None):
+        self.queries.append((text, vars))
+        return self.db.query(text, vars)
+
+
+def explain(db, text, vars=None):
+    # SurrealDB's plan for a single SELECT, one step per dict
+    return db.query(text.strip().rstrip(";") + " EXPLAIN", vars)
+
+
+def indexes(db, text, vars=None):
+    # The indexes the plan for a single SELECT iterates
+    return {step["detail"]["plan"]["index"] for step in explain(db, text, vars) if step["operation"] == "Iterate Index"}
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import threading
+import time
+
+import asgi
+import changelog
+import extensions
+from tests.helpers import create_event
+
+
+def test_long_poll_check_reads_changes_after_the_token(app, client, make_user, monkeypatch):
+    user, headers = make_user()
+    monkeypatch.setattr(changelog, "SETTLE_SECONDS", 0)
+    asgi_app = asgi.AsgiApp(app)
+    token = client.get("/sync/", headers=headers).json["next"]
+    create_event(client, headers)
+    later = client.get("/sync/", query_string={"since": token}, headers=headers).json["next"]
+
+    async def check():
+        try:
+            return [await asgi_app._has_changes(f"user:{user}", *changelog.decode_token(since)) for since in (token, later)]
+        finally:
+            await extensions.adb.close()
+
+    assert asyncio.run(check()) == [True, False]
+
+
+async def call(asgi_app, path, headers=None, query="", disconnect=None):
+    # Runs one GET through the ASGI app; returns (status, body). The client
+    # disconnects once disconnect is set, or after the request otherwise.
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query.encode(),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+    }
+    messages = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        if disconnect is not None:
+            await disconnect.wait()
+        else:
+            await asyncio.Event().wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    status = next(message["status"] for message in messages if message["type"] == "http.response.start")
+    return status, b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+
+
+def run(coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await extensions.adb.close()
+    return asyncio.run(main())
+
+
+def test_other_requests_pass_through_to_flask(app, make_user):
+    user, headers = make_user()
+    asgi_app = asgi.AsgiApp(app)
+
+    status, body = run(call(asgi_app, f"/events/owned-by/{user}", headers))
+
+    assert status == 200
+    assert json.loads(body) == {"events": []}
+
+
+def test_long_poll_returns_when_a_change_lands(app, client, make_user, monkeypatch):
+    user, headers = make_user()
+    monkeypatch.setattr(changelog, "SETTLE_SECONDS", 0)
+    asgi_app = asgi.AsgiApp(app)
+    asgi_app.poll_interval = 0.05
+    token = client.get("/sync/", headers=headers).json["next"]
+    threading.Timer(0.2, create_event, (client, headers)).start()
+
+    started = time.monotonic()
+    status, body = run(call(asgi_app, "/sync/", headers, f"since={token}&wait=10"))
+
+    assert status == 200
+    assert time.monotonic() - started < 5
+    assert {change["table"] for change in json.loads(body)["changes"]} == {"calendar_event", "has_access_to"}
+
+
+def test_long_poll_gives_up_after_wait(app, client, make_user):
+    user, headers = make_user()
+    asgi_app = asgi.AsgiApp(app)
+    token = client.get("/sync/", headers=headers).json["next"]
+
+    started = time.monotonic()
+    status, body = run(call(asgi_app, "/sync/", headers, f"since={token}&wait=0.2"))
+
+    assert status == 200
+    assert time.monotonic() - started >= 0.2
+    assert json.loads(body)["changes"] == []
+
+
+def test_long_poll_leaves_bad_requests_to_flask(app, make_user):
+    user, headers = make_user()
+    asgi_app = asgi.AsgiApp(app)
+
+    assert run(call(asgi_app, "/sync/", headers, "since=not-a-token&wait=1"))[0] == 400
+    assert run(call(asgi_app, "/sync/", {}, "since=not-a-token&wait=1"))[0] == 401
+
+
+def test_live_streams_changes_until_the_client_leaves(app, make_user, monkeypatch):
+    user, headers = make_user()
+    asgi_app = asgi.AsgiApp(app)
+    monkeypatch.setattr(extensions.change_feed, "heartbeat", 0.05)
+
+    async def stream():
+        disconnect = asyncio.Event()
+        response = asyncio.create_task(call(asgi_app, "/live", headers, disconnect=disconnect))
+        while not extensions.change_feed.stats()["subscribers"]:
+            await asyncio.sleep(0.01)
+        extensions.change_feed._broadcast({"type": "resync"})
+        await asyncio.sleep(0.1)
+        disconnect.set()
+        return await response
+
+    status, body = run(stream())
+
+    assert status == 200
+    assert body.startswith(b"retry: 5000\n\n")
+    assert b"event: resync\n" in body and b": heartbeat\n" in body
+    assert extensions.change_feed.stats()["subscribers"] == 0
+    assert run(call(asgi_app, "/live"))[0] == 401
@@ -0,0 +1,39 @@
+from tests.helpers import create_event
+
+
+def befriend(client, one, two):
+    client.post("/social/following", json={"target_user_id": two[0]}, headers=one[1])
+    client.post("/social/following", json={"target_user_id": one[0]}, headers=two[1])
+
+
+def find(client, headers, users):
+    return client.post("/availability/", json={
+        "users": users, "from": "2026-11-02T09:00:00Z", "to": "2026-11-02T17:00:00Z", "duration_minutes": 30
+    }, headers=headers)
+
+
+def test_friends_busy_time_counts_only_events_they_own(client, make_user):
+    alice, bob = make_user(), make_user()
+    befriend(client, alice, bob)
+    create_event(client, bob[1], "Standup", "2026-11-02T10:00:00Z", "2026-11-02T11:00:00Z")
+    create_event(client, bob[1], "Focus", "2026-11-02T14:00:00Z", "2026-11-02T15:00:00Z", busy=False)
+    shared = create_event(client, alice[1], "Lunch", "2026-11-02T12:00:00Z", "2026-11-02T13:00:00Z")
+    client.post(f"/events/{shared}/share", json={"shares": [{"user_id": bob[0], "share": "view"}]}, headers=alice[1])
+
+    response = find(client, alice[1], [bob[0]])
+
+    assert response.status_code == 200
+    assert response.json["busy"][f"user:{bob[0]}"] == [{"start": "2026-11-02T10:00:00", "end": "2026-11-02T11:00:00"}]
+    assert response.json["busy"][f"user:{alice[0]}"] == [{"start": "2026-11-02T12:00:00", "end": "2026-11-02T13:00:00"}]
+    assert response.json["free"][0] == {"start": "2026-11-02T09:00:00", "end": "2026-11-02T10:00:00"}
+
+
+def test_users_who_are_not_friends_stay_hidden(client, make_user):
+    alice, bob = make_user(), make_user()
+    # A one-way follow isn't enough
+    client.post("/social/following", json={"target_user_id": alice[0]}, headers=bob[1])
+
+    response = find(client, alice[1], [bob[0]])
+
+    assert response.status_code == 403
+    assert response.json["users"] == [f"user:{bob[0]}"]
@@ -0,0 +1,110 @@
+import random
+
+import extensions
+from conflicts import Calendar, IntervalTree
+from tests.helpers import create_event
+
+DAY = {"from": "2026-11-02T00:00:00Z", "to": "2026-11-03T00:00:00Z"}
+
+
+def ordered(intervals):
+    return sorted(intervals, key=lambda interval: (interval[0], interval[1], interval[2]["id"]))
+
+
+def brute_force(intervals, start, end):
+    return ordered(interval for interval in intervals if interval[0] < end and interval[1] > start)
+
+
+def random_intervals(rng, count):
+    intervals = []
+    for number in range(count):
+        start = rng.randrange(1000)
+        intervals.append((start, start + rng.choice([1, 5, 30, 300]), {"id": f"calendar_event:{number}"}))
+    return intervals
+
+
+def test_interval_tree_matches_brute_force():
+    rng = random.Random(7)
+    for count in (0, 1, 2, 3, 10, 257):
+        intervals = random_intervals(rng, count)
+        tree = IntervalTree(intervals)
+        for _ in range(200):
+            start = rng.randrange(-10, 1100)
+            end = start + rng.randrange(1, 200)
+            found = tree.overlapping(start, end)
+            assert [interval[:2] for interval in found] == sorted(interval[:2] for interval in found)
+            assert ordered(found) == brute_force(intervals, start, end)
+
+
+def test_interval_tree_treats_intervals_as_half_open():
+    tree = IntervalTree([(10, 20, {"id": "a"})])
+
+    assert tree.overlapping(20, 30) == []
+    assert tree.overlapping(0, 10) == []
+    assert len(tree.overlapping(19, 21)) == 1
+
+
+def test_calendar_changes_match_a_fresh_load():
+    rng = random.Random(11)
+    rows = [
+        (f"calendar_event:{number}", "Event", f"2026-11-{day:02d}T{hour:02d}:00:00", f"2026-11-{day:02d}T{hour + 1:02d}:00:00", None, None)
+        for number, (day, hour) in enumerate((rng.randrange(1, 29), rng.randrange(0, 23)) for _ in range(50))
+    ]
+    calendar = Calendar(rows, 0, 0)
+    events = {row[0]: dict(zip(("id", "title", "start_time", "end_time"), row[:4])) for row in rows}
+    for step in range(120):
+        event_id = f"calendar_event:{rng.randrange(70)}"
+        if rng.random() < 0.3:
+            events.pop(event_id, None)
+            calendar.change(event_id, None)
+        else:
+            day, hour = rng.randrange(1, 29), rng.randrange(0, 23)
+            events[event_id] = {"id": event_id, "title": "Event", "start_time": f"2026-11-{day:02d}T{hour:02d}:00:00", "end_time": f"2026-11-{day:02d}T{hour + 1:02d}:00:00"}
+            calendar.change(event_id, events[event_id])
+        if step % 40 == 39:
+            calendar.rebuild()
+
+        fresh = Calendar([(event["id"], "Event", event["start_time"], event["end_time"], None, None) for event in events.values()], 0, 0)
+        window = fresh.tree.intervals[rng.randrange(len(fresh.tree))][:2]
+        assert sorted(item["id"] for _, _, item in calendar.overlapping(*window)) == sorted(item["id"] for _, _, item in fresh.overlapping(*window))
+
+
+def test_recurring_events_conflict_occurrence_by_occurrence(client, make_user):
+    user, headers = make_user()
+    create_event(client, headers, "Weekly", "2026-11-02T09:00:00Z", "2026-11-02T10:00:00Z", recurrence={"rrule": "FREQ=WEEKLY;COUNT=10"})
+
+    clash = client.post("/events/", json={"title": "Clash", "start_time": "2026-11-23T09:30:00Z", "end_time": "2026-11-23T10:30:00Z", "conflict_policy": "reject"}, headers=headers)
+    after_series = client.post("/events/", json={"title": "Later", "start_time": "2027-01-11T09:30:00Z", "end_time": "2027-01-11T10:30:00Z", "conflict_policy": "reject"}, headers=headers)
+
+    assert clash.status_code == 409
+    assert clash.json["conflicts"][0]["recurrence_id"].startswith("2026-11-23T09:00:00")
+    assert after_series.status_code == 201
+
+
+def conflicts(client, headers):
+    return [event["title"] for event in client.get("/events/conflicts", query_string=DAY, headers=headers).json["conflicts"]]
+
+
+def test_writes_in_this_process_update_the_cached_calendar(client, make_user):
+    user, headers = make_user()
+    create_event(client, headers, "Standup")
+    assert conflicts(client, headers) == ["Standup"]
+    misses = extensions.conflicts.stats()["misses"]
+
+    create_event(client, headers, "Review", "2026-11-02T14:00:00Z", "2026-11-02T15:00:00Z")
+
+    assert conflicts(client, headers) == ["Standup", "Review"]
+    assert extensions.conflicts.stats()["misses"] == misses
+
+
+def test_writes_through_another_worker_are_seen_on_the_next_check(client, make_user, monkeypatch):
+    user, headers = make_user()
+    create_event(client, headers, "Standup")
+    assert conflicts(client, headers) == ["Standup"]
+
+    # Another worker's cache is the one its writes update
+    monkeypatch.setattr(extensions.conflicts, "apply", lambda *args: None)
+    create_event(client, headers, "Review", "2026-11-02T14:00:00Z", "2026-11-02T15:00:00Z")
+    monkeypatch.undo()
+
+    assert conflicts(client, headers) == ["Standup", "Review"]
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+from surrealdb import RecordID
+
+from pagination import encode_cursor
+from queries import STATEMENTS
+from tests.helpers import create_event, explain
+
+RANGE = {"from": "2026-11-01T00:00:00Z", "to": "2026-11-08T00:00:00Z"}
+
+
+def test_range_pages_follow_the_cursor(client, make_user):
+    user, headers = make_user()
+    for day in (4, 2, 3):
+        create_event(client, headers, f"Day {day}", f"2026-11-0{day}T10:00:00Z", f"2026-11-0{day}T11:00:00Z")
+
+    titles, cursor = [], None
+    while True:
+        response = client.get("/events/", query_string={**RANGE, "limit": 2, **({"cursor": cursor} if cursor else {})}, headers=headers)
+        assert response.status_code == 200
+        titles += [event["title"] for event in response.json["events"]]
+        cursor = response.json["next_cursor"]
+        if cursor is None:
+            break
+
+    assert titles == ["Day 2", "Day 3", "Day 4"]
+
+
+def test_forged_cursors_are_refused(client, make_user):
+    user, headers = make_user()
+    create_event(client, headers)
+
+    for cursor in ("not a cursor", encode_cursor("2026-11-02T10:00:00Z", "x'); --"), encode_cursor("2026-11-02T10:00:00Z", 7),
+                   encode_cursor("2026-11-02T10:00:00Z", "user:bob")):
+        response = client.get("/events/", query_string={**RANGE, "cursor": cursor}, headers=headers)
+        assert response.status_code == 400, cursor
+
+
+@pytest.mark.parametrize("name", ["events.range_single", "events.range_series"])
+def test_range_statements_read_only_the_users_events(client, db, make_user, name):
+    user, headers = make_user()
+    create_event(client, headers)
+    create_event(client, headers, recurrence="FREQ=DAILY")
+    vars = {"user_id": RecordID("user", user), "after_start": None, "after_id": None, "limit": 10,
+            "from": RANGE["from"], "to": RANGE["to"]}
+
+    # The events come from the user's edges, not a scan of calendar_event
+    # testing a subquery per row
+    plan = explain(db, STATEMENTS[name].text, vars)
+
+    assert {step["operation"] for step in plan} == {"Iterate Thing", "Collector"}
+
+
+@pytest.mark.parametrize("body", [None, [], "title", {"content": None}, {"content": ["title"]}])
+def test_update_refuses_bodies_that_are_not_objects(client, make_user, body):
+    user, headers = make_user()
+    event = create_event(client, headers)
+
+    response = client.put(f"/events/{event}", data=json.dumps(body), content_type="application/json", headers=headers)
+
+    assert response.status_code == 400
+    assert client.get(f"/events/{event}", headers=headers).json["event"]["title"] == "Event"
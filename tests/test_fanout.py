@@ -0,0 +1,109 @@
+import pytest
+
+from tests.helpers import create_event, create_event_label, create_relationship_label, edge, follow_and_tag, permission, run_fanout
+
+
+@pytest.fixture
+def labelled(client, db, make_user):
+    # An event labelled "Work" by its owner, who follows bob and has a
+    # "Team" relationship label
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    work = create_event_label(db, client, owner_headers, owner)
+    team = create_relationship_label(client, owner_headers, "Team")
+    follow_and_tag(client, owner_headers, team, bob)
+    assert client.put(f"/events/{event}/labels", json={"label_ids": [work]}, headers=owner_headers).status_code == 200
+    return {"owner": owner_headers, "bob": bob, "bob_headers": bob_headers, "event": event, "work": work, "team": team}
+
+
+def grant(client, labelled, group, share):
+    response = client.put(f"/event-labels/{labelled['work']}/groups/{group}", json={"share": share}, headers=labelled["owner"])
+    assert response.status_code == 202, response.json
+    run_fanout()
+
+
+def revoke(client, labelled, group):
+    response = client.delete(f"/event-labels/{labelled['work']}/groups/{group}", headers=labelled["owner"])
+    assert response.status_code == 202, response.json
+    run_fanout()
+
+
+def test_revoking_a_grant_gives_back_the_permission_it_raised(client, db, labelled):
+    event, bob = labelled["event"], labelled["bob"]
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "view"}]}, headers=labelled["owner"])
+
+    grant(client, labelled, labelled["team"], "admin")
+    assert permission(client, labelled["bob_headers"], event) == "admin"
+
+    revoke(client, labelled, labelled["team"])
+    link = edge(db, bob, event)
+    assert link["because_of"] == ["direct"]
+    assert link["permission"] == "view"
+    assert permission(client, labelled["bob_headers"], event) == "view"
+
+
+def test_grants_are_reference_counted(client, db, labelled):
+    event, bob = labelled["event"], labelled["bob"]
+    pals = create_relationship_label(client, labelled["owner"], "Pals")
+    assert client.put(f"/relationship-labels/{pals}/members/{bob}", headers=labelled["owner"]).status_code == 200
+
+    grant(client, labelled, labelled["team"], "view")
+    grant(client, labelled, pals, "edit")
+    link = edge(db, bob, event)
+    assert link["label_refs"] == [f"event_label:{labelled['work']}"] * 2
+    assert link["permission"] == "edit"
+
+    revoke(client, labelled, pals)
+    link = edge(db, bob, event)
+    assert link["label_refs"] == [f"event_label:{labelled['work']}"]
+    assert link["permission"] == "view"
+
+    revoke(client, labelled, labelled["team"])
+    assert edge(db, bob, event) is None
+    assert permission(client, labelled["bob_headers"], event) is None
+
+
+def test_deleting_the_event_label_recomputes_the_permission(client, db, labelled):
+    event, bob = labelled["event"], labelled["bob"]
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "view"}]}, headers=labelled["owner"])
+    grant(client, labelled, labelled["team"], "admin")
+
+    assert client.delete(f"/event-labels/{labelled['work']}", headers=labelled["owner"]).status_code == 204
+    link = edge(db, bob, event)
+    assert link["because_of"] == ["direct"]
+    assert link["permission"] == "view"
+    assert permission(client, labelled["bob_headers"], event) == "view"
+
+
+def test_untagging_a_member_removes_their_access(client, db, labelled):
+    event, bob = labelled["event"], labelled["bob"]
+    grant(client, labelled, labelled["team"], "edit")
+    assert permission(client, labelled["bob_headers"], event) == "edit"
+
+    assert client.delete(f"/relationship-labels/{labelled['team']}/members/{bob}", headers=labelled["owner"]).status_code == 200
+    run_fanout()
+    assert edge(db, bob, event) is None
+    assert permission(client, labelled["bob_headers"], event) is None
+
+
+def test_blocking_a_member_takes_away_their_groups_grants(client, labelled):
+    event = labelled["event"]
+    grant(client, labelled, labelled["team"], "edit")
+    assert permission(client, labelled["bob_headers"], event) == "edit"
+
+    assert client.post("/social/block", json={"target_user_id": labelled["bob"]}, headers=labelled["owner"]).status_code == 201
+    run_fanout()
+
+    assert permission(client, labelled["bob_headers"], event) is None
+
+
+def test_tagging_a_member_later_gives_them_the_groups_grants(client, make_user, labelled):
+    carol, carol_headers = make_user()
+    grant(client, labelled, labelled["team"], "view")
+    assert permission(client, carol_headers, labelled["event"]) is None
+
+    follow_and_tag(client, labelled["owner"], labelled["team"], carol)
+    run_fanout()
+
+    assert permission(client, carol_headers, labelled["event"]) == "view"
@@ -0,0 +1,88 @@
+import json
+
+from surrealdb import RecordID
+
+from queries import STATEMENTS
+from recurrence import parse_datetime
+from tests.helpers import create_event, explain
+
+
+def export(client, headers, export_format="ndjson"):
+    response = client.get("/events/export", query_string={"format": export_format}, headers=headers)
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def import_(client, headers, body, mimetype):
+    response = client.post("/events/import", data=body, content_type=mimetype, headers=headers)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def comparable(events):
+    # What an export has to carry across, whatever the timestamp format
+    recurrence = lambda event: event.get("recurrence") or {}
+    return sorted(
+        (
+            event["title"], event.get("description"), parse_datetime(event["start_time"]), parse_datetime(event["end_time"]),
+            recurrence(event).get("rrule"), tuple(sorted(parse_datetime(exdate) for exdate in recurrence(event).get("exdates") or ()))
+        )
+        for event in events
+    )
+
+
+def seed(client, headers):
+    create_event(client, headers, "Plain")
+    series = create_event(client, headers, "Escaped, with; separators\nand a newline", "2026-11-02T09:00:00Z", "2026-11-02T09:30:00Z",
+                          recurrence="FREQ=DAILY;COUNT=5", description="Standup")
+    assert client.delete(f"/events/{series}/occurrences/2026-11-03T09:00:00Z", headers=headers).status_code == 200
+
+
+def test_export_pages_read_only_the_users_events(client, db, make_user):
+    user, headers = make_user()
+    create_event(client, headers)
+
+    plan = explain(db, STATEMENTS["events.export_page"].text, {
+        "user_id": RecordID("user", user), "after_start": None, "after_id": None, "limit": 10
+    })
+
+    assert {step["operation"] for step in plan} == {"Iterate Thing", "Collector"}
+
+
+def test_ndjson_export_imports_back_as_the_same_events(client, make_user):
+    alice, alice_headers = make_user()
+    bob, bob_headers = make_user()
+    seed(client, alice_headers)
+    exported = export(client, alice_headers)
+
+    assert import_(client, bob_headers, exported, "application/x-ndjson")[-1] == {"type": "done", "processed": 2, "imported": 2, "failed": 0}
+
+    events = [json.loads(line) for line in export(client, bob_headers).splitlines()]
+    assert comparable(events) == comparable(json.loads(line) for line in exported.splitlines())
+    assert not {event["id"] for event in events} & {json.loads(line)["id"] for line in exported.splitlines()}
+
+
+def test_ics_export_imports_back_as_the_same_events(client, make_user):
+    alice, alice_headers = make_user()
+    bob, bob_headers = make_user()
+    seed(client, alice_headers)
+
+    assert import_(client, bob_headers, export(client, alice_headers, "ics"), "text/calendar")[-1]["imported"] == 2
+
+    expected = [json.loads(line) for line in export(client, alice_headers).splitlines()]
+    assert comparable(json.loads(line) for line in export(client, bob_headers).splitlines()) == comparable(expected)
+    assert "SUMMARY:Escaped\\, with\\; separators\\nand a newline" in export(client, bob_headers, "ics")
+
+
+def test_bad_records_are_reported_and_the_rest_imported_in_batches(app, client, make_user):
+    app.config["EVENTS_IMPORT_BATCH"] = 2
+    user, headers = make_user()
+    good = json.dumps({"title": "Good", "start_time": "2026-11-02T10:00:00Z", "end_time": "2026-11-02T11:00:00Z"})
+    body = "\n".join([good, "{not json", good, json.dumps(["not", "an", "object"]), good, json.dumps({"title": "No times"})])
+
+    lines = import_(client, headers, body, "application/x-ndjson")
+
+    assert [line["record"] for line in lines if line["type"] == "error"] == [2, 4, 6]
+    assert [line["processed"] for line in lines if line["type"] == "progress"] == [3]
+    assert lines[-1] == {"type": "done", "processed": 6, "imported": 3, "failed": 3}
+    assert len(export(client, headers).splitlines()) == 3
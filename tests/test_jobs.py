@@ -0,0 +1,101 @@
+import time
+
+import pytest
+from surrealdb import RecordID
+
+import extensions
+import jobs
+from jobs import JobScheduler
+from tests.helpers import create_event
+
+
+def scheduler(holder, batch_size=500):
+    scheduler = JobScheduler(extensions.sdb)
+    scheduler.holder = holder
+    scheduler.batch_size = batch_size
+    scheduler.throttle = 0
+    return scheduler
+
+
+def test_one_process_holds_the_lease_until_it_runs_out(app, db):
+    first, second = scheduler("first"), scheduler("second")
+
+    first._renew()
+    second._renew()
+    assert first._leader and not second._leader
+
+    # Renewing keeps it; once it lapses the other process takes it
+    first._renew()
+    assert first._leader
+    db.query("UPDATE job_lease:scheduler SET expires = time::now() - 1s")
+    second._renew()
+    first._renew()
+    assert second._leader and not first._leader
+
+    second._release()
+    first._renew()
+    assert first._leader
+
+
+def test_a_new_leader_keeps_the_schedule(app, db):
+    first, second = scheduler("first"), scheduler("second")
+    for each in (first, second):
+        each.intervals = {"noop": 3600}
+        each.register("noop", lambda scheduler, db: {"ok": True})
+    first._renew()
+    assert first.run("noop")["last_result"] == {"ok": True}
+
+    first._release()
+    second._renew()
+
+    assert second._leader
+    assert not second._jobs["noop"].due(time.time())
+
+
+@pytest.mark.parametrize("batch_size", [3, 100])
+def test_expired_tokens_are_purged_in_batches(app, db, batch_size):
+    now = int(time.time())
+    db.query("INSERT INTO blocked_token $rows", {"rows": [
+        {"jti": f"expired-{number}", "expiry": now - 60} for number in range(7)
+    ] + [
+        {"jti": f"live-{number}", "expiry": now + 3600} for number in range(2)
+    ]})
+    purger = scheduler("purger", batch_size)
+    selects = []
+    query = db.query
+
+    class Counting:
+        def query(self, text, vars=None):
+            if text.startswith("SELECT"):
+                selects.append(text)
+            return query(text, vars)
+
+    assert jobs.purge_expired_tokens(purger, Counting()) == {"removed": 7}
+
+    assert sorted(db.query("SELECT VALUE jti FROM blocked_token")) == ["live-0", "live-1"]
+    assert len(selects) == (3 if batch_size == 3 else 1)
+
+
+def test_batches_stop_when_the_process_is_stopping(app, db):
+    now = int(time.time())
+    db.query("INSERT INTO blocked_token $rows", {"rows": [{"jti": f"expired-{number}", "expiry": now - 60} for number in range(7)]})
+    purger = scheduler("purger", 3)
+    purger._stop.set()
+
+    assert jobs.purge_expired_tokens(purger, db) == {"removed": 3}
+
+
+def test_orphaned_edges_are_found_across_pages(app, client, db, make_user):
+    user, headers = make_user()
+    for number in range(2):
+        create_event(client, headers, f"Event {number}")
+    # Edges to events that are gone, which deleting the event itself would
+    # have taken with it
+    db.query("INSERT RELATION INTO has_access_to $edges", {"edges": [
+        {"in": RecordID("user", user), "out": RecordID("calendar_event", f"gone{number}"), "permission": "owner"} for number in range(3)
+    ]})
+
+    result = jobs.purge_orphaned_edges(scheduler("purger", 2), db)
+
+    assert result == {"scanned": 5, "removed": 3}
+    assert len(db.query("SELECT * FROM has_access_to")) == 2
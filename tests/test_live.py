@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+import threading
+import time
+import uuid
+
+from surrealdb import RecordID
+
+import extensions
+from live import ACTION_FIELD, LIVE_TABLES, ChangeFeed, Subscription
+from tests.helpers import RecordingConnection, create_event, indexes
+
+
+def feed_with(*user_ids):
+    # A feed with a subscriber per user and no upstream connection
+    feed = ChangeFeed(None, None)
+    subscriptions = {}
+    for user_id in user_ids:
+        subscriptions[user_id] = Subscription(user_id, 16)
+        feed._subscribers[user_id].add(subscriptions[user_id])
+    return feed, subscriptions
+
+
+def test_followed_user_gets_relationship_changes_without_labels():
+    feed, subscriptions = feed_with("user:a", "user:b")
+    record = {"id": "relationship_with:1", "in": "user:a", "out": "user:b", "type": "following", "labels": ["relationship_label:x"]}
+
+    feed._dispatch("relationship_with", "UPDATE", record)
+
+    assert subscriptions["user:a"].get(0)["record"] == record
+    assert "labels" not in subscriptions["user:b"].get(0)["record"]
+
+
+def test_blocked_user_is_not_told():
+    feed, subscriptions = feed_with("user:a", "user:b")
+    record = {"id": "relationship_with:1", "in": "user:a", "out": "user:b", "type": "blocked", "labels": []}
+
+    feed._dispatch("relationship_with", "CREATE", record)
+    feed._dispatch("relationship_with", "DELETE", record)
+
+    assert subscriptions["user:a"].get(0)["action"] == "CREATE"
+    assert subscriptions["user:a"].get(0)["action"] == "DELETE"
+    assert subscriptions["user:b"].get(0) is None
+
+
+def test_event_audience_is_read_through_the_edge_index(client, db, make_user):
+    user, headers = make_user()
+    event = create_event(client, headers)
+    connection = RecordingConnection(db)
+
+    class Connections:
+        @contextlib.contextmanager
+        def connection(self):
+            yield connection
+
+    assert ChangeFeed(Connections(), None)._event_audience(f"calendar_event:{event}") == {f"user:{user}"}
+
+    assert indexes(db, *connection.queries[0]) == {"has_access_to_out"}
+
+
+class Upstream:
+    # The public live query API of an async SurrealDB connection, with
+    # notify() standing in for the server
+    def __init__(self):
+        self.connections = 0
+        self.ready = threading.Event()
+        self.fail = None
+        self._queues = {}
+
+    async def connect(self):
+        self.connections += 1
+        self.ready.clear()
+        self._loop = asyncio.get_running_loop()
+        self._queues = {}
+        return self
+
+    async def query(self, text, vars=None):
+        if self.fail:
+            raise self.fail
+        if text.startswith("LIVE SELECT"):
+            query_uuid = uuid.uuid4()
+            self._queues[str(query_uuid)] = (text.rsplit(" FROM ", 1)[1], asyncio.Queue())
+            return query_uuid
+        return True
+
+    async def subscribe_live(self, query_uuid):
+        table, notifications = self._queues[str(query_uuid)]
+        if len(self._queues) == len(LIVE_TABLES):
+            self.ready.set()
+
+        async def records():
+            while True:
+                yield await notifications.get()
+
+        return records()
+
+    def notify(self, table, record):
+        for name, notifications in self._queues.values():
+            if name == table:
+                self._loop.call_soon_threadsafe(notifications.put_nowait, record)
+
+    async def close(self):
+        pass
+
+
+def test_upstream_notifications_reach_subscribers(client, make_user):
+    user, headers = make_user()
+    event = create_event(client, headers)
+    upstream = Upstream()
+    feed = ChangeFeed(extensions.sdb, upstream)
+    subscription = feed.subscribe(f"user:{user}")
+    try:
+        assert upstream.ready.wait(5)
+        upstream.notify("calendar_event", {"id": RecordID("calendar_event", event), "title": "Moved", ACTION_FIELD: "UPDATE"})
+        # Deleted records come back without the projected action
+        upstream.notify("calendar_event", {"id": RecordID("calendar_event", event), "title": "Moved"})
+        updated, deleted = subscription.get(5), subscription.get(5)
+    finally:
+        feed.stop()
+
+    assert updated == {"type": "change", "table": "calendar_event", "action": "UPDATE", "record": {"id": RecordID("calendar_event", event), "title": "Moved"}}
+    assert deleted["action"] == "DELETE"
+    assert feed.stats()["delivered"] == 2
+
+
+def test_lost_upstream_reconnects_and_resyncs():
+    upstream = Upstream()
+    feed = ChangeFeed(None, upstream)
+    feed.heartbeat = 0.01
+    subscription = feed.subscribe("user:a")
+    try:
+        assert upstream.ready.wait(5)
+        upstream.fail = ConnectionError("socket closed")
+        # The ping fails and the reconnect backs off before trying again
+        time.sleep(0.1)
+        upstream.fail = None
+        change = subscription.get(5)
+    finally:
+        feed.stop()
+
+    assert change == {"type": "resync"}
+    assert upstream.connections >= 2
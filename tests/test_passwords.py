@@ -0,0 +1,125 @@
+import time
+import uuid
+
+import pytest
+
+import extensions
+import passwords
+from passwords import HashingBusy, PasswordHasher
+
+
+def register(client, password="correct horse"):
+    name = "p" + uuid.uuid4().hex[:12]
+    email = f"{name}@example.com"
+    response = client.post("/auth/register", json={"username": name, "email": email, "password": password})
+    assert response.status_code == 200, response.json
+    return email
+
+
+def login(client, email, password="correct horse"):
+    return client.post("/auth/login", json={"email": email, "password": password})
+
+
+def stored_hash(db, email):
+    return db.query("SELECT VALUE password FROM user WHERE email = $email", {"email": email})[0]
+
+
+@pytest.mark.parametrize("method, normalized", [
+    ("scrypt", "scrypt:32768:8:1"),
+    ("scrypt:16384:8:1", "scrypt:16384:8:1"),
+    ("pbkdf2", f"pbkdf2:sha256:{passwords.DEFAULT_PBKDF2_ITERATIONS}"),
+    ("pbkdf2:sha512:1000", "pbkdf2:sha512:1000"),
+    ("argon2", "argon2:3:65536:4"),
+])
+def test_methods_are_normalized_to_the_hash_prefix(method, normalized):
+    assert passwords.normalize_method(method) == normalized
+
+
+def test_unknown_methods_are_refused():
+    with pytest.raises(ValueError):
+        passwords.normalize_method("md5")
+
+
+def test_login_checks_the_password(client):
+    email = register(client)
+
+    assert login(client, email).status_code == 200
+    assert login(client, email, "wrong").status_code == 401
+    assert login(client, "nobody@example.com").status_code == 401
+
+
+def test_old_hashes_are_upgraded_on_login(client, db, monkeypatch):
+    monkeypatch.setattr(extensions.passwords, "method", "pbkdf2:sha256:1000")
+    email = register(client)
+    assert stored_hash(db, email).startswith("pbkdf2:sha256:1000$")
+
+    monkeypatch.setattr(extensions.passwords, "method", "scrypt:16384:8:1")
+    assert login(client, email).status_code == 200
+    upgraded = stored_hash(db, email)
+    assert upgraded.startswith("scrypt:16384:8:1$")
+
+    # Already current, so left alone
+    assert login(client, email).status_code == 200
+    assert stored_hash(db, email) == upgraded
+    assert login(client, email, "wrong").status_code == 401
+
+
+def test_slots_are_capped_per_account_address_and_server():
+    hasher = PasswordHasher()
+    hasher.workers, hasher.method = 0, "pbkdf2:sha256:1000"
+    hasher.max_pending, hasher.max_per_account, hasher.max_per_ip = 3, 1, 2
+
+    hasher._acquire("a@example.com", "10.0.0.1")
+    with pytest.raises(HashingBusy) as busy:
+        hasher.hash("secret", "a@example.com", "10.0.0.2")
+    assert busy.value.scope == "account"
+
+    hasher.hash("secret", "b@example.com", "10.0.0.1")
+    hasher._acquire("c@example.com", "10.0.0.1")
+    with pytest.raises(HashingBusy) as busy:
+        hasher.hash("secret", "d@example.com", "10.0.0.1")
+    assert busy.value.scope == "ip"
+
+    hasher._acquire("e@example.com", "10.0.0.3")
+    with pytest.raises(HashingBusy) as busy:
+        hasher.hash("secret", "f@example.com", "10.0.0.4")
+    assert busy.value.scope == "server"
+
+    for account, ip in (("a@example.com", "10.0.0.1"), ("c@example.com", "10.0.0.1"), ("e@example.com", "10.0.0.3")):
+        hasher._release(account, ip)
+    assert hasher.stats()["pending"] == 0
+    assert hasher._accounts == {} and hasher._ips == {}
+    assert hasher.stats()["rejected_account"] == hasher.stats()["rejected_ip"] == hasher.stats()["rejected_server"] == 1
+
+
+def test_busy_accounts_get_a_429_with_retry_after(client):
+    email = register(client)
+    extensions.passwords._acquire(email, None)
+    extensions.passwords._acquire(email, None)
+    try:
+        response = login(client, email)
+    finally:
+        extensions.passwords._release(email, None)
+        extensions.passwords._release(email, None)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert login(client, email).status_code == 200
+
+
+def test_the_process_pool_hashes_and_frees_its_slots():
+    hasher = PasswordHasher()
+    hasher.workers, hasher.method = 1, "pbkdf2:sha256:1000"
+    try:
+        stored = hasher.hash("secret", "a@example.com", "10.0.0.1")
+        assert hasher.check(stored, "secret", "a@example.com", "10.0.0.1") == (True, None)
+        assert hasher.check(stored, "wrong", "a@example.com", "10.0.0.1") == (False, None)
+    finally:
+        hasher.stop()
+
+    # Slots are freed by a callback that can run just after the result
+    deadline = time.monotonic() + 5
+    while hasher.stats()["pending"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert hasher.stats()["pending"] == 0
+    assert hasher.stats()["checked"] == 2
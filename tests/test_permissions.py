@@ -0,0 +1,73 @@
+import extensions
+from tests.helpers import RecordingConnection, create_event, create_relationship_label, follow_and_tag, indexes, permission
+
+
+def test_resolve_that_raced_an_invalidation_is_not_cached(client, db, make_user, monkeypatch):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    resolver = extensions.permissions
+    resolve = resolver._resolve
+
+    def racing_resolve(db, user_id, event_ids):
+        # The share lands after the edges were read but before they're stored
+        resolved = resolve(db, user_id, event_ids)
+        client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "edit"}]}, headers=owner_headers)
+        return resolved
+
+    monkeypatch.setattr(resolver, "_resolve", racing_resolve)
+    assert resolver.get(db, f"user:{bob}", f"calendar_event:{event}") is None
+    monkeypatch.setattr(resolver, "_resolve", resolve)
+
+    assert permission(client, bob_headers, event) == "edit"
+
+
+def test_share_and_unshare_invalidate_cached_answers(client, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    assert permission(client, bob_headers, event) is None
+
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "view"}]}, headers=owner_headers)
+    assert permission(client, bob_headers, event) == "view"
+
+    client.delete(f"/events/{event}/share", json={"shares": [{"user_id": bob}]}, headers=owner_headers)
+    assert permission(client, bob_headers, event) is None
+
+
+def test_deleting_the_event_drops_cached_answers(client, db, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "view"}]}, headers=owner_headers)
+    assert extensions.permissions.get(db, f"user:{bob}", f"calendar_event:{event}") == "view"
+
+    assert client.delete(f"/events/{event}", headers=owner_headers).status_code == 200
+
+    assert extensions.permissions.get(db, f"user:{bob}", f"calendar_event:{event}") is None
+
+
+def test_deleting_a_relationship_label_drops_answers_that_relied_on_it(client, db, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    label = create_relationship_label(client, owner_headers)
+    follow_and_tag(client, owner_headers, label, bob)
+    client.post(f"/events/{event}/share", json={"groups": [{"label_id": label, "share": "edit"}]}, headers=owner_headers)
+    assert permission(client, bob_headers, event) == "edit"
+
+    client.delete(f"/relationship-labels/{label}", headers=owner_headers)
+
+    assert permission(client, bob_headers, event) is None
+
+
+
+def test_resolve_reads_the_users_edges_through_the_index(client, db, make_user):
+    owner, owner_headers = make_user()
+    event = create_event(client, owner_headers)
+    connection = RecordingConnection(db)
+
+    assert extensions.permissions._resolve(connection, f"user:{owner}", [f"calendar_event:{event}"])[f"calendar_event:{event}"][0] == "owner"
+
+    text, vars = connection.queries[0]
+    assert indexes(db, text, vars) == {"has_access_to_out"}
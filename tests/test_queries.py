@@ -0,0 +1,45 @@
+import re
+
+import pytest
+
+import extensions
+from queries import STATEMENTS
+from tests.helpers import RecordingConnection, create_event, indexes
+
+
+def test_a_record_cast_in_the_query_falls_back_to_a_table_scan(db):
+    assert indexes(db, "SELECT * FROM has_access_to WHERE in = <record> $user_id", {"user_id": "user:a"}) == set()
+
+
+@pytest.mark.parametrize("name, index", [
+    ("events.owner", "has_access_to_out"),
+    ("events.audience", "has_access_to_out"),
+    ("events.links", "has_access_to_out"),
+    ("events.shares", "has_access_to_out"),
+])
+def test_record_vars_are_sent_as_record_ids_and_use_the_index(client, db, make_user, name, index):
+    user, headers = make_user()
+    event = create_event(client, headers)
+    connection = RecordingConnection(db)
+
+    assert extensions.queries.run(connection, name, {"event_id": f"calendar_event:{event}"})
+
+    text, vars = connection.queries[0]
+    assert text == STATEMENTS[name].text
+    assert index in indexes(db, text, vars)
+
+
+def test_owned_by_reads_both_users_edges_through_the_index(client, db, make_user):
+    owner, owner_headers = make_user()
+    viewer, viewer_headers = make_user()
+    event = create_event(client, owner_headers)
+    create_event(client, owner_headers, "Not shared")
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": viewer, "share": "view"}]}, headers=owner_headers)
+    connection = RecordingConnection(db)
+
+    events = extensions.queries.run(connection, "events.owned_by", {"user_id": f"user:{owner}", "requester_id": f"user:{viewer}"})
+
+    assert [str(item["id"]) for item in events] == [f"calendar_event:{event}"]
+    text, vars = connection.queries[0]
+    for select in re.findall(r"\((SELECT [^()]*)\)", text):
+        assert indexes(db, select, vars) == {"has_access_to_in"}
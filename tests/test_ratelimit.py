@@ -0,0 +1,26 @@
+import flask_jwt_extended
+import pytest
+
+import main
+
+
+@pytest.fixture
+def limited_app(app):
+    # The app fixture with the rate limiter's before_request installed
+    return main.create_app({**app.config, "RATE_LIMIT_ENABLED": True})
+
+
+def test_token_is_decoded_once_per_request(limited_app, make_user, monkeypatch):
+    user, headers = make_user()
+    decodes = []
+    decode = flask_jwt_extended.JWTManager._decode_jwt_from_config
+
+    def counting_decode(self, *args, **kwargs):
+        decodes.append(args[0])
+        return decode(self, *args, **kwargs)
+
+    monkeypatch.setattr(flask_jwt_extended.JWTManager, "_decode_jwt_from_config", counting_decode)
+    response = limited_app.test_client().get("/event-labels/", headers=headers)
+
+    assert response.status_code == 200
+    assert len(decodes) == 1
@@ -0,0 +1,108 @@
+from datetime import datetime
+
+import pytest
+
+from recurrence import expand, occurrence_starts, parse_rrule, series_end
+from tests.helpers import create_event
+
+
+def series(rrule, start="2026-11-02T09:00:00", end="2026-11-02T10:00:00", **recurrence):
+    return {"id": "calendar_event:s", "start_time": start, "end_time": end, "recurrence": {"rrule": rrule, **recurrence}}
+
+
+def starts(event, window_start, window_end):
+    return [occurrence["start_time"] for occurrence in expand(event, window_start, window_end)]
+
+
+@pytest.mark.parametrize("rrule", [
+    "FREQ=DAILY;INTERVAL=3",
+    "FREQ=WEEKLY;BYDAY=MO,WE,FR",
+    "FREQ=WEEKLY;INTERVAL=2;BYDAY=TU,SU;COUNT=40",
+    "FREQ=MONTHLY;COUNT=30",
+    "FREQ=YEARLY;UNTIL=20400101T000000",
+])
+def test_skipping_ahead_matches_iterating_from_the_start(rrule):
+    rule = parse_rrule(rrule)
+    dtstart = datetime(2026, 1, 31, 9)
+    everything = []
+    for start in occurrence_starts(rule, dtstart):
+        if start.year > 2040:
+            break
+        everything.append(start)
+
+    for not_before in (datetime(2026, 3, 1), datetime(2027, 7, 15, 12), datetime(2031, 2, 28)):
+        skipped = occurrence_starts(rule, dtstart, not_before)
+        expected = [start for start in everything if start >= not_before][:10]
+        assert [start for _, start in zip(expected, skipped)] == expected
+
+
+def test_weekly_byday_inside_a_window():
+    event = series("FREQ=WEEKLY;BYDAY=MO,TH")
+
+    assert starts(event, "2026-11-10T00:00:00", "2026-11-24T00:00:00") == [
+        "2026-11-12T09:00:00", "2026-11-16T09:00:00", "2026-11-19T09:00:00", "2026-11-23T09:00:00",
+    ]
+
+
+def test_occurrence_running_into_the_window_is_included():
+    event = series("FREQ=DAILY", start="2026-11-02T23:00:00", end="2026-11-03T01:00:00")
+
+    assert starts(event, "2026-11-05T00:00:00", "2026-11-05T12:00:00") == ["2026-11-04T23:00:00"]
+
+
+def test_monthly_skips_months_without_the_day():
+    event = series("FREQ=MONTHLY;COUNT=4", start="2026-01-31T09:00:00", end="2026-01-31T10:00:00")
+
+    assert starts(event, "2026-01-01T00:00:00", "2027-01-01T00:00:00") == [
+        "2026-01-31T09:00:00", "2026-03-31T09:00:00", "2026-05-31T09:00:00", "2026-07-31T09:00:00",
+    ]
+
+
+def test_exdates_and_overrides():
+    event = series(
+        "FREQ=DAILY;COUNT=5",
+        exdates=["2026-11-03T09:00:00"],
+        overrides={
+            "2026-11-04T09:00:00": {"start_time": "2026-11-09T15:00:00", "end_time": "2026-11-09T16:00:00", "title": "Moved"},
+        },
+    )
+
+    occurrences = list(expand(event, "2026-11-01T00:00:00", "2026-11-10T00:00:00"))
+
+    assert [occurrence["start_time"] for occurrence in occurrences] == [
+        "2026-11-02T09:00:00", "2026-11-05T09:00:00", "2026-11-06T09:00:00", "2026-11-09T15:00:00",
+    ]
+    assert occurrences[-1]["title"] == "Moved"
+    assert occurrences[-1]["recurrence_id"] == "2026-11-04T09:00:00"
+    # A moved occurrence is found where it is now, not where it was
+    assert starts(event, "2026-11-04T00:00:00", "2026-11-05T00:00:00") == []
+
+
+def test_series_end_counts_overrides():
+    rule = parse_rrule("FREQ=WEEKLY;COUNT=3")
+
+    assert series_end(rule, "2026-11-02T09:00:00", "2026-11-02T10:00:00") == "2026-11-16T10:00:00"
+    assert series_end(rule, "2026-11-02T09:00:00", "2026-11-02T10:00:00", {"2026-11-09T09:00:00": {"end_time": "2026-11-20T10:00:00"}}) == "2026-11-20T10:00:00"
+    assert series_end(parse_rrule("FREQ=DAILY"), "2026-11-02T09:00:00", "2026-11-02T10:00:00") is None
+
+
+def test_exdates_match_the_occurrence_in_any_offset():
+    event = series("FREQ=DAILY;COUNT=3", start="2026-11-02T09:00:00+00:00", end="2026-11-02T10:00:00+00:00",
+                   exdates=["2026-11-03T10:00:00+01:00"])
+
+    assert starts(event, "2026-11-01T00:00:00", "2026-11-10T00:00:00") == ["2026-11-02T09:00:00+00:00", "2026-11-04T09:00:00+00:00"]
+
+
+def test_occurrence_edits_are_stored_under_the_series_key(client, make_user):
+    user, headers = make_user()
+    event = create_event(client, headers, "Standup", "2026-11-02T09:00:00Z", "2026-11-02T09:15:00Z", recurrence="FREQ=DAILY;COUNT=3")
+
+    assert client.delete(f"/events/{event}/occurrences/2026-11-03T10:00:00+01:00", headers=headers).status_code == 200
+    response = client.put(f"/events/{event}/occurrences/2026-11-04T04:00:00-05:00", json={"content": {"title": "Late"}}, headers=headers)
+
+    assert response.json["event"]["recurrence"]["exdates"] == ["2026-11-03T09:00:00+00:00"]
+    assert list(response.json["event"]["recurrence"]["overrides"]) == ["2026-11-04T09:00:00+00:00"]
+    listed = client.get("/events/?from=2026-11-01T00:00:00Z&to=2026-11-10T00:00:00Z", headers=headers).json["events"]
+    assert [(occurrence["start_time"], occurrence["title"]) for occurrence in listed] == [
+        ("2026-11-02T09:00:00+00:00", "Standup"), ("2026-11-04T09:00:00+00:00", "Late")
+    ]
@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+from tests.helpers import create_event
+
+
+def test_unchanged_lists_answer_304_to_their_etag(client, make_user):
+    user, headers = make_user()
+    create_event(client, headers)
+    first = client.get(f"/events/owned-by/{user}", headers=headers)
+    assert first.status_code == 200 and first.headers["ETag"].startswith('W/"events-')
+
+    again = client.get(f"/events/owned-by/{user}", headers={**headers, "If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+    assert again.headers["ETag"] == first.headers["ETag"]
+
+    create_event(client, headers, "Second")
+    changed = client.get(f"/events/owned-by/{user}", headers={**headers, "If-None-Match": first.headers["ETag"]})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != first.headers["ETag"]
+    assert len(changed.json["events"]) == 2
+
+
+def test_if_modified_since_is_answered_from_the_revision(client, make_user):
+    user, headers = make_user()
+    create_event(client, headers)
+    first = client.get(f"/events/owned-by/{user}", headers=headers)
+    last_modified = first.last_modified
+
+    unchanged = client.get(f"/events/owned-by/{user}", headers={**headers, "If-Modified-Since": first.headers["Last-Modified"]})
+    assert unchanged.status_code == 304
+
+    earlier = (last_modified - timedelta(seconds=1)).strftime("%a, %d %b %Y %H:%M:%S GMT")
+    assert client.get(f"/events/owned-by/{user}", headers={**headers, "If-Modified-Since": earlier}).status_code == 200
+
+
+def test_shares_change_the_recipients_etag(client, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    first = client.get(f"/events/owned-by/{owner}", headers=bob_headers)
+    assert first.json["events"] == []
+
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "view"}]}, headers=owner_headers)
+
+    response = client.get(f"/events/owned-by/{owner}", headers={**bob_headers, "If-None-Match": first.headers["ETag"]})
+    assert response.status_code == 200
+    assert len(response.json["events"]) == 1
+
+
+def test_errors_are_not_cached(client, make_user):
+    user, headers = make_user()
+
+    response = client.get("/events/owned-by/nobody", headers=headers)
+
+    assert response.status_code == 404
+    assert "ETag" not in response.headers
@@ -0,0 +1,35 @@
+import flask_jwt_extended
+
+import extensions
+from revocation import RevocationCache
+
+
+def test_logout_reaches_other_workers_after_a_sync(app, client, make_user):
+    user, headers = make_user()
+    with app.app_context():
+        jti = flask_jwt_extended.decode_token(headers["Authorization"].split()[1])["jti"]
+    # Another worker's cache, which already trusts the token
+    other = RevocationCache(extensions.sdb)
+    other.start()
+    with app.app_context():
+        assert not other.is_revoked(jti)
+
+    assert client.post("/auth/logout", headers=headers).status_code == 200
+
+    other.sync_interval = 0
+    with app.app_context():
+        assert other.is_revoked(jti)
+    assert other.stats()["synced"] == 1
+
+
+def test_sync_drops_expired_tokens(app):
+    cache = RevocationCache(extensions.sdb)
+    cache.start()
+    # Tokens other workers revoked, which this one learnt of through sync
+    cache._revoked = {"expired": 1, "live": 2 ** 40}
+
+    with app.app_context():
+        cache.sync()
+
+    assert cache._revoked == {"live": 2 ** 40}
+    assert cache.stats()["revoked"] == 1
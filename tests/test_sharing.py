@@ -0,0 +1,99 @@
+import sharing
+from sharing import reason_permissions
+from tests.helpers import (
+    RecordingConnection, create_event, create_relationship_label, edge, explain, follow_and_tag, indexes, permission,
+)
+
+
+def test_group_share_raises_and_unshare_restores_direct_permission(client, db, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    label = create_relationship_label(client, owner_headers)
+    follow_and_tag(client, owner_headers, label, bob)
+
+    response = client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "view"}]}, headers=owner_headers)
+    assert response.status_code == 200
+    response = client.post(f"/events/{event}/share", json={"groups": [{"label_id": label, "share": "admin"}]}, headers=owner_headers)
+    assert response.status_code == 200
+    assert permission(client, bob_headers, event) == "admin"
+
+    response = client.delete(f"/events/{event}/share", json={"groups": [{"label_id": label}]}, headers=owner_headers)
+    assert response.json["results"][0]["status"] == "updated"
+    assert permission(client, bob_headers, event) == "view"
+    link = edge(db, bob, event)
+    assert link["because_of"] == ["direct"]
+    assert link["reason_permissions"] == {"direct": "view"}
+
+
+def test_direct_share_replaces_only_the_direct_reason(client, db, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    label = create_relationship_label(client, owner_headers)
+    follow_and_tag(client, owner_headers, label, bob)
+
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "admin"}], "groups": [{"label_id": label, "share": "edit"}]}, headers=owner_headers)
+    assert permission(client, bob_headers, event) == "admin"
+
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "view"}]}, headers=owner_headers)
+    assert permission(client, bob_headers, event) == "edit"
+    assert edge(db, bob, event)["reason_permissions"] == {"direct": "view", f"relationship_label:{label}": "edit"}
+
+
+def test_direct_unshare_removes_the_edge(client, db, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": bob, "share": "edit"}]}, headers=owner_headers)
+    response = client.delete(f"/events/{event}/share", json={"shares": [{"user_id": bob}]}, headers=owner_headers)
+    assert response.json["results"][0]["status"] == "deleted"
+    assert edge(db, bob, event) is None
+    assert permission(client, bob_headers, event) is None
+
+
+def test_edges_without_reason_permissions_count_each_reason_at_the_edge_permission():
+    edge = {"permission": "edit", "because_of": ["direct", "relationship_label:a"]}
+    assert reason_permissions(edge) == {"direct": "edit", "relationship_label:a": "edit"}
+    edge["reason_permissions"] = {"direct": "view"}
+    assert reason_permissions(edge) == {"direct": "view", "relationship_label:a": "edit"}
+
+
+def test_deleting_a_relationship_label_takes_away_what_its_group_was_shared(client, db, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    carol, carol_headers = make_user()
+    event = create_event(client, owner_headers)
+    label = create_relationship_label(client, owner_headers)
+    follow_and_tag(client, owner_headers, label, bob)
+    follow_and_tag(client, owner_headers, label, carol)
+    client.post(f"/events/{event}/share", json={"shares": [{"user_id": carol, "share": "view"}], "groups": [{"label_id": label, "share": "edit"}]}, headers=owner_headers)
+    in_range = {"from": "2026-11-01T00:00:00Z", "to": "2026-11-03T00:00:00Z"}
+    assert len(client.get("/events/", query_string=in_range, headers=bob_headers).json["events"]) == 1
+
+    assert client.delete(f"/relationship-labels/{label}", headers=owner_headers).status_code == 200
+
+    assert edge(db, bob, event) is None
+    assert client.get("/events/", query_string=in_range, headers=bob_headers).json["events"] == []
+    assert permission(client, carol_headers, event) == "view"
+    assert edge(db, carol, event)["because_of"] == ["direct"]
+
+
+def test_share_lookups_use_the_event_and_requester_indexes(client, db, make_user):
+    owner, owner_headers = make_user()
+    bob, bob_headers = make_user()
+    event = create_event(client, owner_headers)
+    label = create_relationship_label(client, owner_headers)
+    follow_and_tag(client, owner_headers, label, bob)
+    connection = RecordingConnection(db)
+
+    sharing.resolve_targets(connection, f"user:{owner}", [f"user:{bob}"], [f"relationship_label:{label}"])
+    sharing._existing(connection, f"calendar_event:{event}", [f"user:{owner}", f"user:{bob}"])
+
+    _, _, (relationships, relationship_vars), (existing, existing_vars) = connection.queries
+    assert indexes(db, relationships, relationship_vars) == {"relationship_with_in"}
+    # Only the event's own edges are read; `in IN $users` would have the
+    # planner union has_access_to_in over the whole audience
+    plan = explain(db, existing, existing_vars)
+    assert {step["operation"] for step in plan} == {"Iterate Value", "Collector"}
@@ -0,0 +1,82 @@
+import extensions
+
+
+def counts(client, headers):
+    return client.get("/social/counts", headers=headers).json
+
+
+def test_cached_adjacency_follows_every_write(client, make_user):
+    alice, alice_headers = make_user()
+    bob, bob_headers = make_user()
+    # Both sides are cached before anything changes
+    assert counts(client, alice_headers) == {"following": 0, "followers": 0, "friends": 0, "blocked": 0}
+    assert counts(client, bob_headers) == {"following": 0, "followers": 0, "friends": 0, "blocked": 0}
+
+    client.post("/social/following", json={"target_user_id": bob}, headers=alice_headers)
+    assert counts(client, bob_headers)["followers"] == 1
+
+    client.post("/social/following", json={"target_user_id": alice}, headers=bob_headers)
+    assert counts(client, alice_headers) == {"following": 1, "followers": 1, "friends": 1, "blocked": 0}
+
+    client.post("/social/block", json={"target_user_id": bob}, headers=alice_headers)
+    assert counts(client, alice_headers) == {"following": 0, "followers": 0, "friends": 0, "blocked": 1}
+    assert counts(client, bob_headers) == {"following": 0, "followers": 0, "friends": 0, "blocked": 0}
+
+    client.delete(f"/social/block/{bob}", headers=alice_headers)
+    assert counts(client, alice_headers)["blocked"] == 0
+
+
+def test_following_back_makes_friends_and_unfollowing_undoes_it(client, make_user):
+    alice, alice_headers = make_user()
+    bob, bob_headers = make_user()
+    client.post("/social/following", json={"target_user_id": bob}, headers=alice_headers)
+    assert counts(client, alice_headers)["friends"] == 0
+
+    response = client.post("/social/following", json={"target_user_id": alice}, headers=bob_headers)
+    assert response.json["relationship"]["type"] == "friends"
+    assert [edge["type"] for edge in client.get("/social/friends", headers=alice_headers).json["friends"]] == ["friends"]
+    assert counts(client, bob_headers)["friends"] == 1
+
+    client.delete(f"/social/following/{bob}", headers=alice_headers)
+    assert counts(client, alice_headers) == {"following": 0, "followers": 1, "friends": 0, "blocked": 0}
+    assert counts(client, bob_headers) == {"following": 1, "followers": 0, "friends": 0, "blocked": 0}
+    assert client.get("/social/following", headers=bob_headers).json["following"][0]["type"] == "following"
+
+    # Following again restores the friendship, and removing it leaves both following
+    client.post("/social/following", json={"target_user_id": bob}, headers=alice_headers)
+    assert counts(client, bob_headers)["friends"] == 1
+    assert client.delete(f"/social/friends/{bob}", headers=alice_headers).status_code == 200
+    assert counts(client, alice_headers) == {"following": 1, "followers": 1, "friends": 0, "blocked": 0}
+    assert counts(client, bob_headers) == {"following": 1, "followers": 1, "friends": 0, "blocked": 0}
+
+
+def befriend(client, one, two):
+    client.post("/social/following", json={"target_user_id": two[0]}, headers=one[1])
+    client.post("/social/following", json={"target_user_id": one[0]}, headers=two[1])
+
+
+def test_mutual_friends_and_suggestions_rank_real_friendships(client, make_user):
+    alice, bob, carol, dave, eve = (make_user() for _ in range(5))
+    befriend(client, bob, dave)
+    befriend(client, carol, dave)
+    client.post("/social/following", json={"target_user_id": eve[0]}, headers=bob[1])
+    # Cached before alice makes friends, so the counts below are kept in place
+    assert client.get("/social/suggestions", headers=alice[1]).json["suggestions"] == []
+
+    befriend(client, alice, bob)
+    befriend(client, alice, carol)
+
+    mutual = client.get(f"/social/mutual/{dave[0]}", headers=alice[1]).json
+    assert mutual == {"mutual_friends": sorted([f"user:{bob[0]}", f"user:{carol[0]}"]), "count": 2}
+    expected = [
+        {"user_id": f"user:{dave[0]}", "mutual_friends": 2, "mutual": 2},
+        {"user_id": f"user:{eve[0]}", "mutual_friends": 1, "mutual": 1},
+    ]
+    assert client.get("/social/suggestions", headers=alice[1]).json["suggestions"] == expected
+    extensions.suggestions.invalidate(f"user:{alice[0]}")
+    assert client.get("/social/suggestions", headers=alice[1]).json["suggestions"] == expected
+
+    client.delete(f"/social/friends/{carol[0]}", headers=alice[1])
+    assert client.get(f"/social/mutual/{dave[0]}", headers=alice[1]).json["count"] == 1
+    assert client.get("/social/suggestions", headers=alice[1]).json["suggestions"][0] == {
+        "user_id": f"user:{dave[0]}", "mutual_friends": 1, "mutual": 2}
@@ -0,0 +1,72 @@
+import re
+
+import changelog
+from tests.helpers import RecordingConnection, create_event, indexes
+
+
+def test_sync_reads_use_the_user_indexes(client, db, make_user):
+    user, headers = make_user()
+    create_event(client, headers)
+    connection = RecordingConnection(db)
+
+    changelog.snapshot(connection, f"user:{user}")
+
+    edges_query = next(query for query in connection.queries if "FROM has_access_to" in query[0])
+    assert indexes(db, *edges_query) == {"has_access_to_in"}
+    vars = {"user_id": edges_query[1]["user_id"], "at": changelog.datetime.now(changelog.timezone.utc), "key": "", "limit": 10}
+    for select in re.findall(r"\((SELECT [^()]*)\)", changelog.CHANGES_SINCE):
+        assert indexes(db, select, vars) == {"change_log_user_at"}
+
+
+def sync(client, headers, since, limit=500):
+    response = client.get("/sync/", query_string={"since": since, "limit": limit}, headers=headers)
+    assert response.status_code == 200, response.json
+    return response.json
+
+
+def test_pages_follow_the_token_to_every_change(client, make_user, monkeypatch):
+    monkeypatch.setattr(changelog, "SETTLE_SECONDS", 0)
+    user, headers = make_user()
+    token = client.get("/sync/", headers=headers).json["next"]
+    events = {create_event(client, headers, f"Event {number}") for number in range(3)}
+
+    seen = []
+    while True:
+        page = sync(client, headers, token, limit=2)
+        assert len(page["changes"]) <= 2
+        seen += [(change["table"], change["id"].split(":", 1)[1]) for change in page["changes"]]
+        token = page["next"]
+        if not page["has_more"]:
+            break
+
+    # Each event and its owner edge, once
+    assert len(seen) == len(set(seen)) == 6
+    assert {key for table, key in seen if table == "calendar_event"} == events
+    assert sync(client, headers, token)["changes"] == []
+
+
+def test_deleted_events_come_back_as_tombstones(client, make_user, monkeypatch):
+    monkeypatch.setattr(changelog, "SETTLE_SECONDS", 0)
+    user, headers = make_user()
+    kept = create_event(client, headers, "Kept")
+    gone = create_event(client, headers, "Gone")
+    token = client.get("/sync/", headers=headers).json["next"]
+
+    client.put(f"/events/{kept}", json={"content": {"title": "Renamed"}}, headers=headers)
+    client.delete(f"/events/{gone}", headers=headers)
+
+    changes = {change["id"]: change for change in sync(client, headers, token)["changes"] if change["table"] == "calendar_event"}
+    assert changes[f"calendar_event:{kept}"]["action"] == "upsert"
+    assert changes[f"calendar_event:{kept}"]["record"]["title"] == "Renamed"
+    assert changes[f"calendar_event:{gone}"] == {"table": "calendar_event", "id": f"calendar_event:{gone}", "action": "delete"}
+
+
+def test_tokens_from_before_a_compaction_have_expired(client, db, make_user):
+    user, headers = make_user()
+    token = client.get("/sync/", headers=headers).json["next"]
+    assert client.get("/sync/", query_string={"since": token}, headers=headers).status_code == 200
+
+    changelog.compact(db, retention_days=0)
+
+    assert client.get("/sync/", query_string={"since": token}, headers=headers).status_code == 410
+    assert client.get("/sync/", query_string={"since": "not a token"}, headers=headers).status_code == 400
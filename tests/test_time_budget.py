@@ -0,0 +1,79 @@
+from datetime import date
+
+import time_budget
+from tests.helpers import RecordingConnection, create_event, indexes
+
+WEEK = {"period": "custom", "from": "2026-11-02", "to": "2026-11-09"}
+
+
+def budget(client, headers):
+    return client.get("/analytics/time-budget", query_string=WEEK, headers=headers).json["totals"]
+
+
+def test_update_moves_the_budget_with_the_event(client, make_user):
+    user, headers = make_user()
+    event = create_event(client, headers)
+    assert budget(client, headers) == {"unlabelled": 3600}
+
+    response = client.put(f"/events/{event}", json={"content": {"end_time": "2026-11-02T12:30:00Z"}}, headers=headers)
+
+    assert response.status_code == 200
+    assert budget(client, headers) == {"unlabelled": 9000}
+
+
+def test_update_of_an_event_that_moved_meanwhile_writes_nothing(client, db, make_user, monkeypatch):
+    user, headers = make_user()
+    event = create_event(client, headers)
+    get = time_budget.change_rows
+
+    def racing_change_rows(*args, **kwargs):
+        # Another request moves the event after this one read it
+        db.query("UPDATE type::thing('calendar_event', $event) SET end_time = '2026-11-02T11:30:00Z'", {"event": event})
+        return get(*args, **kwargs)
+
+    monkeypatch.setattr(time_budget, "change_rows", racing_change_rows)
+    response = client.put(f"/events/{event}", json={"content": {"end_time": "2026-11-02T12:30:00Z", "title": "Moved"}}, headers=headers)
+
+    assert response.status_code == 409
+    assert client.get(f"/events/{event}", headers=headers).json["event"]["title"] == "Event"
+    assert budget(client, headers) == {"unlabelled": 3600}
+
+
+def test_open_ended_series_count_in_any_window(client, db, make_user):
+    user, headers = make_user()
+    # Started well over a year before the week that is read
+    event = create_event(client, headers, "Standup", "2024-01-01T09:00:00Z", "2024-01-01T09:30:00Z", recurrence="FREQ=DAILY")
+
+    assert budget(client, headers) == {"unlabelled": 7 * 1800}
+    assert db.query("SELECT * FROM time_budget WHERE user = type::thing('user', $user)", {"user": user}) == []
+
+    # Once it has an end it is aggregated like any other event
+    client.put(f"/events/{event}", json={"content": {"recurrence": "FREQ=DAILY;UNTIL=20261105T000000Z"}}, headers=headers)
+    assert budget(client, headers) == {"unlabelled": 3 * 1800}
+    client.put(f"/events/{event}", json={"content": {"recurrence": "FREQ=DAILY"}}, headers=headers)
+    assert budget(client, headers) == {"unlabelled": 7 * 1800}
+
+
+def test_open_ended_occurrences_are_clipped_to_the_window(client, make_user):
+    user, headers = make_user()
+    create_event(client, headers, "Night shift", "2026-10-04T22:00:00Z", "2026-10-05T02:00:00Z", recurrence="FREQ=WEEKLY")
+
+    # Sunday nights: the first runs into the window, the second out of it
+    assert budget(client, headers) == {"unlabelled": 7200 + 7200}
+
+
+def test_reads_and_rebuilds_use_the_user_indexes(client, db, make_user):
+    user, headers = make_user()
+    create_event(client, headers)
+    connection = RecordingConnection(db)
+
+    time_budget.read(connection, f"user:{user}", date(2026, 11, 2), date(2026, 11, 9))
+    assert time_budget.rebuild(connection, f"user:{user}") == 1
+
+    stored, open_series, _, edges, _ = connection.queries
+    assert indexes(db, *stored) == {"time_budget_user_day"}
+    assert indexes(db, *open_series) == {"has_access_to_in"}
+    assert indexes(db, *edges) == {"has_access_to_in"}
+    assert budget(client, headers) == {"unlabelled": 3600}
+    assert time_budget.rebuild(db) >= 1
+    assert budget(client, headers) == {"unlabelled": 3600}
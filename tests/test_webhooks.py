@@ -0,0 +1,124 @@
+# Webhook urls must not reach the server's own network
+
+import http.server
+import json
+import threading
+
+import pytest
+from surrealdb import RecordID
+
+import extensions
+import webhooks
+from tests.helpers import RecordingConnection, create_event, indexes
+
+
+@pytest.fixture
+def receiver():
+    # A local endpoint that records POSTs and redirects /moved to /
+    received = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(self.path)
+            self.rfile.read(int(self.headers["Content-Length"]))
+            if self.path == "/moved":
+                self.send_response(307)
+                self.send_header("Location", "/")
+            else:
+                self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", received
+    server.shutdown()
+    server.server_close()
+
+
+def _delivery(url):
+    return {"id": "webhook_delivery:1", "event_type": "event.created", "url": url, "payload": {}}
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/hook",
+    "http://localhost:8000/hook",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://10.0.0.5/hook",
+    "http://[::1]/hook",
+    "http://[::ffff:192.168.1.1]/hook",
+    "ftp://example.com/hook",
+])
+def test_private_urls_are_refused(client, make_user, url):
+    user, headers = make_user()
+
+    response = client.post("/webhooks/", json={"url": url}, headers=headers)
+
+    assert response.status_code == 400
+
+
+def test_delivery_rechecks_the_url(app, receiver):
+    url, received = receiver
+
+    ok, detail = extensions.webhooks.deliver(_delivery(url + "/"), "secret")
+
+    assert not ok and "private" in detail
+    assert received == []
+
+
+def test_escape_hatch_allows_private_urls_without_following_redirects(app, receiver, monkeypatch):
+    url, received = receiver
+    monkeypatch.setattr(extensions.webhooks, "allow_private", True)
+
+    assert extensions.webhooks.check_url(url + "/") is None
+    assert extensions.webhooks.deliver(_delivery(url + "/"), "secret") == (True, "HTTP 204")
+    assert extensions.webhooks.deliver(_delivery(url + "/moved"), "secret") == (False, "HTTP 307")
+    assert received == ["/", "/moved"]
+
+
+def test_public_addresses_pass(monkeypatch):
+    monkeypatch.setattr(webhooks.socket, "getaddrinfo", lambda *args, **kwargs: [(2, 1, 6, "", ("93.184.216.34", 443))])
+
+    assert webhooks.resolve("https://example.com/hook") == ("93.184.216.34", None)
+
+
+def test_subscriptions_and_deliveries_are_read_through_indexes(client, db, make_user, monkeypatch):
+    user, headers = make_user()
+    monkeypatch.setattr(webhooks.socket, "getaddrinfo", lambda *args, **kwargs: [(2, 1, 6, "", ("93.184.216.34", 443))])
+    created = client.post("/webhooks/", json={"url": "https://example.com/hook"}, headers=headers)
+    webhook = str(created.json["webhook"]["id"]).split(":", 1)[1]
+    connection = RecordingConnection(db)
+    monkeypatch.setattr(extensions.sdb, "get_db", lambda: connection)
+
+    assert len(client.get("/webhooks/", headers=headers).json) == 1
+    assert client.get(f"/webhooks/{webhook}/deliveries", headers=headers).json == []
+    assert client.get(f"/webhooks/{webhook}/deliveries", query_string={"status": "dead"}, headers=headers).json == []
+    assert client.delete(f"/webhooks/{webhook}", headers=headers).status_code == 200
+
+    subscriptions, deliveries, dead, _ = connection.queries
+    assert indexes(db, *subscriptions) == {"webhook_subscription_owner"}
+    assert indexes(db, *deliveries) == {"webhook_delivery_subscription"}
+    assert indexes(db, *dead) == {"webhook_delivery_status"}
+
+
+def test_imports_and_occurrence_edits_are_delivered(client, db, make_user, monkeypatch):
+    user, headers = make_user()
+    monkeypatch.setattr(webhooks.socket, "getaddrinfo", lambda *args, **kwargs: [(2, 1, 6, "", ("93.184.216.34", 443))])
+    created = client.post("/webhooks/", json={"url": "https://example.com/hook"}, headers=headers)
+    webhook = RecordID.parse(created.json["webhook"]["id"])
+    body = "\n".join(json.dumps({"title": title, "start_time": "2026-11-02T10:00:00Z", "end_time": "2026-11-02T11:00:00Z"}) for title in ("A", "B"))
+    client.post("/events/import", data=body, content_type="application/x-ndjson", headers=headers).get_data()
+    event = create_event(client, headers, recurrence="FREQ=DAILY")
+
+    response = client.delete(f"/events/{event}/occurrences/2026-11-03T10:00:00Z", headers=headers)
+
+    assert response.status_code == 200
+    deliveries = db.query("SELECT event_type, payload.event.title AS title FROM webhook_delivery WHERE subscription = $webhook ORDER BY event_type, title", {"webhook": webhook})
+    assert deliveries == [
+        {"event_type": "event.created", "title": "A"},
+        {"event_type": "event.created", "title": "B"},
+        {"event_type": "event.created", "title": "Event"},
+        {"event_type": "event.updated", "title": "Event"},
+    ]
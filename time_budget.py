@@ -0,0 +1,198 @@
+# Per-user, per-label, per-day duration aggregates for the "time budget"
+#
+# Each row of the time_budget table holds the seconds a user's owned events
+# spend on one event_label on one day, keyed by [user, label, day] so writes
+# are idempotent upserts. Rows are adjusted by the difference between an
+# event before and after every write, so reading a budget never scans
+# calendar_event. Open-ended recurring series have no last day to
+# aggregate up to, so they are left out of the rows and worked out for the
+# requested window when a budget is read (see open_series_rows). An event
+# update writes its difference in the same transaction as the event (see
+# events.update).
+
+import collections
+import sys
+from datetime import datetime, timedelta
+
+from surrealdb import RecordID
+
+from recurrence import comparable, expand, parse_datetime
+
+UNLABELLED = "unlabelled"
+# The event fields contributions() reads
+TIMING_FIELDS = ("start_time", "end_time", "recurrence", "recurrence_end")
+
+
+def split_by_day(start, end):
+    # Seconds of [start, end) falling on each calendar day
+    seconds = {}
+    while start < end:
+        midnight = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        chunk_end = min(end, midnight)
+        day = start.date().isoformat()
+        seconds[day] = seconds.get(day, 0) + int((chunk_end - start).total_seconds())
+        start = chunk_end
+    return seconds
+
+
+def is_open_ended(event):
+    return bool(event.get("recurrence")) and not event.get("recurrence_end")
+
+
+def contributions(event, labels, window=None):
+    # Counter of (label, day) -> seconds for one event and its owner's
+    # labels. An open-ended series only counts inside window, a (start, end)
+    # pair, and nothing without one.
+    totals = collections.Counter()
+    if not event or (window is None and is_open_ended(event)):
+        return totals
+
+    if window is not None:
+        start, end = (comparable(parse_datetime(bound)) for bound in window)
+    else:
+        start = comparable(parse_datetime(event["start_time"]))
+        end = comparable(parse_datetime(event.get("recurrence_end") or event["end_time"]))
+
+    labels = [str(label) for label in labels or []] or [UNLABELLED]
+    for occurrence in expand(event, start, end):
+        occurrence_start = comparable(parse_datetime(occurrence["start_time"]))
+        occurrence_end = comparable(parse_datetime(occurrence["end_time"]))
+        for day, seconds in split_by_day(max(occurrence_start, start), min(occurrence_end, end)).items():
+            for label in labels:
+                totals[(label, day)] += seconds
+    return totals
+
+
+def _rows(user_id, deltas):
+    user = RecordID.parse(str(user_id)) if isinstance(user_id, str) else user_id
+    return [
+        {"id": [str(user), label, day], "user": user, "label": label, "day": day, "seconds": seconds}
+        for (label, day), seconds in deltas.items()
+        if seconds
+    ]
+
+
+def _write(db, rows):
+    if rows:
+        db.query(
+            "INSERT INTO time_budget $rows ON DUPLICATE KEY UPDATE seconds += $input.seconds RETURN NONE",
+            {"rows": rows}
+        )
+
+
+def change_rows(user_id, before, after, labels=None, labels_before=None):
+    # time_budget rows for the difference between an event before and after
+    # a write, for a caller that writes them itself. before is None for a
+    # create, after for a delete.
+    deltas = contributions(after, labels)
+    deltas.subtract(contributions(before, labels if labels_before is None else labels_before))
+    return _rows(user_id, deltas)
+
+
+def record_change(db, user_id, before, after, labels=None, labels_before=None):
+    # Applies the difference between an event before and after a write to
+    # its owner's aggregates
+    _write(db, change_rows(user_id, before, after, labels, labels_before))
+
+
+def record_created(db, user_id, events):
+    # One aggregate write for a batch of newly created, unlabelled events
+    deltas = collections.Counter()
+    for event in events:
+        deltas.update(contributions(event, None))
+    _write(db, _rows(user_id, deltas))
+
+
+def read(db, user_id, start, end):
+    # The user's rows for the days in [start, end), open-ended series included
+    rows = db.query(
+        "SELECT label, day, seconds FROM time_budget WHERE user = $user_id AND day >= $from AND day < $to",
+        {"user_id": RecordID.parse(str(user_id)), "from": start.isoformat(), "to": end.isoformat()}
+    )
+    return rows + open_series_rows(db, user_id, start, end)
+
+
+def open_series_rows(db, user_id, start, end):
+    # Rows shaped like time_budget's for the user's open-ended series on the
+    # days in [start, end), worked out from the series themselves
+    edges = db.query(
+        """
+        SELECT labels, out.* AS event FROM has_access_to
+        WHERE in = $user_id AND permission = 'owner'
+            AND out.recurrence != NONE AND out.recurrence_end = NONE AND out.start_time < $to;
+        """,
+        {"user_id": RecordID.parse(str(user_id)), "to": end.isoformat()}
+    )
+
+    window = (datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.min.time()))
+    totals = collections.Counter()
+    for edge in edges:
+        if edge.get("event"):
+            totals.update(contributions(edge["event"], edge.get("labels"), window))
+    return [{"label": label, "day": day, "seconds": seconds} for (label, day), seconds in totals.items()]
+
+
+def rollup(rows, bucket):
+    # Groups time_budget rows into day, week (starting Monday) or month buckets
+    series = collections.defaultdict(collections.Counter)
+    totals = collections.Counter()
+    for row in rows:
+        day = datetime.fromisoformat(row["day"]).date()
+        if bucket == "week":
+            key = (day - timedelta(days=day.weekday())).isoformat()
+        elif bucket == "month":
+            key = day.strftime("%Y-%m")
+        else:
+            key = day.isoformat()
+        series[key][row["label"]] += row["seconds"]
+        totals[row["label"]] += row["seconds"]
+
+    return {
+        "totals": dict(totals),
+        "series": [{"bucket": key, "labels": dict(series[key])} for key in sorted(series)],
+    }
+
+
+def rebuild(db, user_id=None, batch_size=500):
+    # Recomputes the aggregates from calendar_event in batches of owner edges
+    if user_id:
+        db.query("DELETE time_budget WHERE user = $user_id", {"user_id": RecordID.parse(user_id)})
+    else:
+        db.query("DELETE time_budget")
+
+    # Any OR in the condition would keep one user's rebuild off the
+    # has_access_to_in index; every id is greater than NONE
+    edges_query = f"""
+        SELECT id, in AS user, labels, out.* AS event FROM has_access_to
+        WHERE {"in = $user_id AND " if user_id else ""}permission = 'owner' AND id > $after
+        ORDER BY id
+        LIMIT $limit;
+    """
+    after, processed = None, 0
+    while True:
+        edges = db.query(edges_query, {"user_id": RecordID.parse(user_id) if user_id else None, "after": after, "limit": batch_size})
+
+        totals = collections.defaultdict(collections.Counter)
+        for edge in edges:
+            if edge.get("event"):
+                totals[str(edge["user"])].update(contributions(edge["event"], edge.get("labels")))
+        for user, deltas in totals.items():
+            _write(db, _rows(user, deltas))
+
+        processed += len(edges)
+        if len(edges) < batch_size:
+            return processed
+        after = edges[-1]["id"]
+
+
+if __name__ == "__main__":
+    # python time_budget.py rebuild [user_id]
+    from extensions import sdb
+
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        sys.exit("usage: python time_budget.py rebuild [user_id]")
+
+    sdb.start()
+    with sdb.connection() as db:
+        user = f"user:{sys.argv[2]}" if len(sys.argv) > 2 else None
+        print(f"Rebuilt time budget from {rebuild(db, user)} events")
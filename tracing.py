@@ -0,0 +1,320 @@
+# Opt-in request tracing
+#
+# With TRACING set, every request gets a root span and the code it runs
+# can open child spans with tracing.span(name). The JWT checks, JSON
+# parsing and serialization, and every SurrealDB call already do. Finished
+# requests feed per-route and per-phase latency histograms for /metrics,
+# and a TRACE_SAMPLE_RATE share of them is exported as OTLP/HTTP JSON to
+# TRACE_OTLP_ENDPOINT by a background thread. The last TRACE_BUFFER
+# exported traces are also kept in memory for GET /debug/traces.
+#
+# With TRACING off no hooks are registered and span() returns a shared
+# no-op context manager after one ContextVar lookup.
+
+import collections
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+
+import flask
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, name, parent_id, kind, attributes):
+        self.name = name
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.error = False
+
+    @property
+    def seconds(self):
+        return (self.end - self.start) / 1e9
+
+
+class Trace:
+    def __init__(self, sampled):
+        self.trace_id = random.getrandbits(128)
+        self.sampled = sampled
+        self.spans = []
+        self._stack = []
+
+    def begin(self, name, kind=INTERNAL, **attributes):
+        span = Span(name, self._stack[-1].span_id if self._stack else None, kind, attributes)
+        self.spans.append(span)
+        self._stack.append(span)
+        return span
+
+    def end(self, span, error=False):
+        if span.end is not None:
+            return
+        span.end = time.time_ns()
+        span.error = error
+        # Anything opened inside span and left open ends with it
+        while self._stack:
+            top = self._stack.pop()
+            if top.end is None:
+                top.end = span.end
+            if top is span:
+                break
+
+    def finish(self):
+        if self.spans:
+            self.end(self.spans[0])
+
+
+class _SpanContext:
+    __slots__ = ("trace", "name", "kind", "attributes", "span")
+
+    def __init__(self, trace, name, kind, attributes):
+        self.trace = trace
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.span = self.trace.begin(self.name, self.kind, **self.attributes)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.end(self.span, error=exc_type is not None)
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, kind=INTERNAL, **attributes):
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _SpanContext(trace, name, kind, attributes)
+
+
+def begin(name, kind=INTERNAL, **attributes):
+    # For phases that start and end in different callbacks; spans still
+    # open when the request ends are closed with it
+    trace = _current.get()
+    if trace is None:
+        return None
+    return trace.begin(name, kind, **attributes)
+
+
+def end(span):
+    trace = _current.get()
+    if trace is not None and span is not None:
+        trace.end(span)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def to_otlp(traces, service_name):
+    # OTLP/HTTP JSON export request for a list of finished traces
+    spans = []
+    for trace in traces:
+        for item in trace.spans:
+            otlp_span = {
+                "traceId": f"{trace.trace_id:032x}",
+                "spanId": f"{item.span_id:016x}",
+                "name": item.name,
+                "kind": item.kind,
+                "startTimeUnixNano": str(item.start),
+                "endTimeUnixNano": str(item.end),
+                "attributes": [_attribute(key, value) for key, value in item.attributes.items()],
+                "status": {"code": 2 if item.error else 1},
+            }
+            if item.parent_id is not None:
+                otlp_span["parentSpanId"] = f"{item.parent_id:016x}"
+            spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attribute("service.name", service_name)]},
+        "scopeSpans": [{"scope": {"name": "calendar-api.tracing"}, "spans": spans}],
+    }]}
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.endpoint = None
+        self.service_name = "calendar-api"
+        self.batch_size = 64
+
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._phases = {}
+        self._recent = collections.deque(maxlen=100)
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = None
+        self._counters = {"traces": 0, "exported": 0, "export_failures": 0, "dropped": 0}
+
+    def init_app(self, app):
+        app.config.setdefault("TRACING", os.getenv("TRACING", "false").lower() == "true")
+        app.config.setdefault("TRACE_SAMPLE_RATE", float(os.getenv("TRACE_SAMPLE_RATE", 1.0)))
+        app.config.setdefault("TRACE_OTLP_ENDPOINT", os.getenv("TRACE_OTLP_ENDPOINT"))
+        app.config.setdefault("TRACE_SERVICE_NAME", os.getenv("TRACE_SERVICE_NAME", "calendar-api"))
+        app.config.setdefault("TRACE_BUFFER", int(os.getenv("TRACE_BUFFER", 100)))
+        self.enabled = app.config["TRACING"]
+        self.sample_rate = app.config["TRACE_SAMPLE_RATE"]
+        self.endpoint = app.config["TRACE_OTLP_ENDPOINT"]
+        self.service_name = app.config["TRACE_SERVICE_NAME"]
+        self._recent = collections.deque(maxlen=app.config["TRACE_BUFFER"])
+
+        app.extensions["tracing"] = self
+        if not self.enabled:
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+    def route_histograms(self):
+        # [(labels, snapshot)] per blueprint, route, method and status
+        with self._lock:
+            return [
+                ({"blueprint": blueprint, "route": route, "method": method, "status": status}, histogram.snapshot())
+                for (blueprint, route, method, status), histogram in sorted(self._routes.items())
+            ]
+
+    def phase_histograms(self):
+        with self._lock:
+            return [({"phase": phase}, histogram.snapshot()) for phase, histogram in sorted(self._phases.items())]
+
+    def recent(self):
+        with self._lock:
+            traces = list(self._recent)
+        return to_otlp(traces, self.service_name)
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _before_request(self):
+        trace = Trace(random.random() < self.sample_rate)
+        rule = flask.request.url_rule
+        trace.begin(
+            f"{flask.request.method} {rule.rule if rule else 'unmatched'}",
+            SERVER,
+            **{"http.method": flask.request.method, "http.route": rule.rule if rule else "", "flask.blueprint": flask.request.blueprint or ""}
+        )
+        flask.g.trace_token = _current.set(trace)
+
+    def _after_request(self, response):
+        trace = _current.get()
+        if trace is not None and trace.spans:
+            trace.spans[0].attributes["http.status_code"] = response.status_code
+            trace.spans[0].error = response.status_code >= 500
+        return response
+
+    def _teardown_request(self, exception):
+        token = flask.g.pop("trace_token", None)
+        trace = _current.get()
+        if token is None or trace is None:
+            return
+        _current.reset(token)
+        trace.finish()
+        root = trace.spans[0]
+        if exception is not None:
+            root.error = True
+
+        route_key = (
+            root.attributes["flask.blueprint"],
+            root.attributes["http.route"],
+            root.attributes["http.method"],
+            str(root.attributes.get("http.status_code", 500)),
+        )
+        with self._lock:
+            self._counters["traces"] += 1
+            self._routes.setdefault(route_key, Histogram()).observe(root.seconds)
+            for item in trace.spans[1:]:
+                # "query events.get" counts towards "query"
+                phase = item.name.split(" ", 1)[0]
+                self._phases.setdefault(phase, Histogram()).observe(item.seconds)
+            if trace.sampled:
+                self._recent.append(trace)
+
+        if trace.sampled and self.endpoint:
+            self._export(trace)
+
+    def _export(self, trace):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            with self._lock:
+                self._counters["dropped"] += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch
+            batch = [trace for trace in batch if trace is not None]
+            if batch:
+                self._post(batch)
+            if stopping:
+                return
+
+    def _post(self, batch):
+        body = json.dumps(to_otlp(batch, self.service_name)).encode()
+        request = urllib.request.Request(self.endpoint, data=body, headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                response.read()
+            counter = "exported"
+        except Exception as e:
+            logger.warning("Failed to export %d traces: %s", len(batch), e)
+            counter = "export_failures"
+        with self._lock:
+            self._counters[counter] += len(batch)
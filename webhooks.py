@@ -0,0 +1,339 @@
+# Outbound webhooks for real-time updates
+#
+# Route handlers only write rows to the webhook_delivery table (the durable
+# queue) through emit(). A dispatcher thread claims due deliveries and hands
+# them to a thread pool, so request latency never depends on subscribers.
+# Failed deliveries are retried with exponential backoff and dead-lettered
+# (status = 'dead') after WEBHOOK_MAX_ATTEMPTS.
+#
+# Subscribers choose the url, so it is checked when the subscription is
+# made and again before every delivery: the host must only resolve to
+# public addresses, never loopback, private, link-local (cloud metadata)
+# or reserved ones. Deliveries connect to the address that was checked
+# rather than resolving the host again, and redirects are not followed.
+# WEBHOOK_ALLOW_PRIVATE turns the check off for local development.
+
+import concurrent.futures
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+from surrealdb import RecordID
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = ("event.created", "event.updated", "event.deleted", "event.shared", "event.unshared")
+
+
+def sign(secret, timestamp, body):
+    message = f"{timestamp}.".encode() + body
+    return "sha256=" + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def _record(user_id):
+    return RecordID.parse(user_id) if isinstance(user_id, str) else user_id
+
+
+def resolve(url, allow_private=False):
+    # (address to connect to, error message) for a subscriber's url. The
+    # address is None when the url can't be delivered to.
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return None, "A http or https url is required"
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        infos = socket.getaddrinfo(parsed.hostname, port, type=socket.SOCK_STREAM)
+    except (ValueError, OSError):
+        return None, "The url's host could not be resolved"
+    addresses = [ipaddress.ip_address(info[4][0].split("%")[0]) for info in infos]
+    if not allow_private:
+        for address in addresses:
+            mapped = getattr(address, "ipv4_mapped", None) or address
+            if not mapped.is_global or mapped.is_multicast:
+                return None, "The url's host must not resolve to a private, loopback, link-local or reserved address"
+    return str(addresses[0]), None
+
+
+class _PinnedConnection:
+    # Connects to an address resolved and checked beforehand instead of
+    # looking the host up again, which a DNS change could point elsewhere.
+    # The host is still what the Host header and TLS verification use.
+    def __init__(self, host, port, address, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self._create_connection = lambda target, *args: socket.create_connection((address, target[1]), *args)
+
+
+class _PinnedHTTPConnection(_PinnedConnection, http.client.HTTPConnection):
+    pass
+
+
+class _PinnedHTTPSConnection(_PinnedConnection, http.client.HTTPSConnection):
+    pass
+
+
+class WebhookDispatcher:
+    def __init__(self, sdb):
+        self.sdb = sdb
+        self.workers = 4
+        self.per_endpoint = 2
+        self.max_attempts = 8
+        self.backoff_base = 2.0
+        self.backoff_max = 3600.0
+        self.timeout = 5.0
+        self.poll_interval = 5.0
+        self.allow_private = False
+
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # endpoint url -> deliveries currently being sent to it
+        self._in_flight = {}
+        self._counters = {
+            "enqueued": 0,
+            "delivered": 0,
+            "retried": 0,
+            "dead": 0,
+        }
+
+    def init_app(self, app):
+        app.config.setdefault("WEBHOOK_WORKERS", 4)
+        app.config.setdefault("WEBHOOK_PER_ENDPOINT", 2)
+        app.config.setdefault("WEBHOOK_MAX_ATTEMPTS", 8)
+        app.config.setdefault("WEBHOOK_BACKOFF_BASE", 2.0)
+        app.config.setdefault("WEBHOOK_BACKOFF_MAX", 3600.0)
+        app.config.setdefault("WEBHOOK_TIMEOUT", 5.0)
+        app.config.setdefault("WEBHOOK_POLL_INTERVAL", 5.0)
+        app.config.setdefault("WEBHOOK_DISPATCH", True)
+        # Development only: lets subscriptions point at localhost and the LAN
+        app.config.setdefault("WEBHOOK_ALLOW_PRIVATE", os.getenv("WEBHOOK_ALLOW_PRIVATE", "false").lower() == "true")
+
+        self.workers = app.config["WEBHOOK_WORKERS"]
+        self.per_endpoint = app.config["WEBHOOK_PER_ENDPOINT"]
+        self.max_attempts = app.config["WEBHOOK_MAX_ATTEMPTS"]
+        self.backoff_base = app.config["WEBHOOK_BACKOFF_BASE"]
+        self.backoff_max = app.config["WEBHOOK_BACKOFF_MAX"]
+        self.timeout = app.config["WEBHOOK_TIMEOUT"]
+        self.poll_interval = app.config["WEBHOOK_POLL_INTERVAL"]
+        self.allow_private = app.config["WEBHOOK_ALLOW_PRIVATE"]
+
+        app.extensions["webhooks"] = self
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="webhook")
+        self._thread = threading.Thread(target=self._run, name="webhook-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def emit(self, db, event_type, user_ids, payload):
+        # Queues a delivery for every active subscription of user_ids that
+        # listens to event_type. Two short writes, no network calls.
+        return self.emit_many(db, event_type, user_ids, [payload])
+
+    def emit_many(self, db, event_type, user_ids, payloads):
+        # emit() for a batch of payloads, still in two writes
+        subscriptions = db.query(
+            """
+            SELECT id, url FROM webhook_subscription
+            WHERE owner IN $owners AND active = true
+                AND (events CONTAINS $event_type OR events CONTAINS '*');
+            """,
+            {"owners": [_record(user_id) for user_id in set(map(str, user_ids))], "event_type": event_type}
+        )
+        if not subscriptions or not payloads:
+            return 0
+
+        db.query(
+            "INSERT INTO webhook_delivery $deliveries RETURN NONE",
+            {"deliveries": [
+                {
+                    "subscription": subscription["id"],
+                    "url": subscription["url"],
+                    "event_type": event_type,
+                    "payload": payload,
+                    "status": "pending",
+                    "attempts": 0,
+                }
+                for subscription in subscriptions
+                for payload in payloads
+            ]}
+        )
+        with self._lock:
+            self._counters["enqueued"] += len(subscriptions) * len(payloads)
+        self._wake.set()
+        return len(subscriptions) * len(payloads)
+
+    def check_url(self, url):
+        # An error message for a url subscriptions can't use, or None
+        return resolve(url, self.allow_private)[1]
+
+    def deliver(self, delivery, secret):
+        # Sends one delivery, returning (ok, detail)
+        address, error = resolve(delivery["url"], self.allow_private)
+        if error:
+            return False, error
+        body = json.dumps({
+            "id": str(delivery["id"]),
+            "type": delivery["event_type"],
+            "data": delivery["payload"],
+        }, default=str).encode()
+        timestamp = str(int(time.time()))
+        url = urllib.parse.urlsplit(delivery["url"])
+        connection_class = _PinnedHTTPSConnection if url.scheme == "https" else _PinnedHTTPConnection
+        connection = connection_class(url.hostname, url.port, address, timeout=self.timeout)
+        try:
+            # A redirect is reported as a failure, not followed
+            connection.request("POST", urllib.parse.urlunsplit(("", "", url.path or "/", url.query, "")), body=body, headers={
+                "Content-Type": "application/json",
+                "User-Agent": "CalendarApp-Webhooks",
+                "X-Webhook-Id": str(delivery["id"]),
+                "X-Webhook-Event": delivery["event_type"],
+                "X-Webhook-Timestamp": timestamp,
+                "X-Webhook-Signature": sign(secret, timestamp, body),
+            })
+            response = connection.getresponse()
+            return 200 <= response.status < 300, f"HTTP {response.status}"
+        except (http.client.HTTPException, OSError) as e:
+            return False, str(e) or type(e).__name__
+        finally:
+            connection.close()
+
+    def backoff(self, attempts):
+        delay = min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_flight"] = sum(self._in_flight.values())
+        return stats
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self._claim()
+            except Exception:
+                logger.exception("Failed to claim webhook deliveries")
+                claimed = 0
+            if not claimed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def _claim(self):
+        # Claims due deliveries for endpoints that are below their concurrency
+        # limit. Deliveries left 'sending' by a crashed worker are picked up
+        # again once their lease runs out.
+        with self._lock:
+            capacity = self.workers * 2 - sum(self._in_flight.values())
+        if capacity <= 0:
+            return 0
+
+        with self.sdb.connection() as db:
+            due = db.query(
+                """
+                SELECT id, url, next_attempt_at FROM webhook_delivery
+                WHERE (status = 'pending' AND (next_attempt_at = NONE OR next_attempt_at <= time::now()))
+                    OR (status = 'sending' AND lease_until < time::now())
+                ORDER BY next_attempt_at
+                LIMIT $limit;
+                """,
+                {"limit": capacity * 4}
+            )
+
+            wanted = []
+            with self._lock:
+                reserved = dict(self._in_flight)
+                for delivery in due:
+                    if len(wanted) >= capacity:
+                        break
+                    if reserved.get(delivery["url"], 0) < self.per_endpoint:
+                        reserved[delivery["url"]] = reserved.get(delivery["url"], 0) + 1
+                        wanted.append(delivery["id"])
+            if not wanted:
+                return 0
+
+            deliveries = db.query(
+                """
+                UPDATE $ids SET status = 'sending', lease_until = time::now() + 5m
+                WHERE status = 'pending' OR (status = 'sending' AND lease_until < time::now())
+                RETURN AFTER;
+                """,
+                {"ids": wanted}
+            )
+            secrets = {}
+            if deliveries:
+                subscriptions = db.query(
+                    "SELECT id, secret FROM $ids",
+                    {"ids": list({str(delivery["subscription"]): delivery["subscription"] for delivery in deliveries}.values())}
+                )
+                secrets = {str(subscription["id"]): subscription["secret"] for subscription in subscriptions}
+
+        for delivery in deliveries:
+            with self._lock:
+                self._in_flight[delivery["url"]] = self._in_flight.get(delivery["url"], 0) + 1
+            self._executor.submit(self._send, delivery, secrets.get(str(delivery["subscription"])))
+        return len(deliveries)
+
+    def _send(self, delivery, secret):
+        try:
+            if secret is None:
+                ok, detail = False, "Subscription deleted"
+                attempts = self.max_attempts
+            else:
+                ok, detail = self.deliver(delivery, secret)
+                attempts = delivery.get("attempts", 0) + 1
+
+            with self.sdb.connection() as db:
+                if ok:
+                    db.query(
+                        "UPDATE $id SET status = 'delivered', attempts = $attempts, delivered_at = time::now(), last_error = NONE",
+                        {"id": delivery["id"], "attempts": attempts}
+                    )
+                    counter = "delivered"
+                elif attempts >= self.max_attempts:
+                    db.query(
+                        "UPDATE $id SET status = 'dead', attempts = $attempts, last_error = $error",
+                        {"id": delivery["id"], "attempts": attempts, "error": detail}
+                    )
+                    counter = "dead"
+                else:
+                    db.query(
+                        """
+                        UPDATE $id SET status = 'pending', attempts = $attempts, last_error = $error,
+                            next_attempt_at = time::now() + type::duration($delay);
+                        """,
+                        {"id": delivery["id"], "attempts": attempts, "error": detail, "delay": f"{int(self.backoff(attempts) * 1000)}ms"}
+                    )
+                    counter = "retried"
+            with self._lock:
+                self._counters[counter] += 1
+        except Exception:
+            logger.exception("Failed to send webhook delivery %s", delivery["id"])
+        finally:
+            with self._lock:
+                self._in_flight[delivery["url"]] -= 1
+                if not self._in_flight[delivery["url"]]:
+                    del self._in_flight[delivery["url"]]
+            self._wake.set()